@@ -1,4 +1,4 @@
-import boto3
+from client_helpers import get_client
 from botocore.exceptions import ClientError
 
 
@@ -6,8 +6,7 @@ def get_secret():
     secret_name = "MySecretName"
     region_name = "us-west-2"
 
-    session = boto3.session.Session()
-    client = session.client(
+    client = get_client(
         service_name='secretsmanager',
         region_name=region_name,
     )
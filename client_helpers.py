@@ -0,0 +1,188 @@
+import threading
+import boto3
+from botocore.config import Config
+
+
+# Size of the urllib3 connection pool behind every cached client. Raise it
+# when many threads share one client, e.g., for concurrent S3 transfers.
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+_lock = threading.RLock()
+_sessions = {}
+_clients = {}
+# id(client) -> session key, for the clients in _clients
+_client_sessions = {}
+_http_sessions = {}
+_local = threading.local()
+_max_pool_connections = DEFAULT_MAX_POOL_CONNECTIONS
+_generation = 0
+
+
+def set_max_pool_connections(max_pool_connections):
+    """Set the connection pool size used for clients created from now on
+
+    Clients that are already cached keep their pool; call clear_cache()
+    to rebuild them with the new size.
+
+    :param max_pool_connections: Maximum number of pooled HTTP connections
+    """
+    global _max_pool_connections
+
+    with _lock:
+        _max_pool_connections = max_pool_connections
+
+
+def _session_key(region_name, aws_access_key_id, aws_secret_access_key,
+                 aws_session_token, profile_name):
+    return (region_name, aws_access_key_id, aws_secret_access_key,
+            aws_session_token, profile_name)
+
+
+def _get_session(session_key):
+    # boto3 sessions are not thread safe, so callers must hold _lock
+    session = _sessions.get(session_key)
+    if session is None:
+        region_name, access_key, secret_key, token, profile_name = session_key
+        session = boto3.session.Session(aws_access_key_id=access_key,
+                                        aws_secret_access_key=secret_key,
+                                        aws_session_token=token,
+                                        region_name=region_name,
+                                        profile_name=profile_name)
+        _sessions[session_key] = session
+    return session
+
+
+def get_client(service_name, region_name=None, endpoint_url=None,
+               aws_access_key_id=None, aws_secret_access_key=None,
+               aws_session_token=None, profile_name=None,
+               max_pool_connections=None):
+    """Return a shared low-level client, creating it on first use
+
+    Clients are cached by service, region, endpoint URL, credentials and
+    pool size. Low-level clients are thread safe, so the same instance is
+    returned to every thread and its keep-alive connections are reused.
+
+    :param service_name: AWS service name, e.g., 's3'
+    :param region_name: String region, e.g., 'us-west-2'
+    :param endpoint_url: Custom endpoint, e.g., a VPC interface endpoint
+    :param aws_access_key_id: Explicit access key, if not using the default chain
+    :param aws_secret_access_key: Explicit secret key
+    :param aws_session_token: Explicit session token
+    :param profile_name: Named profile from the shared credentials file
+    :param max_pool_connections: Pool size. If not specified, the module default is used
+    :return: botocore client
+    """
+
+    session_key = _session_key(region_name, aws_access_key_id,
+                               aws_secret_access_key, aws_session_token,
+                               profile_name)
+    with _lock:
+        if max_pool_connections is None:
+            max_pool_connections = _max_pool_connections
+        key = (service_name, endpoint_url, max_pool_connections) + session_key
+        client = _clients.get(key)
+        if client is None:
+            session = _get_session(session_key)
+            config = Config(max_pool_connections=max_pool_connections)
+            client = session.client(service_name, endpoint_url=endpoint_url,
+                                    config=config)
+            _clients[key] = client
+            _client_sessions[id(client)] = session_key
+    return client
+
+
+def get_client_identity(client):
+    """Return the region and credentials a client from get_client was made with
+
+    Use it to key caches of per-caller outcomes, e.g., permission checks,
+    the same way the client cache is keyed.
+
+    :param client: Client returned by get_client
+    :return: Tuple of region name, access key, secret key, session token and
+    profile name as passed to get_client, or None for other clients
+    """
+
+    with _lock:
+        return _client_sessions.get(id(client))
+
+
+def get_resource(service_name, region_name=None, endpoint_url=None,
+                 aws_access_key_id=None, aws_secret_access_key=None,
+                 aws_session_token=None, profile_name=None,
+                 max_pool_connections=None):
+    """Return a service resource cached for the calling thread
+
+    Resources are not thread safe, so each thread gets its own instance per
+    key. They are still built from the shared session, which keeps the
+    loaded service models in memory across threads.
+
+    :param service_name: AWS service name, e.g., 'dynamodb'
+    :return: boto3 service resource
+    """
+
+    session_key = _session_key(region_name, aws_access_key_id,
+                               aws_secret_access_key, aws_session_token,
+                               profile_name)
+    with _lock:
+        if max_pool_connections is None:
+            max_pool_connections = _max_pool_connections
+        generation = _generation
+    key = (service_name, endpoint_url, max_pool_connections) + session_key
+
+    resources = getattr(_local, 'resources', None)
+    if resources is None or getattr(_local, 'generation', None) != generation:
+        resources = _local.resources = {}
+        _local.generation = generation
+
+    resource = resources.get(key)
+    if resource is None:
+        with _lock:
+            session = _get_session(session_key)
+            config = Config(max_pool_connections=max_pool_connections)
+            resource = session.resource(service_name, endpoint_url=endpoint_url,
+                                        config=config)
+        resources[key] = resource
+    return resource
+
+
+def clear_cache():
+    """Drop every cached session, client, resource and HTTP session
+
+    Use this after rotating credentials or changing the pool size.
+    """
+
+    global _generation
+
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
+        _client_sessions.clear()
+        _http_sessions.clear()
+        # Per-thread resource caches are dropped lazily on their next lookup
+        _generation += 1
+
+
+def get_http_session(pool_maxsize=DEFAULT_MAX_POOL_CONNECTIONS):
+    """Return a shared requests.Session for presigned URL traffic
+
+    The session keeps keep-alive connections to S3 open between calls
+    instead of opening a new TCP and TLS connection per request.
+
+    :param pool_maxsize: Maximum number of pooled connections per host
+    :return: requests.Session
+    """
+
+    # requests is only needed by the presigned URL helpers
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    with _lock:
+        session = _http_sessions.get(pool_maxsize)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_maxsize,
+                                  pool_maxsize=pool_maxsize)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_sessions[pool_maxsize] = session
+    return session
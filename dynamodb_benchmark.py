@@ -0,0 +1,144 @@
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+from decimal import Decimal
+from boto3.dynamodb.types import TypeDeserializer
+import client_helpers
+import dynamodb_helpers
+from s3_transfer_benchmark import _start_moto
+
+
+ATTRIBUTES = ['id', 'name', 'count', 'price', 'ratio', 'active']
+
+
+def _item(i):
+    return {'id': f'item-{i:09d}',
+            'name': f'name-{random.randrange(1000)}',
+            'count': random.randrange(1000000),
+            'price': Decimal(random.randrange(100000)) / 100,
+            'ratio': Decimal(str(random.random())),
+            'active': i % 2 == 0}
+
+
+def create_table(table_name, items):
+    dynamodb = client_helpers.get_client('dynamodb')
+    dynamodb.create_table(TableName=table_name,
+                          KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+                          AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+                          BillingMode='PAY_PER_REQUEST')
+    dynamodb.get_waiter('table_exists').wait(TableName=table_name)
+    dynamodb_helpers.invalidate_table(table_name)
+    dynamodb_helpers.batch_write_items(table_name, (_item(i) for i in range(items)))
+
+
+def _raw_pages(table_name):
+    # Pages as the low-level client returns them, to time decoding alone
+    paginator = client_helpers.get_client('dynamodb').get_paginator('scan')
+    return [page['Items'] for page in paginator.paginate(TableName=table_name)]
+
+
+def _resource_decode(pages):
+    deserializer = TypeDeserializer()
+    return [{name: deserializer.deserialize(value) for name, value in raw.items()}
+            for raw_items in pages for raw in raw_items]
+
+
+def _fast_decode(pages):
+    return [item for raw_items in pages for item in dynamodb_helpers._fast_items(raw_items)]
+
+
+# Scenario name -> function returning the number of items it read
+SCENARIOS = {
+    'resource_scan': lambda table_name, pages:
+        sum(1 for _ in dynamodb_helpers.iter_scan(table_name)),
+    'fast_scan': lambda table_name, pages:
+        sum(1 for _ in dynamodb_helpers.iter_scan(table_name, fast=True)),
+    'scan_columns': lambda table_name, pages:
+        len(dynamodb_helpers.scan_columns(table_name, ATTRIBUTES)['id']),
+    'resource_decode': lambda table_name, pages: len(_resource_decode(pages)),
+    'fast_decode': lambda table_name, pages: len(_fast_decode(pages)),
+}
+
+
+def run_scenario(name, table_name, pages, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        count = SCENARIOS[name](table_name, pages)
+        result = (time.perf_counter() - start, time.process_time() - cpu_start)
+        if best is None or result < best:
+            best = result
+    seconds, cpu_seconds = best
+    return {
+        'scenario': name,
+        'items': count,
+        'seconds': seconds,
+        'cpu_seconds': cpu_seconds,
+        'items_per_s': count / seconds,
+    }
+
+
+def run(table_name, items, scenarios, repeat, endpoint_url):
+    # botocore reads this variable when a client is created, so cached
+    # clients have to go first
+    os.environ['AWS_ENDPOINT_URL_DYNAMODB'] = endpoint_url
+    client_helpers.clear_cache()
+    create_table(table_name, items)
+    pages = _raw_pages(table_name)
+
+    results = []
+    for name in scenarios:
+        result = run_scenario(name, table_name, pages, repeat)
+        results.append(result)
+        print(f"{name:<16} {result['items']:>9} items {result['seconds']:>8.3f}s "
+              f"cpu {result['cpu_seconds']:>8.3f}s {result['items_per_s']:>10.0f} items/s")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the resource and fast DynamoDB read paths against a '
+                    'local DynamoDB stand-in')
+    parser.add_argument('--endpoint-url',
+                        help='DynamoDB endpoint. If not specified, a moto server is started')
+    parser.add_argument('--table', default='dynamodb-helpers-benchmark')
+    parser.add_argument('--items', type=int, default=20000, help='Number of items to scan')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per scenario, the fastest is reported')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--output', default='dynamodb_benchmark.json',
+                        help='File to write the results to as JSON')
+    args = parser.parse_args(argv)
+
+    # The stand-in accepts any credentials
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    server = None
+    endpoint_url = args.endpoint_url
+    if endpoint_url is None:
+        server, endpoint_url = _start_moto()
+
+    try:
+        results = run(args.table, args.items, args.scenarios.split(','), args.repeat,
+                      endpoint_url)
+    finally:
+        if server is not None:
+            server.stop()
+
+    with open(args.output, 'w') as f:
+        json.dump({'timestamp': time.time(),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'endpoint_url': endpoint_url,
+                   'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
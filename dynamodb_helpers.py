@@ -1,11 +1,305 @@
-import boto3
+import os
+import gzip
+import json
+import time
+import uuid
+import queue
+import random
+import copy
+import base64
+import threading
+from array import array
+from decimal import Decimal
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from client_helpers import get_client, get_resource
 from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.conditions import Key, Attr, ConditionExpressionBuilder
+from boto3.dynamodb.types import Binary, TypeSerializer, TypeDeserializer
+
+
+_lock = threading.Lock()
+_local = threading.local()
+_key_schemas = {}
+_generation = 0
+
+_DONE = object()
+
+
+def get_table(table_name, region_name=None, endpoint_url=None):
+    """Return a Table handle cached for the calling thread
+
+    Like the resources they come from, Table objects are not thread safe,
+    so each thread keeps its own per region, endpoint and table name. The
+    handle is lazy: no request is made until one of its attributes is read.
+
+    :param table_name: string
+    :param region_name: String region, e.g., 'us-west-2'
+    :param endpoint_url: Custom DynamoDB endpoint
+    :return: boto3 DynamoDB Table resource
+    """
+
+    dynamodb = get_resource('dynamodb', region_name=region_name, endpoint_url=endpoint_url)
+    with _lock:
+        generation = _generation
+    tables = getattr(_local, 'tables', None)
+    if tables is None or getattr(_local, 'generation', None) != generation:
+        tables = _local.tables = {}
+        _local.generation = generation
+
+    key = (region_name, endpoint_url, table_name)
+    table = tables.get(key)
+    # A cleared client cache hands out a new resource, don't keep the old one alive
+    if table is None or table.meta.client is not dynamodb.meta.client:
+        table = tables[key] = dynamodb.Table(table_name)
+    return table
+
+
+def get_key_schema(table_name, region_name=None, endpoint_url=None):
+    """Return the key attribute names of a table, partition key first
+
+    The schema is read with DescribeTable on first use and then shared by
+    every thread.
+
+    :return: Tuple of one or two attribute names
+    """
+
+    key = (region_name, endpoint_url, table_name)
+    with _lock:
+        schema = _key_schemas.get(key)
+    if schema is None:
+        dynamodb = get_client('dynamodb', region_name=region_name, endpoint_url=endpoint_url)
+        key_schema = dynamodb.describe_table(TableName=table_name)['Table']['KeySchema']
+        # KeySchema lists HASH before RANGE, but don't rely on it
+        schema = tuple(k['AttributeName']
+                       for k in sorted(key_schema, key=lambda k: k['KeyType'] != 'HASH'))
+        with _lock:
+            _key_schemas[key] = schema
+    return schema
+
+
+def invalidate_table(table_name=None):
+    """Drop cached Table handles and key schemas
+
+    :param table_name: Table to forget. If not specified, every table is forgotten
+    """
+
+    global _generation
+
+    with _lock:
+        for key in list(_key_schemas):
+            if table_name is None or key[2] == table_name:
+                del _key_schemas[key]
+        # Per-thread Table caches are dropped lazily on their next lookup
+        _generation += 1
+
+
+class _CapacityBucket:
+    # Token bucket that may go into debt: what a request costs is only
+    # known from its response, so requests wait for a positive balance
+    # and pay afterwards
+
+    def __init__(self, rate, burst_seconds):
+        self._lock = threading.Lock()
+        self.set_rate(rate, burst_seconds)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def set_rate(self, rate, burst_seconds):
+        with self._lock:
+            self.rate = float(rate)
+            self.capacity = self.rate * burst_seconds
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait(self, reserve):
+        while True:
+            with self._lock:
+                self._refill()
+                threshold = self.capacity * reserve
+                if self.tokens > threshold:
+                    return
+                wait = max((threshold - self.tokens) / self.rate, 0.001)
+            time.sleep(wait)
+
+    def spend(self, units):
+        with self._lock:
+            self._refill()
+            self.tokens -= units
+
+
+class CapacityLimiter:
+    """Client-side budget of provisioned DynamoDB capacity shared by threads
+
+    Each table and global secondary index gets a read and a write token
+    bucket filled at target_fraction of its provisioned capacity, read with
+    DescribeTable on first use and again every refresh seconds. Requests
+    wait for a positive balance and are charged what ReturnConsumedCapacity
+    reports, so scans, queries and writes that share a limiter stay under
+    the budget together instead of being throttled. On-demand tables are
+    not limited.
+
+    Give background jobs reserved(), so they leave part of the budget to
+    online traffic using the limiter itself.
+    """
+
+    def __init__(self, target_fraction=0.8, burst_seconds=1.0, refresh=300,
+                 region_name=None, endpoint_url=None):
+        """
+        :param target_fraction: Fraction of the provisioned capacity to use
+        :param burst_seconds: Seconds of unused capacity that may be saved up
+        :param refresh: Seconds after which the provisioned capacity is read again
+        :param region_name: String region, e.g., 'us-west-2'
+        :param endpoint_url: Custom DynamoDB endpoint
+        """
+
+        self.target_fraction = target_fraction
+        self.burst_seconds = burst_seconds
+        self.refresh = refresh
+        self.region_name = region_name
+        self.endpoint_url = endpoint_url
+        self._tables = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _buckets(self, table_name):
+        # Returns {(index name or None, 'read' or 'write'): bucket}. DescribeTable
+        # runs outside the lock, so a slow one only holds up its own table.
+        with self._lock:
+            entry = self._tables.get(table_name)
+            if entry is not None and (time.monotonic() < entry[1]
+                                      or table_name in self._refreshing):
+                # Stale buckets are good enough while another thread refreshes
+                return entry[0]
+            self._refreshing.add(table_name)
+
+        try:
+            dynamodb = get_client('dynamodb', region_name=self.region_name,
+                                  endpoint_url=self.endpoint_url)
+            description = dynamodb.describe_table(TableName=table_name)['Table']
+        finally:
+            with self._lock:
+                self._refreshing.discard(table_name)
+        throughputs = [(None, description.get('ProvisionedThroughput', {}))]
+        throughputs.extend((index['IndexName'], index.get('ProvisionedThroughput', {}))
+                           for index in description.get('GlobalSecondaryIndexes', []))
+
+        with self._lock:
+            entry = self._tables.get(table_name)
+            if entry is not None and time.monotonic() < entry[1]:
+                # Another thread got there first
+                return entry[0]
+            buckets = entry[0] if entry is not None else {}
+            for index_name, throughput in throughputs:
+                for kind, units in (('read', 'ReadCapacityUnits'), ('write', 'WriteCapacityUnits')):
+                    rate = throughput.get(units, 0) * self.target_fraction
+                    bucket = buckets.get((index_name, kind))
+                    if not rate:
+                        # On demand
+                        buckets.pop((index_name, kind), None)
+                    elif bucket is None:
+                        buckets[(index_name, kind)] = _CapacityBucket(rate, self.burst_seconds)
+                    else:
+                        bucket.set_rate(rate, self.burst_seconds)
+            self._tables[table_name] = (buckets, time.monotonic() + self.refresh)
+            return buckets
+
+    def wait(self, table_name, kind, index_name=None, reserve=0.0):
+        """Block until a request may be sent
+
+        :param kind: 'read' or 'write'
+        :param index_name: Index a query or scan reads from
+        :param reserve: Fraction of the bucket to leave to other callers
+        """
+
+        buckets = self._buckets(table_name)
+        if kind == 'read':
+            # Local secondary indexes use the table's capacity
+            bucket = buckets.get((index_name, 'read')) or buckets.get((None, 'read'))
+            if bucket is not None:
+                bucket.wait(reserve)
+            return
+        # A write also writes every global secondary index
+        for (_, bucket_kind), bucket in list(buckets.items()):
+            if bucket_kind == 'write':
+                bucket.wait(reserve)
+
+    def consumed(self, consumed_capacity, kind):
+        """Charge what a response reports in ConsumedCapacity
+
+        :param consumed_capacity: ConsumedCapacity of a response, a
+        dictionary or, for batch operations, a list of them
+        :param kind: 'read' or 'write'
+        """
+
+        if not consumed_capacity:
+            return
+        if isinstance(consumed_capacity, dict):
+            consumed_capacity = [consumed_capacity]
+        for capacity in consumed_capacity:
+            buckets = self._buckets(capacity['TableName'])
+            indexes = capacity.get('GlobalSecondaryIndexes', {})
+            for index_name, units in indexes.items():
+                bucket = buckets.get((index_name, kind))
+                if bucket is not None:
+                    bucket.spend(units.get('CapacityUnits', 0))
+            bucket = buckets.get((None, kind))
+            if bucket is not None:
+                bucket.spend(capacity.get('CapacityUnits', 0)
+                             - sum(units.get('CapacityUnits', 0) for units in indexes.values()))
+
+    def reserved(self, reserve):
+        """Return a view of this limiter that leaves reserve of every bucket
+
+        :param reserve: Fraction of each bucket, e.g., 0.5, the view's
+        callers wait for before sending
+        """
+
+        return _ReservedCapacityLimiter(self, reserve)
+
+
+class _ReservedCapacityLimiter:
+
+    def __init__(self, limiter, reserve):
+        self._limiter = limiter
+        self._reserve = reserve
+
+    def wait(self, table_name, kind, index_name=None, reserve=None):
+        self._limiter.wait(table_name, kind, index_name,
+                           self._reserve if reserve is None else reserve)
+
+    def consumed(self, consumed_capacity, kind):
+        self._limiter.consumed(consumed_capacity, kind)
+
+
+def _limit(limiter, kwargs, table_name, kind):
+    # Wait for the budget and ask DynamoDB for the cost of the request
+    if limiter is not None:
+        limiter.wait(table_name, kind, kwargs.get('IndexName'))
+        kwargs['ReturnConsumedCapacity'] = 'INDEXES'
+
+
+_default_limiter = None
+_default_limiter_lock = threading.Lock()
+
+
+def get_capacity_limiter():
+    """Return the process-wide CapacityLimiter, creating it on first use"""
+
+    global _default_limiter
+
+    with _default_limiter_lock:
+        if _default_limiter is None:
+            _default_limiter = CapacityLimiter()
+    return _default_limiter
 
 
 def create_table():
     # Get the service resource.
-    dynamodb = boto3.resource('dynamodb')
+    dynamodb = get_resource('dynamodb')
 
     # Create the DynamoDB table.
     table = dynamodb.create_table(
@@ -38,21 +332,14 @@ def create_table():
 
     # Wait until the table exists.
     table.meta.client.get_waiter('table_exists').wait(TableName='users')
+    invalidate_table('users')
 
     # Print out some data about the table.
     print(table.item_count)
 
 
 def get_table_info(table_name):
-    # Get the service resource.
-    dynamodb = boto3.resource('dynamodb')
-
-    # Instantiate a table resource object without actually
-    # creating a DynamoDB table. Note that the attributes of this table
-    # are lazy-loaded: a request is not made nor are the attribute
-    # values populated until the attributes
-    # on the table resource are accessed or its load() method is called.
-    table = dynamodb.Table(table_name)
+    table = get_table(table_name)
 
     # Print out some data about the table.
     # This will cause a request to be made to DynamoDB and its attribute
@@ -60,75 +347,343 @@ def get_table_info(table_name):
     print(f"Table Name: {table_name} -- Creation DateTime: {table.creation_date_time}")
 
 
-def create_new_item(table_name, new_item):
+class ItemCache:
+    """Thread-safe read-through LRU cache of DynamoDB items
+
+    Entries expire after ttl seconds. Keys that were looked up and not
+    found are remembered as well, for negative_ttl seconds, so hot misses
+    stay off the network too. Pass the same instance to the read and write
+    helpers so writes keep it current.
+
+    Items are copied on the way in and out, so callers may change what
+    they get without changing the cache.
+
+    A read that started before a write to the same key must not replace
+    the written item with the one it read. Readers take generation()
+    before going to the table and hand it to put(), which drops the item
+    if the key was written or invalidated since.
+    """
+
+    def __init__(self, max_size=10000, ttl=60, negative_ttl=10):
+        """
+        :param max_size: Maximum number of items and missing keys to keep
+        :param ttl: Seconds an item is served from the cache
+        :param negative_ttl: Seconds a missing key is remembered. 0 disables it
+        """
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        # Generation of the last write per key, bounded like the items.
+        # Keys dropped from it count as written at _floor.
+        self._generation = 0
+        self._written = OrderedDict()
+        self._tables_written = {}
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def _write(self, table_name, key):
+        # Call with the lock held
+        self._generation += 1
+        self._written[(table_name, key)] = self._generation
+        self._written.move_to_end((table_name, key))
+        while len(self._written) > self.max_size:
+            _, generation = self._written.popitem(last=False)
+            self._floor = max(self._floor, generation)
+
+    def _written_since(self, table_name, key, generation):
+        # Call with the lock held
+        written = max(self._written.get((table_name, key), self._floor),
+                      self._tables_written.get(table_name, 0))
+        return written > generation
+
+    def generation(self):
+        """Return the generation to pass to put() for an item read after now"""
+
+        with self._lock:
+            return self._generation
+
+    def get(self, table_name, key):
+        """Return (hit, item). item is None for a cached missing key
+
+        :param key: Tuple of key values, partition key first
+        """
+
+        with self._lock:
+            entry = self._items.get((table_name, key))
+            if entry is None or time.monotonic() >= entry[1]:
+                if entry is not None:
+                    del self._items[(table_name, key)]
+                self.misses += 1
+                return False, None
+            self._items.move_to_end((table_name, key))
+            if entry[0] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            item = entry[0]
+        return True, copy.deepcopy(item)
+
+    def put(self, table_name, key, item, generation=None):
+        """Cache item under key, or remember key as missing if item is None
+
+        :param generation: For an item read from the table, generation()
+        taken before the read. The item is dropped if key was written or
+        invalidated since. Leave it out for items being written.
+        """
+
+        ttl = self.ttl if item is not None else self.negative_ttl
+        item = copy.deepcopy(item)
+        with self._lock:
+            if generation is None:
+                self._write(table_name, key)
+            elif self._written_since(table_name, key, generation):
+                return
+            if ttl <= 0:
+                self._items.pop((table_name, key), None)
+                return
+            self._items[(table_name, key)] = (item, time.monotonic() + ttl)
+            self._items.move_to_end((table_name, key))
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, table_name, key=None):
+        """Forget key, or every entry of table_name if key is not specified"""
+
+        with self._lock:
+            if key is not None:
+                self._items.pop((table_name, key), None)
+                self._write(table_name, key)
+                return
+            self._generation += 1
+            self._tables_written[table_name] = self._generation
+            for cache_key in [k for k in self._items if k[0] == table_name]:
+                del self._items[cache_key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._written.clear()
+            self._tables_written.clear()
+            self._generation += 1
+            self._floor = self._generation
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {'hits': self.hits, 'negative_hits': self.negative_hits,
+                    'misses': self.misses, 'size': len(self._items),
+                    'hit_ratio': (self.hits + self.negative_hits) / lookups if lookups else 0.0}
+
+
+def _key_tuple(item, schema):
+    return tuple(item[name] for name in schema)
+
+
+def create_new_item(table_name, new_item, cache=None, limiter=None):
     #
     # new_item must be in a form of a dictionary
     #
 
-    # Get the service resource.
-    dynamodb = boto3.resource('dynamodb')
-
-    # Instantiate a table resource object without actually
-    # creating a DynamoDB table. Note that the attributes of this table
-    # are lazy-loaded: a request is not made nor are the attribute
-    # values populated until the attributes
-    # on the table resource are accessed or its load() method is called.
-    table = dynamodb.Table(table_name)
+    table = get_table(table_name)
 
-    table.put_item(new_item)
+    kwargs = {}
+    _limit(limiter, kwargs, table_name, 'write')
+    response = table.put_item(Item=new_item, **kwargs)
+    if limiter is not None:
+        limiter.consumed(response.get('ConsumedCapacity'), 'write')
 
+    if cache is not None:
+        cache.put(table_name, _key_tuple(new_item, get_key_schema(table_name)), new_item)
 
-def get_item(table_name, item_name):
-    # Get the service resource.
-    dynamodb = boto3.resource('dynamodb')
-
-    # Instantiate a table resource object without actually
-    # creating a DynamoDB table. Note that the attributes of this table
-    # are lazy-loaded: a request is not made nor are the attribute
-    # values populated until the attributes
-    # on the table resource are accessed or its load() method is called.
-    table = dynamodb.Table(table_name)
 
-    response = table.get_item(
-    Key={
+def get_item(table_name, item_name, key=None, cache=None, limiter=None):
+    if key is None:
+        key = {
             'username': 'janedoe',
             'last_name': 'Doe'
         }
-    )
+
+    # Serve hot keys, and keys known to be missing, from the cache
+    hit = False
+    if cache is not None:
+        cache_key = _key_tuple(key, get_key_schema(table_name))
+        generation = cache.generation()
+        hit, cached = cache.get(table_name, cache_key)
+        response = {'Item': cached} if cached is not None else {}
+
+    if not hit:
+        table = get_table(table_name)
+        kwargs = {}
+        _limit(limiter, kwargs, table_name, 'read')
+        response = table.get_item(Key=key, **kwargs)
+        if limiter is not None:
+            limiter.consumed(response.get('ConsumedCapacity'), 'read')
+        if cache is not None:
+            cache.put(table_name, cache_key, response.get('Item'), generation)
+
     item = response[item_name]
     print(item)
 
     return item
 
 
-def update_item(table_name, item_name):
-    # Get the service resource.
-    dynamodb = boto3.resource('dynamodb')
+# BatchGetItem accepts at most 100 keys per request
+MAX_BATCH_GET = 100
 
-    # Instantiate a table resource object without actually
-    # creating a DynamoDB table. Note that the attributes of this table
-    # are lazy-loaded: a request is not made nor are the attribute
-    # values populated until the attributes
-    # on the table resource are accessed or its load() method is called.
-    table = dynamodb.Table(table_name)
 
-    table.update_item(
-        Key={
-            'username': 'janedoe',
-            'last_name': 'Doe'
-        },
-        UpdateExpression='SET age = :val1',
-        ExpressionAttributeValues={
-            ':val1': 26
-        }
-    )
+def _batch_get(table_name, keys, request, max_retries, backoff, region_name, endpoint_url,
+               limiter):
+    # Runs on a worker thread, so it takes that thread's resource
+    dynamodb = get_resource('dynamodb', region_name=region_name, endpoint_url=endpoint_url)
+    items = []
+    pending = {table_name: dict(request, Keys=keys)}
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+        kwargs = {}
+        _limit(limiter, kwargs, table_name, 'read')
+        response = dynamodb.batch_get_item(RequestItems=pending, **kwargs)
+        if limiter is not None:
+            limiter.consumed(response.get('ConsumedCapacity'), 'read')
+        items.extend(response['Responses'].get(table_name, []))
+        pending = response.get('UnprocessedKeys')
+        if not pending:
+            return items
+    raise RuntimeError(f'{len(pending[table_name]["Keys"])} keys of {table_name} '
+                       f'still unprocessed after {max_retries} retries')
 
-    response = table.get_item(
-        Key={
-            'username': 'janedoe',
-            'last_name': 'Doe'
-            }
-    )
+
+def batch_get_items(table_name, keys, as_dict=False, projection=None, consistent_read=False,
+                    max_workers=8, max_retries=8, backoff=0.05, region_name=None,
+                    endpoint_url=None, cache=None, limiter=None):
+    """Fetch many items with concurrent BatchGetItem requests
+
+    Keys are split into requests of 100. UnprocessedKeys, which DynamoDB
+    returns when it throttles or a response gets too large, are sent again
+    with jittered exponential backoff.
+
+    :param table_name: string
+    :param keys: Iterable of primary key dictionaries
+    :param as_dict: If True, return a dictionary instead of a list
+    :param projection: List of attribute names to return. The key
+    attributes are always included. If not specified, all
+    :param consistent_read: If True, use strongly consistent reads
+    :param max_workers: Maximum number of concurrent BatchGetItem requests
+    :param max_retries: Number of retries for unprocessed keys
+    :param backoff: Base delay in seconds between retries
+    :param cache: ItemCache to read through. Keys found in it are not
+    requested. It is not read for projections or consistent reads, which
+    must come from the table, but full items read are still cached.
+    :param limiter: CapacityLimiter to pace the requests with
+    :return: List of items in the order of keys, None for keys that do not
+    exist; or, with as_dict, a dictionary of key tuple -> item for the items
+    found, the key tuple holding the key values partition key first
+    """
+
+    schema = get_key_schema(table_name, region_name, endpoint_url)
+    keys = list(keys)
+    found = {}
+    # DynamoDB rejects requests that name the same key twice
+    unique = {}
+    for key in keys:
+        unique.setdefault(_key_tuple(key, schema), key)
+
+    if cache is not None:
+        generation = cache.generation()
+    if cache is not None and not projection and not consistent_read:
+        for key_tuple in list(unique):
+            hit, item = cache.get(table_name, key_tuple)
+            if hit:
+                del unique[key_tuple]
+                if item is not None:
+                    found[key_tuple] = item
+
+    request = {'ConsistentRead': consistent_read}
+    if projection:
+        _projection_arguments(list(dict.fromkeys(list(schema) + list(projection))), request)
+
+    batches = list(unique.values())
+    batches = [batches[i:i + MAX_BATCH_GET] for i in range(0, len(batches), MAX_BATCH_GET)]
+    fetched = {}
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, len(batches)), 1)) as executor:
+        futures = [executor.submit(_batch_get, table_name, batch, request, max_retries,
+                                   backoff, region_name, endpoint_url, limiter)
+                   for batch in batches]
+        for future in futures:
+            for item in future.result():
+                fetched[_key_tuple(item, schema)] = item
+
+    if cache is not None and not projection:
+        for key_tuple in unique:
+            cache.put(table_name, key_tuple, fetched.get(key_tuple), generation)
+    found.update(fetched)
+
+    if as_dict:
+        return found
+    return [found.get(_key_tuple(key, schema)) for key in keys]
+
+
+def _update_arguments(attributes):
+    # Placeholders keep reserved words usable as attribute names
+    names = {}
+    values = {}
+    assignments = []
+    for i, (name, value) in enumerate(attributes.items()):
+        names[f'#u{i}'] = name
+        values[f':u{i}'] = value
+        assignments.append(f'#u{i} = :u{i}')
+    return {'UpdateExpression': 'SET ' + ', '.join(assignments),
+            'ExpressionAttributeNames': names,
+            'ExpressionAttributeValues': values}
+
+
+def update_attributes(table_name, key, attributes, condition=None, return_values='ALL_NEW',
+                      cache=None, limiter=None):
+    """Set attributes of an item and get the result in the same request
+
+    :param table_name: string
+    :param key: Primary key dictionary
+    :param attributes: Dictionary of attribute name -> new value
+    :param condition: Condition the item must meet, e.g., Attr('age').lt(30)
+    :param return_values: 'ALL_NEW', 'UPDATED_NEW', 'ALL_OLD', 'UPDATED_OLD' or 'NONE'
+    :param cache: ItemCache to write the new item through to
+    :param limiter: CapacityLimiter to pace the request with
+    :return: Attributes returned by DynamoDB, per return_values
+    """
+
+    table = get_table(table_name)
+    kwargs = _update_arguments(attributes)
+    if condition is not None:
+        kwargs['ConditionExpression'] = condition
+    _limit(limiter, kwargs, table_name, 'write')
+    response = table.update_item(Key=key, ReturnValues=return_values, **kwargs)
+    if limiter is not None:
+        limiter.consumed(response.get('ConsumedCapacity'), 'write')
+    item = response.get('Attributes')
+
+    if cache is not None:
+        cache_key = _key_tuple(key, get_key_schema(table_name))
+        if return_values == 'ALL_NEW':
+            cache.put(table_name, cache_key, item)
+        else:
+            cache.invalidate(table_name, cache_key)
+    return item
+
+
+def update_item(table_name, item_name, cache=None, limiter=None):
+    key = {
+        'username': 'janedoe',
+        'last_name': 'Doe'
+    }
+
+    # ReturnValues brings the new item back with the update itself
+    response = {'Item': update_attributes(table_name, key, {'age': 26}, cache=cache,
+                                          limiter=limiter)}
 
     item = response[item_name]
     print(item)
@@ -136,98 +691,1116 @@ def update_item(table_name, item_name):
     return item
 
 
-def delete_item(table_name, key):
+def delete_item(table_name, key, cache=None, limiter=None):
     #
     # key must be in the form of a dictionary
     #
 
-    # Get the service resource.
-    dynamodb = boto3.resource('dynamodb')
+    table = get_table(table_name)
+
+    kwargs = {}
+    _limit(limiter, kwargs, table_name, 'write')
+    response = table.delete_item(Key=key, **kwargs)
+    if limiter is not None:
+        limiter.consumed(response.get('ConsumedCapacity'), 'write')
+
+    if cache is not None:
+        # Remember the key as missing
+        cache.put(table_name, _key_tuple(key, get_key_schema(table_name)), None)
+
+
+# TransactWriteItems accepts at most 100 operations per transaction
+MAX_TRANSACTION_ITEMS = 100
+
+# Cancellation reasons after which the same transaction may succeed
+RETRYABLE_CANCELLATIONS = {'TransactionConflict', 'ThrottlingError',
+                           'ProvisionedThroughputExceeded'}
+
+
+def _add_condition(operation, condition):
+    # boto3 only builds condition objects at the top level of a request,
+    # not inside TransactItems, so build the expression here
+    if condition is None:
+        return
+    built = ConditionExpressionBuilder().build_expression(condition)
+    operation['ConditionExpression'] = built.condition_expression
+    operation.setdefault('ExpressionAttributeNames', {}).update(
+        built.attribute_name_placeholders)
+    if built.attribute_value_placeholders:
+        operation.setdefault('ExpressionAttributeValues', {}).update(
+            built.attribute_value_placeholders)
+
+
+def put_operation(table_name, item, condition=None):
+    """Return a Put operation for transact_write
+
+    :param condition: Condition the existing item must meet, e.g.,
+    Attr('username').not_exists()
+    """
+
+    operation = {'TableName': table_name, 'Item': item}
+    _add_condition(operation, condition)
+    return {'Put': operation}
+
+
+def update_operation(table_name, key, attributes, condition=None):
+    """Return an Update operation setting attributes, for transact_write"""
+
+    operation = dict(_update_arguments(attributes), TableName=table_name, Key=key)
+    _add_condition(operation, condition)
+    return {'Update': operation}
+
+
+def delete_operation(table_name, key, condition=None):
+    """Return a Delete operation for transact_write"""
+
+    operation = {'TableName': table_name, 'Key': key}
+    _add_condition(operation, condition)
+    return {'Delete': operation}
+
+
+def _operation_key(operation, region_name=None, endpoint_url=None):
+    # (table name, key tuple) of the item an operation writes
+    (kind, body), = operation.items()
+    schema = get_key_schema(body['TableName'], region_name, endpoint_url)
+    return body['TableName'], _key_tuple(body['Item'] if kind == 'Put' else body['Key'], schema)
+
+
+def _transactions(operations, region_name=None, endpoint_url=None):
+    # A transaction may not touch the same item twice, so such an
+    # operation starts the next one
+    transaction = []
+    keys = set()
+    for operation in operations:
+        key = _operation_key(operation, region_name, endpoint_url)
+        if len(transaction) == MAX_TRANSACTION_ITEMS or key in keys:
+            yield transaction
+            transaction = []
+            keys = set()
+        transaction.append(operation)
+        keys.add(key)
+    if transaction:
+        yield transaction
+
+
+def _transact(client, transaction, max_retries, backoff, limiter):
+    # The token makes a retry of a transaction that did go through a no-op
+    token = str(uuid.uuid4())
+    kwargs = {}
+    if limiter is not None:
+        kwargs['ReturnConsumedCapacity'] = 'INDEXES'
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+        if limiter is not None:
+            for table_name in {body['TableName'] for operation in transaction
+                               for body in operation.values()}:
+                limiter.wait(table_name, 'write')
+        try:
+            response = client.transact_write_items(TransactItems=transaction,
+                                                   ClientRequestToken=token, **kwargs)
+            if limiter is not None:
+                limiter.consumed(response.get('ConsumedCapacity'), 'write')
+            return
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'TransactionCanceledException':
+                reasons = {r.get('Code') for r in e.response.get('CancellationReasons', [])}
+                reasons.discard('None')
+                if not reasons or not reasons <= RETRYABLE_CANCELLATIONS or attempt == max_retries:
+                    raise
+            elif code != 'TransactionInProgressException' or attempt == max_retries:
+                raise
+
+
+def transact_write(operations, max_retries=5, backoff=0.05, region_name=None,
+                   endpoint_url=None, cache=None, limiter=None):
+    """Run puts, updates, deletes and condition checks as transactions
+
+    Operations are grouped into transactions of at most 100, cutting
+    early where an item comes up a second time. Each transaction is atomic,
+    but a list split into several transactions is not: if one fails, the
+    ones before it stay written. Transactions cancelled by a conflict with
+    another write are retried with jittered exponential backoff; a failed
+    condition is raised as the ClientError DynamoDB returned.
+
+    :param operations: Iterable of operations in TransactWriteItems form
+    with plain Python values, e.g., from put_operation, update_operation or
+    delete_operation
+    :param max_retries: Number of retries per cancelled transaction
+    :param backoff: Base delay in seconds between retries
+    :param region_name: Region of the tables
+    :param endpoint_url: Custom DynamoDB endpoint, e.g., DynamoDB Local
+    :param cache: ItemCache to drop the written items from
+    :param limiter: CapacityLimiter to pace the transactions with
+    :return: Number of transactions committed
+    """
+
+    # The resource's client converts the Python values for us
+    client = get_resource('dynamodb', region_name=region_name, endpoint_url=endpoint_url).meta.client
+    committed = 0
+    for transaction in _transactions(operations, region_name, endpoint_url):
+        try:
+            _transact(client, transaction, max_retries, backoff, limiter)
+        finally:
+            if cache is not None:
+                for operation in transaction:
+                    if 'ConditionCheck' not in operation:
+                        cache.invalidate(*_operation_key(operation, region_name,
+                                                         endpoint_url))
+        committed += 1
+    return committed
+
+
+# BatchWriteItem accepts at most 25 items per request
+MAX_BATCH_WRITE = 25
+
+# Error codes DynamoDB uses when a table or account is over its capacity
+THROTTLING_ERRORS = {'ProvisionedThroughputExceededException', 'ThrottlingException',
+                     'RequestLimitExceeded'}
 
-    # Instantiate a table resource object without actually
-    # creating a DynamoDB table. Note that the attributes of this table
-    # are lazy-loaded: a request is not made nor are the attribute
-    # values populated until the attributes
-    # on the table resource are accessed or its load() method is called.
-    table = dynamodb.Table(table_name)
 
-    table.delete_item(key)
+class _AdaptiveDelay:
+    # Shared by the writers of one load. Every throttle doubles the pause
+    # before each request; every clean request shrinks it again.
 
+    def __init__(self, base=0.05, maximum=10.0):
+        self.base = base
+        self.maximum = maximum
+        self.delay = 0.0
+        self.throttled = 0
+        self._lock = threading.Lock()
 
-def table_batch_writer(table_name, item_list):
+    def wait(self):
+        delay = self.delay
+        if delay:
+            time.sleep(random.uniform(delay / 2, delay))
+
+    def throttle(self):
+        with self._lock:
+            self.throttled += 1
+            self.delay = min(max(self.delay * 2, self.base), self.maximum)
+
+    def success(self):
+        if self.delay:
+            with self._lock:
+                self.delay = self.delay * 0.9 if self.delay > self.base else 0.0
+
+
+def _write_batch(dynamodb, table_name, items, delay, max_retries, limiter):
+    # Returns the capacity units consumed
+    consumed = 0.0
+    pending = {table_name: [{'PutRequest': {'Item': item}} for item in items]}
+    for attempt in range(max_retries + 1):
+        delay.wait()
+        if limiter is not None:
+            limiter.wait(table_name, 'write')
+        try:
+            response = dynamodb.batch_write_item(RequestItems=pending,
+                                                 ReturnConsumedCapacity='INDEXES')
+        except ClientError as e:
+            if e.response['Error']['Code'] not in THROTTLING_ERRORS:
+                raise
+            delay.throttle()
+            continue
+        if limiter is not None:
+            limiter.consumed(response.get('ConsumedCapacity'), 'write')
+        consumed += sum(c.get('CapacityUnits', 0) for c in response.get('ConsumedCapacity', []))
+        pending = response.get('UnprocessedItems')
+        if not pending:
+            delay.success()
+            return consumed
+        # Unprocessed items are DynamoDB's other way of saying slow down
+        delay.throttle()
+    raise RuntimeError(f'{len(pending.get(table_name, []))} items of {table_name} '
+                       f'still unprocessed after {max_retries} retries')
+
+
+def batch_write_items(table_name, items, max_workers=8, max_retries=20,
+                      region_name=None, endpoint_url=None, cache=None, limiter=None):
+    """Write a stream of items with parallel BatchWriteItem requests
+
+    Items are consumed lazily and handed to max_workers threads, each
+    buffering its own batch of 25. Items are routed to a thread by their
+    primary key, so the writes of one key are sent in the order given and
+    the last item given for a key is the one that stays. An item whose key
+    is already in the batch replaces the earlier one, since DynamoDB
+    rejects batches that name a key twice. Throttling slows every writer
+    down instead of failing the load.
+
+    :param table_name: string
+    :param items: Iterable of item dictionaries
+    :param max_workers: Number of writer threads
+    :param max_retries: Number of throttled attempts allowed per batch
+    :param cache: ItemCache to write the items through to
+    :param limiter: CapacityLimiter to pace the requests with
+    :return: Dictionary with 'written', the number of items sent, 'seconds',
+    'items_per_s', 'consumed_capacity' in write capacity units and
+    'throttled', the number of throttled requests
+    """
+
+    schema = get_key_schema(table_name, region_name, endpoint_url)
+    delay = _AdaptiveDelay()
+    feeds = [queue.Queue(maxsize=MAX_BATCH_WRITE * 4) for _ in range(max_workers)]
+    stop = threading.Event()
+    lock = threading.Lock()
+    result = {'written': 0, 'consumed_capacity': 0.0}
+    errors = []
+
+    def writer(feed):
+        dynamodb = get_resource('dynamodb', region_name=region_name, endpoint_url=endpoint_url)
+        batch = {}
+
+        def flush():
+            consumed = _write_batch(dynamodb, table_name, list(batch.values()), delay,
+                                    max_retries, limiter)
+            with lock:
+                result['written'] += len(batch)
+                result['consumed_capacity'] += consumed
+            if cache is not None:
+                for key, item in batch.items():
+                    cache.put(table_name, key, item)
+            batch.clear()
+
+        try:
+            while not stop.is_set():
+                try:
+                    message = feed.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if message is _DONE:
+                    break
+                key, item = message
+                batch[key] = item
+                if len(batch) == MAX_BATCH_WRITE:
+                    flush()
+            if batch and not stop.is_set():
+                flush()
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=writer, args=(feed,), daemon=True) for feed in feeds]
+    for thread in threads:
+        thread.start()
+    try:
+        for item in items:
+            key = _key_tuple(item, schema)
+            if not _put(feeds[hash(key) % max_workers], (key, item), stop):
+                break
+    finally:
+        for feed in feeds:
+            _put(feed, _DONE, stop)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    result['seconds'] = time.perf_counter() - start
+    result['items_per_s'] = result['written'] / result['seconds'] if result['seconds'] else 0.0
+    result['throttled'] = delay.throttled
+    return result
+
+
+def table_batch_writer(table_name, item_list, cache=None):
     #
-    # item_list must be in the form of a list of items which are in the form of dictionaries.
+    # item_list can be any iterable of items which are in the form of dictionaries.
     #
-    # Get the service resource.
-    dynamodb = boto3.resource('dynamodb')
+    return batch_write_items(table_name, item_list, cache=cache)
 
-    # Instantiate a table resource object without actually
-    # creating a DynamoDB table. Note that the attributes of this table
-    # are lazy-loaded: a request is not made nor are the attribute
-    # values populated until the attributes
-    # on the table resource are accessed or its load() method is called.
-    table = dynamodb.Table(table_name)
 
-    with table.batch_writer() as batch:
-        for item in item_list:
-            batch.put_item(item)
+def _projection_arguments(projection, kwargs):
+    # Placeholders keep reserved words such as 'name' or 'size' usable
+    names = dict(kwargs.get('ExpressionAttributeNames', {}))
+    placeholders = []
+    for i, attribute in enumerate(projection):
+        names[f'#p{i}'] = attribute
+        placeholders.append(f'#p{i}')
+    kwargs['ProjectionExpression'] = ', '.join(placeholders)
+    kwargs['ExpressionAttributeNames'] = names
 
 
-def query_table(table_name, key_name, key_value):
-    # Get the service resource.
-    dynamodb = boto3.resource('dynamodb')
+def _client_arguments(table_name, kwargs):
+    # The low-level client neither builds condition objects nor serializes
+    # values, so do both here. One builder keeps the placeholders of the key
+    # condition and the filter apart.
+    builder = ConditionExpressionBuilder()
+    names = dict(kwargs.get('ExpressionAttributeNames', {}))
+    values = dict(kwargs.get('ExpressionAttributeValues', {}))
+    for argument, is_key_condition in (('KeyConditionExpression', True),
+                                       ('FilterExpression', False)):
+        condition = kwargs.get(argument)
+        if condition is not None and not isinstance(condition, str):
+            built = builder.build_expression(condition, is_key_condition=is_key_condition)
+            kwargs[argument] = built.condition_expression
+            names.update(built.attribute_name_placeholders)
+            values.update(built.attribute_value_placeholders)
+    if names:
+        kwargs['ExpressionAttributeNames'] = names
+    if values:
+        serializer = TypeSerializer()
+        kwargs['ExpressionAttributeValues'] = {placeholder: serializer.serialize(value)
+                                               for placeholder, value in values.items()}
+    kwargs['TableName'] = table_name
 
-    # Instantiate a table resource object without actually
-    # creating a DynamoDB table. Note that the attributes of this table
-    # are lazy-loaded: a request is not made nor are the attribute
-    # values populated until the attributes
-    # on the table resource are accessed or its load() method is called.
-    table = dynamodb.Table(table_name)
 
-    response = table.query(
-        KeyConditionExpression=Key(key_name).eq(key_value)
-    )
+def _number(data):
+    if '.' in data or 'e' in data or 'E' in data:
+        return float(data)
+    return int(data)
 
-    items = response['Items']
 
-    print(items)
+def _fast_value(value):
+    for kind, data in value.items():
+        if kind == 'S':
+            return data
+        if kind == 'N':
+            return _number(data)
+        return _CONVERTERS[kind](data)
 
-    return items
 
+# DynamoDB JSON type -> converter to a native Python value. The client
+# already decodes binary values to bytes and booleans to bool.
+_CONVERTERS = {
+    'S': lambda data: data,
+    'N': _number,
+    'B': bytes,
+    'BOOL': lambda data: data,
+    'NULL': lambda data: None,
+    'L': lambda data: [_fast_value(value) for value in data],
+    'M': lambda data: {name: _fast_value(value) for name, value in data.items()},
+    'SS': set,
+    'NS': lambda data: {_number(number) for number in data},
+    'BS': set,
+}
 
-def scan_table(table_name, scan_name, scan_value):
-    # Get the service resource.
-    dynamodb = boto3.resource('dynamodb')
 
-    # Instantiate a table resource object without actually
-    # creating a DynamoDB table. Note that the attributes of this table
-    # are lazy-loaded: a request is not made nor are the attribute
-    # values populated until the attributes
-    # on the table resource are accessed or its load() method is called.
-    table = dynamodb.Table(table_name)
+def _fast_item(raw):
+    # Strings and numbers are inlined, they make up most attributes
+    item = {}
+    for name, value in raw.items():
+        for kind, data in value.items():
+            if kind == 'S':
+                item[name] = data
+            elif kind == 'N':
+                item[name] = _number(data)
+            else:
+                item[name] = _CONVERTERS[kind](data)
+    return item
 
-    response = table.scan(
-        FilterExpression=Attr(scan_name).lt(scan_value)
-    )
 
-    items = response['Items']
+def _fast_items(raw_items):
+    return [_fast_item(raw) for raw in raw_items]
+
+
+def _raw_items(raw_items):
+    return raw_items
+
+
+def _page_client(table_name, decode=None):
+    # Resolved on the calling thread and handed to the thread fetching the
+    # pages. Table handles are not thread safe, but their client is, and it
+    # carries the resource layer's condition building and type conversion,
+    # so the fetching thread never needs a resource of its own.
+    if decode is None:
+        return get_table(table_name).meta.client
+    return get_client('dynamodb')
+
+
+def _pages(client, table_name, method, kwargs, limit, page_size, decode=None,
+           limiter=None):
+    # With decode, client is the low-level one and decode turns the raw
+    # items of each page into what is yielded
+    kwargs['TableName'] = table_name
+    returned = 0
+    while limit is None or returned < limit:
+        request_limit = page_size
+        if limit is not None:
+            request_limit = min(request_limit or limit, limit - returned)
+        if request_limit:
+            kwargs['Limit'] = request_limit
+        _limit(limiter, kwargs, table_name, 'read')
+        response = getattr(client, method)(**kwargs)
+        if limiter is not None:
+            limiter.consumed(response.get('ConsumedCapacity'), 'read')
+        items = response['Items']
+        last_evaluated_key = response.get('LastEvaluatedKey')
+        returned += len(items)
+        if decode is not None:
+            items = decode(items)
+        yield items, last_evaluated_key
+        if last_evaluated_key is None:
+            return
+        kwargs['ExclusiveStartKey'] = last_evaluated_key
+
+
+def _put(pages, item, stop):
+    # Blocks while the consumer is behind, but gives up once it has gone away
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _iter_pages(table_name, method, kwargs, limit, page_size, projection,
+                max_buffered_pages, decode=None, limiter=None):
+    if projection:
+        _projection_arguments(projection, kwargs)
+    if decode is not None:
+        _client_arguments(table_name, kwargs)
+
+    client = _page_client(table_name, decode)
+    pages = queue.Queue(maxsize=max(max_buffered_pages, 1))
+    stop = threading.Event()
+
+    def prefetch():
+        try:
+            for items, _ in _pages(client, table_name, method, kwargs, limit, page_size,
+                                   decode, limiter):
+                if not _put(pages, (items, None), stop):
+                    return
+        except Exception as e:
+            _put(pages, (_DONE, e), stop)
+        else:
+            _put(pages, (_DONE, None), stop)
+
+    thread = threading.Thread(target=prefetch, daemon=True)
+    thread.start()
+    try:
+        while True:
+            items, error = pages.get()
+            if items is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield items
+    finally:
+        # Let the prefetch thread go if the caller stopped early. It notices
+        # within 0.1 s of its current request finishing.
+        stop.set()
+        thread.join()
+
+
+def _iter_items(table_name, method, kwargs, limit, page_size, projection,
+                max_buffered_pages, fast, limiter):
+    for items in _iter_pages(table_name, method, kwargs, limit, page_size, projection,
+                             max_buffered_pages, _fast_items if fast else None, limiter):
+        yield from items
+
+
+def iter_query(table_name, key_condition, limit=None, page_size=None, projection=None,
+               max_buffered_pages=2, fast=False, limiter=None, **kwargs):
+    """Stream every item matching a query, following LastEvaluatedKey
+
+    The next page is fetched in the background while the caller works
+    through the current one.
+
+    :param table_name: string
+    :param key_condition: Condition on the key, e.g., Key('username').eq('janedoe')
+    :param limit: Maximum number of items to return. If not specified, all of them
+    :param page_size: Items evaluated per Query request. If not specified,
+    DynamoDB returns up to 1 MB per page
+    :param projection: List of attribute names to return. If not specified, all
+    :param max_buffered_pages: Maximum number of pages fetched ahead of the
+    caller. Each page is at most 1 MB of data.
+    :param fast: If True, read through the low-level client and convert
+    numbers to int or float instead of Decimal. Floats lose digits beyond
+    double precision.
+    :param limiter: CapacityLimiter to pace the requests with
+    :param kwargs: Further Query parameters, e.g., IndexName or FilterExpression
+    :return: Generator of items
+    """
+
+    kwargs['KeyConditionExpression'] = key_condition
+    return _iter_items(table_name, 'query', kwargs, limit, page_size, projection,
+                       max_buffered_pages, fast, limiter)
+
+
+def iter_scan(table_name, filter_expression=None, limit=None, page_size=None,
+              projection=None, max_buffered_pages=2, fast=False, limiter=None, **kwargs):
+    """Stream every item of a table, following LastEvaluatedKey
+
+    See iter_query for the parameters.
+
+    :param filter_expression: Condition items must match, e.g., Attr('age').lt(27)
+    :return: Generator of items
+    """
+
+    if filter_expression is not None:
+        kwargs['FilterExpression'] = filter_expression
+    return _iter_items(table_name, 'scan', kwargs, limit, page_size, projection,
+                       max_buffered_pages, fast, limiter)
+
+
+def _column(values, column_type):
+    if column_type == 'array':
+        # bool is an int subclass, but does not belong in an int column
+        types = {type(value) for value in values}
+        if types <= {int}:
+            try:
+                return array('q', values)
+            except OverflowError:
+                pass
+        if types <= {int, float}:
+            return array('d', values)
+        return values
+    if column_type == 'numpy':
+        import numpy
+        types = {type(value) for value in values}
+        if types <= {int}:
+            try:
+                return numpy.array(values, dtype=numpy.int64)
+            except OverflowError:
+                pass
+        if types <= {int, float, type(None)}:
+            # Missing numbers become NaN
+            return numpy.array([numpy.nan if value is None else value for value in values],
+                               dtype=numpy.float64)
+        return numpy.array(values, dtype=object)
+    return values
+
+
+def scan_columns(table_name, attributes, filter_expression=None, page_size=None,
+                 column_type='array', max_buffered_pages=2, limiter=None, **kwargs):
+    """Scan a table straight into one column per attribute
+
+    Items are decoded from the low-level client's response without building
+    a dictionary per item.
+
+    :param table_name: string
+    :param attributes: List of attribute names to read
+    :param filter_expression: Condition items must match, e.g., Attr('age').lt(27)
+    :param column_type: 'list', 'array', 'numpy' or 'arrow'. With 'array',
+    columns holding only integers or only numbers become array.array('q')
+    or array.array('d'); any other column stays a list. 'numpy' makes the
+    same choice with NumPy arrays, missing numbers becoming NaN. 'arrow'
+    returns a pyarrow.RecordBatch.
+    :param limiter: CapacityLimiter to pace the requests with
+    :param kwargs: Further Scan parameters, e.g., IndexName or Segment
+    :return: Dictionary of attribute name -> column, None marking items
+    without the attribute; or a pyarrow.RecordBatch
+    """
+
+    if filter_expression is not None:
+        kwargs['FilterExpression'] = filter_expression
+    columns = {name: [] for name in attributes}
+    for raw_items in _iter_pages(table_name, 'scan', kwargs, None, page_size, attributes,
+                                 max_buffered_pages, _raw_items, limiter):
+        for name, column in columns.items():
+            append = column.append
+            for raw in raw_items:
+                value = raw.get(name)
+                append(None if value is None else _fast_value(value))
+
+    if column_type == 'arrow':
+        import pyarrow
+        return pyarrow.RecordBatch.from_pydict(columns)
+    return {name: _column(values, column_type) for name, values in columns.items()}
+
+
+def _encode_key(key):
+    # Key attributes can only be strings, numbers or binary
+    encoded = {}
+    for name, value in key.items():
+        if isinstance(value, str):
+            encoded[name] = {'S': value}
+        elif isinstance(value, Binary):
+            encoded[name] = {'B': base64.b64encode(value.value).decode('ascii')}
+        else:
+            encoded[name] = {'N': str(value)}
+    return encoded
+
+
+def _decode_key(encoded):
+    key = {}
+    for name, value in encoded.items():
+        (kind, data), = value.items()
+        if kind == 'S':
+            key[name] = data
+        elif kind == 'B':
+            key[name] = Binary(base64.b64decode(data))
+        else:
+            key[name] = Decimal(data)
+    return key
+
+
+def load_scan_checkpoint(checkpoint_path, total_segments):
+    """Load the progress of an interrupted parallel_scan
+
+    :return: Dictionary with 'total_segments', 'done', the list of finished
+    segments, and 'keys', segment -> encoded LastEvaluatedKey of the last
+    page handed to the caller
+    """
+
+    checkpoint = {'total_segments': total_segments, 'done': [], 'keys': {}}
+    if checkpoint_path is None:
+        return checkpoint
+    try:
+        with open(checkpoint_path) as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return checkpoint
+    if saved['total_segments'] != total_segments:
+        raise ValueError(f'{checkpoint_path} was written for {saved["total_segments"]} '
+                         f'segments, not {total_segments}')
+    return saved
+
+
+def save_scan_checkpoint(checkpoint_path, checkpoint):
+    # Write to a temporary file first so an interrupted run never leaves
+    # a truncated checkpoint behind
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f, separators=(',', ':'))
+    os.replace(tmp_path, checkpoint_path)
+
+
+def _scan_segment(client, table_name, segment, total_segments, kwargs, start_key,
+                  page_size, pages, stop, decode, limiter):
+    kwargs = dict(kwargs, Segment=segment, TotalSegments=total_segments)
+    if start_key is not None:
+        kwargs['ExclusiveStartKey'] = start_key
+    try:
+        for items, last_evaluated_key in _pages(client, table_name, 'scan', kwargs, None,
+                                                page_size, decode, limiter):
+            if not _put(pages, (segment, items, last_evaluated_key), stop):
+                return
+    except Exception as e:
+        _put(pages, (segment, _DONE, e), stop)
+
+
+def parallel_scan(table_name, total_segments=8, max_workers=None, filter_expression=None,
+                  projection=None, ordered=False, checkpoint_path=None, page_size=None,
+                  max_buffered_pages=2, raw=False, limiter=None, **kwargs):
+    """Scan a table with parallel Segment / TotalSegments scans
+
+    Segments are scanned on a thread pool and merged into one stream.
+    With a checkpoint file, progress is saved after each page the caller
+    has consumed, and a later call with the same file and total_segments
+    skips finished segments and resumes the others from their last page.
+    Items of a page that was only partly consumed are returned again.
+
+    :param table_name: string
+    :param total_segments: Number of segments the table is split into
+    :param max_workers: Number of concurrent segment scans. If not
+    specified, one per segment
+    :param filter_expression: Condition items must match, e.g., Attr('age').lt(27)
+    :param projection: List of attribute names to return. If not specified, all
+    :param ordered: If True, items come back segment by segment, else in
+    the order pages arrive
+    :param checkpoint_path: JSON file to save progress to and resume from
+    :param page_size: Items evaluated per Scan request
+    :param max_buffered_pages: Maximum number of pages fetched ahead per
+    worker. Each page is at most 1 MB of data.
+    :param raw: If True, return items in DynamoDB JSON as the low-level
+    client does, e.g., {'age': {'N': '26'}}
+    :param limiter: CapacityLimiter shared by the segment scans
+    :param kwargs: Further Scan parameters, e.g., IndexName or ConsistentRead
+    :return: Generator of items
+    """
+
+    if filter_expression is not None:
+        kwargs['FilterExpression'] = filter_expression
+    if projection:
+        _projection_arguments(projection, kwargs)
+
+    decode = None
+    encode_key = _encode_key
+    decode_key = _decode_key
+    if raw:
+        _client_arguments(table_name, kwargs)
+        decode = _raw_items
+        # Checkpoints hold keys in one format, whichever way they were read
+        deserializer = TypeDeserializer()
+        serializer = TypeSerializer()
+        encode_key = lambda key: _encode_key({name: deserializer.deserialize(value)
+                                              for name, value in key.items()})
+        decode_key = lambda encoded: {name: serializer.serialize(value)
+                                      for name, value in _decode_key(encoded).items()}
+
+    checkpoint = load_scan_checkpoint(checkpoint_path, total_segments)
+    done = set(checkpoint['done'])
+    segments = [segment for segment in range(total_segments) if segment not in done]
+    if not segments:
+        return
+    max_workers = min(max_workers or total_segments, len(segments))
+
+    stop = threading.Event()
+    if ordered:
+        # Segments start in order, so the one being consumed is always running
+        queues = {segment: queue.Queue(maxsize=max(max_buffered_pages, 1))
+                  for segment in segments}
+    else:
+        shared = queue.Queue(maxsize=max(max_buffered_pages, 1) * max_workers)
+        queues = {segment: shared for segment in segments}
+
+    def consume(message):
+        # Returns True once the message's segment is finished
+        segment, items, last_evaluated_key = message
+        if items is _DONE:
+            raise last_evaluated_key
+        yield from items
+        if last_evaluated_key is None:
+            checkpoint['done'].append(segment)
+            checkpoint['keys'].pop(str(segment), None)
+        else:
+            checkpoint['keys'][str(segment)] = encode_key(last_evaluated_key)
+        if checkpoint_path is not None:
+            save_scan_checkpoint(checkpoint_path, checkpoint)
+        return last_evaluated_key is None
+
+    client = _page_client(table_name, decode)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for segment in segments:
+            start_key = checkpoint['keys'].get(str(segment))
+            executor.submit(_scan_segment, client, table_name, segment, total_segments,
+                            kwargs, decode_key(start_key) if start_key else None,
+                            page_size, queues[segment], stop, decode, limiter)
+
+        if ordered:
+            for segment in segments:
+                while not (yield from consume(queues[segment].get())):
+                    pass
+        else:
+            remaining = len(segments)
+            while remaining:
+                if (yield from consume(shared.get())):
+                    remaining -= 1
+    finally:
+        # Unblock workers if the caller stopped early or a segment failed
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _export_default(value):
+    # The only non-JSON values in client output are binary ones
+    return base64.b64encode(value).decode('ascii')
+
+
+def _import_value(value):
+    # DynamoDB JSON from an export -> value the resource layer accepts
+    for kind, data in value.items():
+        if kind == 'S' or kind == 'BOOL':
+            return data
+        if kind == 'N':
+            return Decimal(data)
+        if kind == 'B':
+            return base64.b64decode(data)
+        if kind == 'NULL':
+            return None
+        if kind == 'L':
+            return [_import_value(v) for v in data]
+        if kind == 'M':
+            return {name: _import_value(v) for name, v in data.items()}
+        if kind == 'SS':
+            return set(data)
+        if kind == 'NS':
+            return {Decimal(number) for number in data}
+        if kind == 'BS':
+            return {base64.b64decode(b) for b in data}
+        raise ValueError(f'Unknown DynamoDB type {kind}')
+
+
+# Items per row group of a Parquet export
+PARQUET_ROW_GROUP = 10000
+
+# DynamoDB types stored as Arrow columns of their own. Any other type, and
+# any attribute holding values of several types, is stored as DynamoDB
+# JSON text. Which one a column holds is kept in its field metadata. NULL
+# attributes get a column of True marked NULL.
+_PARQUET_KINDS = {'S', 'N', 'BOOL', 'B', 'SS', 'NS', 'BS'}
+
+
+def _json_text(raw):
+    return json.dumps(raw, default=_export_default, separators=(',', ':'))
+
+
+def _parquet_column(pyarrow, raw_values):
+    # Returns (kind, array) for the values of one attribute in one chunk.
+    # kind is the DynamoDB type, 'json', or '' if every value is missing.
+    kinds = {next(iter(raw)) for raw in raw_values if raw is not None}
+    if not kinds:
+        return '', pyarrow.nulls(len(raw_values))
+    kind = kinds.pop() if len(kinds) == 1 else 'json'
+    if kind == 'NULL':
+        # Arrow nulls stand for missing attributes, so mark NULLs with True
+        return kind, pyarrow.array([None if raw is None else True for raw in raw_values],
+                                   pyarrow.bool_())
+    if kind in _PARQUET_KINDS:
+        values = [None if raw is None else _fast_value(raw) for raw in raw_values]
+        if kind in ('SS', 'NS', 'BS'):
+            values = [None if value is None else sorted(value) for value in values]
+        try:
+            return kind, pyarrow.array(values)
+        except (pyarrow.ArrowException, OverflowError):
+            # E.g., numbers too large for int64 and too precise for a double
+            pass
+    return 'json', pyarrow.array([None if raw is None else _json_text(raw) for raw in raw_values],
+                                 pyarrow.string())
+
+
+def _parquet_table(pyarrow, attributes, raw_items):
+    columns = [_parquet_column(pyarrow, [raw.get(name) for raw in raw_items])
+               for name in attributes]
+    schema = pyarrow.schema([pyarrow.field(name, array.type, metadata={'dynamodb': kind})
+                             for name, (kind, array) in zip(attributes, columns)])
+    return pyarrow.Table.from_arrays([array for _, array in columns], schema=schema)
+
+
+def _kind(field):
+    return (field.metadata or {}).get(b'dynamodb', b'').decode()
+
+
+def _unify_field(pyarrow, old, new):
+    old_kind, new_kind = _kind(old), _kind(new)
+    if (old.type == new.type and old_kind == new_kind) or not new_kind:
+        return old
+    if not old_kind:
+        return new
+    if old_kind == new_kind == 'N':
+        # int64 in one chunk, double in another
+        return pyarrow.field(old.name, pyarrow.float64(), metadata={'dynamodb': 'N'})
+    return pyarrow.field(old.name, pyarrow.string(), metadata={'dynamodb': 'json'})
+
+
+def _tagged_value(kind, value):
+    # Column value read back from Arrow -> DynamoDB JSON
+    if kind == 'N':
+        return {'N': str(value)}
+    if kind == 'NS':
+        return {'NS': [str(number) for number in value]}
+    return {kind: value}
+
+
+def _convert_column(pyarrow, column, old, new):
+    if old.type == new.type and _kind(old) == _kind(new):
+        return column
+    if _kind(new) == 'json' and _kind(old) != 'json':
+        return pyarrow.array([None if value is None else _json_text(_tagged_value(_kind(old), value))
+                              for value in column.to_pylist()], pyarrow.string())
+    # Missing everywhere so far, or int64 numbers becoming doubles
+    return column.cast(new.type)
+
+
+def _convert_table(pyarrow, table, schema):
+    return pyarrow.Table.from_arrays(
+        [_convert_column(pyarrow, table.column(i), table.schema.field(i), schema.field(i))
+         for i in range(len(schema))], schema=schema)
+
+
+class _ParquetExport:
+    # Parquet file whose schema widens as chunks come in. A file has one
+    # schema, so when a chunk does not fit it, the row groups written so far
+    # are copied to a new file under the wider schema. Each column can only
+    # widen a few times, from missing to a type, int64 to double, and to
+    # DynamoDB JSON, so that happens rarely.
+
+    def __init__(self, pyarrow, path):
+        self.pyarrow = pyarrow
+        self.path = path
+        self.current_path = path
+        self.writer = None
+
+    def write(self, table):
+        pyarrow = self.pyarrow
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        else:
+            schema = self.writer.schema
+            unified = pyarrow.schema([_unify_field(pyarrow, old, new)
+                                      for old, new in zip(schema, table.schema)])
+            if not unified.equals(schema, check_metadata=True):
+                self._rewrite(unified)
+            table = _convert_table(pyarrow, table, self.writer.schema)
+        self.writer.write_table(table)
+
+    def _rewrite(self, schema):
+        self.writer.close()
+        old_path = self.current_path
+        self.current_path = self.path + '.tmp' if old_path == self.path else self.path
+        self.writer = self.pyarrow.parquet.ParquetWriter(self.current_path, schema)
+        parquet_file = self.pyarrow.parquet.ParquetFile(old_path)
+        try:
+            old_schema = parquet_file.schema_arrow
+            for i in range(parquet_file.num_row_groups):
+                table = self.pyarrow.Table.from_arrays(parquet_file.read_row_group(i).columns,
+                                                       schema=old_schema)
+                self.writer.write_table(_convert_table(self.pyarrow, table, schema))
+        finally:
+            parquet_file.close()
+        os.remove(old_path)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.current_path != self.path:
+            os.replace(self.current_path, self.path)
+
+
+def _import_parquet_value(kind, value):
+    if kind == 'NULL':
+        return None
+    if kind == 'json':
+        return _import_value(json.loads(value))
+    if kind in ('SS', 'BS'):
+        return set(value)
+    if kind == 'NS':
+        return {Decimal(str(number)) for number in value}
+    # The resource layer takes no floats
+    return Decimal(str(value)) if isinstance(value, float) else value
+
+
+def _open_export(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def export_table(table_name, path, total_segments=8, max_workers=None, attributes=None,
+                 page_size=None, limiter=None):
+    """Stream a whole table to a local file
+
+    Segments are scanned in parallel and each page is written out as soon
+    as it arrives, so memory use does not grow with the table.
+
+    Files ending in .parquet are written as Parquet, which needs pyarrow,
+    in row groups of PARQUET_ROW_GROUP items. Strings, numbers, booleans, binary values
+    and sets get typed columns; NULL attributes a boolean column of True, to
+    tell them from missing ones. Lists, maps and attributes holding values
+    of several types are stored as DynamoDB JSON text. When a later row group
+    needs a wider column type, the file written so far is rewritten with
+    it. Numbers become int64 or double, so they lose digits beyond double
+    precision. import_table restores sets, numbers and NULLs from the
+    column types. Every other file is written as JSON Lines in
+    the format of DynamoDB's own export to S3, one {"Item": {...}} per
+    line, with binary values base64 encoded; a .gz suffix gzips it.
+
+    :param table_name: string
+    :param path: File to write
+    :param total_segments: Number of segments scanned in parallel
+    :param max_workers: Number of concurrent segment scans. If not
+    specified, one per segment
+    :param attributes: Attributes to export. Required for Parquet, where
+    they are the columns. If not specified, all
+    :param page_size: Items evaluated per Scan request
+    :param limiter: CapacityLimiter to pace the scan with
+    :return: Number of items exported
+    """
+
+    parquet = path.endswith('.parquet')
+    if parquet and not attributes:
+        raise ValueError('Parquet exports need the list of attributes')
+    pages = parallel_scan(table_name, total_segments, max_workers, projection=attributes,
+                          page_size=page_size, raw=True, limiter=limiter)
+    count = 0
+
+    if parquet:
+        import pyarrow
+        import pyarrow.parquet
+
+        export = _ParquetExport(pyarrow, path)
+        rows = []
+        try:
+            for raw in pages:
+                rows.append(raw)
+                if len(rows) == PARQUET_ROW_GROUP:
+                    export.write(_parquet_table(pyarrow, attributes, rows))
+                    count += len(rows)
+                    rows = []
+            if rows or export.writer is None:
+                export.write(_parquet_table(pyarrow, attributes, rows))
+                count += len(rows)
+        finally:
+            export.close()
+        return count
+
+    with _open_export(path, 'w') as f:
+        for raw in pages:
+            f.write(json.dumps({'Item': raw}, default=_export_default, separators=(',', ':')))
+            f.write('\n')
+            count += 1
+    return count
+
+
+def _read_export(path, batch_size):
+    if path.endswith('.parquet'):
+        import pyarrow.parquet
+
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        kinds = {field.name: _kind(field) for field in parquet_file.schema_arrow}
+        for batch in parquet_file.iter_batches(batch_size=batch_size):
+            for row in batch.to_pylist():
+                # Missing attributes come back as None
+                yield {name: _import_parquet_value(kinds[name], value)
+                       for name, value in row.items() if value is not None}
+        return
+
+    with _open_export(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield {name: _import_value(value)
+                       for name, value in json.loads(line)['Item'].items()}
+
+
+def import_table(table_name, path, max_workers=8, batch_size=10000, limiter=None):
+    """Stream a file written by export_table into a table
+
+    The file is read lazily and fed to parallel batch writers, so memory
+    use does not grow with the file.
+
+    :param table_name: Table to write to. It must exist.
+    :param path: File written by export_table
+    :param max_workers: Number of writer threads
+    :param batch_size: Rows read from a Parquet file at a time
+    :param limiter: CapacityLimiter to pace the writes with
+    :return: Same dictionary as batch_write_items
+    """
+
+    return batch_write_items(table_name, _read_export(path, batch_size), max_workers=max_workers,
+                             limiter=limiter)
+
+
+def copy_table(source_table_name, dest_table_name, total_segments=8, max_workers=8,
+               limiter=None):
+    """Copy every item of a table into another with no file in between
+
+    The parallel scan of the source feeds the parallel writers of the
+    destination directly.
+
+    :param limiter: CapacityLimiter to pace both tables with
+    :return: Same dictionary as batch_write_items
+    """
+
+    return batch_write_items(dest_table_name,
+                             parallel_scan(source_table_name, total_segments, limiter=limiter),
+                             max_workers=max_workers, limiter=limiter)
+
+
+def query_table(table_name, key_name, key_value):
+    items = list(iter_query(table_name, Key(key_name).eq(key_value)))
 
     print(items)
 
     return items
 
 
-def delete_table(table_name):
-    # Get the service resource.
-    dynamodb = boto3.resource('dynamodb')
+def scan_table(table_name, scan_name, scan_value):
+    items = list(iter_scan(table_name, Attr(scan_name).lt(scan_value)))
+
+    print(items)
 
-    # Instantiate a table resource object without actually
-    # creating a DynamoDB table. Note that the attributes of this table
-    # are lazy-loaded: a request is not made nor are the attribute
-    # values populated until the attributes
-    # on the table resource are accessed or its load() method is called.
-    table = dynamodb.Table(table_name)
+    return items
+
+
+def delete_table(table_name):
+    table = get_table(table_name)
 
     table.delete()
+    invalidate_table(table_name)
 
 
@@ -1,9 +1,83 @@
-import boto3
-from botocore.exceptions import ClientError
+import copy
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from client_helpers import get_client, get_client_identity, DEFAULT_MAX_POOL_CONNECTIONS
+from botocore.exceptions import BotoCoreError, ClientError
+
+
+# Instance IDs sent per StartInstances, StopInstances, ... request
+MAX_INSTANCE_IDS = 1000
+
+# Seconds a dry-run permission check is trusted
+DRY_RUN_TTL = 900
+
+# Error codes that only concern some of the instances in a request. The
+# batch is split to get the action to the others.
+INSTANCE_ERRORS = ('InvalidInstanceID.', 'IncorrectInstanceState')
+
+_dry_run_lock = threading.Lock()
+_dry_runs = {}
+
+
+def check_permission(ec2, method_name, instance_ids, ttl=DRY_RUN_TTL):
+    """Dry-run an instance action once and remember the outcome
+
+    Permissions rarely change, so the outcome is cached for ttl seconds
+    per credentials, region and action, instead of costing an extra request
+    for every call. The first check of an action decides for all instances,
+    so an IAM policy that allows it on some instances only is not told
+    apart; the real request still fails for the others. Errors about the
+    instances themselves, e.g., an unknown ID, say nothing about
+    permissions and are not cached. Clients that do not come from
+    client_helpers.get_client are checked every time.
+
+    :param ec2: EC2 client
+    :param method_name: Client method, e.g., 'start_instances'
+    :param instance_ids: Instance IDs to dry-run the action with
+    :raises ClientError: If the caller is not allowed to run the action,
+    also when that outcome comes from the cache
+    """
+
+    identity = get_client_identity(ec2)
+    key = (identity, ec2.meta.region_name, method_name)
+    with _dry_run_lock:
+        entry = _dry_runs.get(key) if identity is not None else None
+    if entry is not None and time.monotonic() < entry[1]:
+        if entry[0] is not None:
+            # A new exception each time, so tracebacks don't pile up on one
+            response, operation_name = entry[0]
+            raise ClientError(copy.deepcopy(response), operation_name)
+        return
+
+    try:
+        getattr(ec2, method_name)(InstanceIds=instance_ids, DryRun=True)
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        if code == 'DryRunOperation':
+            error = None
+        elif code == 'UnauthorizedOperation':
+            error = e
+        else:
+            # Says nothing about permissions, e.g., an unknown instance ID
+            return
+    else:
+        error = None
+    if identity is not None:
+        with _dry_run_lock:
+            _dry_runs[key] = (None if error is None else (error.response, error.operation_name),
+                              time.monotonic() + ttl)
+    if error is not None:
+        raise error
+
+
+def clear_permission_cache():
+    with _dry_run_lock:
+        _dry_runs.clear()
 
 
 def get_ec2_description():
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
     response = ec2.describe_instances()
     print(response)
 
@@ -11,7 +85,7 @@ def get_ec2_description():
 
 
 def toggle_ec2_monitoring(instance_id, toggle='ON'):
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
     if toggle == 'ON':
         response = ec2.monitor_instances(InstanceIds=[instance_id])
     else:
@@ -21,15 +95,11 @@ def toggle_ec2_monitoring(instance_id, toggle='ON'):
 
 
 def toggle_ec2_instance(instance_id, action='ON'):
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
 
     if action == 'ON':
         # Do a dryrun first to verify permissions
-        try:
-            ec2.start_instances(InstanceIds=[instance_id], DryRun=True)
-        except ClientError as e:
-            if 'DryRunOperation' not in str(e):
-                raise
+        check_permission(ec2, 'start_instances', [instance_id])
 
         # Dry run succeeded, run start_instances without dryrun
         try:
@@ -39,11 +109,7 @@ def toggle_ec2_instance(instance_id, action='ON'):
             print(e)
     else:
         # Do a dryrun first to verify permissions
-        try:
-            ec2.stop_instances(InstanceIds=[instance_id], DryRun=True)
-        except ClientError as e:
-            if 'DryRunOperation' not in str(e):
-                raise
+        check_permission(ec2, 'stop_instances', [instance_id])
 
         # Dry run succeeded, call stop_instances without dryrun
         try:
@@ -54,14 +120,13 @@ def toggle_ec2_instance(instance_id, action='ON'):
 
 
 def reboot_instance(instance_id):
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
 
     try:
-        ec2.reboot_instances(InstanceIds=[instance_id], DryRun=True)
-    except ClientError as e:
-        if 'DryRunOperation' not in str(e):
-            print("You don't have permission to reboot instances.")
-            raise
+        check_permission(ec2, 'reboot_instances', [instance_id])
+    except ClientError:
+        print("You don't have permission to reboot instances.")
+        raise
 
     try:
         response = ec2.reboot_instances(InstanceIds=[instance_id], DryRun=False)
@@ -70,26 +135,129 @@ def reboot_instance(instance_id):
         print('Error', e)
 
 
+# Client method -> (response list, field and key holding the new state)
+INSTANCE_ACTIONS = {
+    'start_instances': ('StartingInstances', 'CurrentState', 'Name'),
+    'stop_instances': ('StoppingInstances', 'CurrentState', 'Name'),
+    'reboot_instances': (None, None, None),
+    'monitor_instances': ('InstanceMonitorings', 'Monitoring', 'State'),
+    'unmonitor_instances': ('InstanceMonitorings', 'Monitoring', 'State'),
+}
+
+
+def _run_batch(ec2, method_name, instance_ids, region_name, results, dry_run=False):
+    try:
+        if dry_run:
+            check_permission(ec2, method_name, instance_ids)
+        response = getattr(ec2, method_name)(InstanceIds=instance_ids)
+    except (BotoCoreError, ClientError) as e:
+        # One unknown or unsuitable ID fails the whole request. Halve the
+        # batch to find it, so the other instances still get the action.
+        # Anything else, e.g., throttling, fails the batch: splitting it
+        # would only send more requests.
+        if (len(instance_ids) > 1 and isinstance(e, ClientError)
+                and e.response['Error']['Code'].startswith(INSTANCE_ERRORS)):
+            middle = len(instance_ids) // 2
+            _run_batch(ec2, method_name, instance_ids[:middle], region_name, results)
+            _run_batch(ec2, method_name, instance_ids[middle:], region_name, results)
+            return
+        for instance_id in instance_ids:
+            results[instance_id] = {'region': region_name, 'state': None, 'error': str(e)}
+        return
+
+    list_name, state_field, state_key = INSTANCE_ACTIONS[method_name]
+    if list_name is None:
+        # RebootInstances returns nothing per instance
+        for instance_id in instance_ids:
+            results[instance_id] = {'region': region_name, 'state': 'rebooting', 'error': None}
+        return
+    for instance in response.get(list_name, []):
+        results[instance['InstanceId']] = {'region': region_name,
+                                           'state': instance[state_field][state_key],
+                                           'error': None}
+
+
+def run_instance_action(method_name, instance_ids, batch_size=MAX_INSTANCE_IDS, max_workers=8,
+                        dry_run=True):
+    """Run a state or monitoring action on many instances, across regions
+
+    Instance IDs are grouped into requests of batch_size. Requests for
+    different regions and batches run in parallel on shared clients. Each
+    batch is dry-run first, and the outcome cached, see check_permission.
+    A batch failing on unknown instances or instances in the wrong state is
+    split to isolate them; other errors, e.g., throttling after botocore's
+    own retries, fail the batch.
+
+    :param method_name: Client method, one of INSTANCE_ACTIONS, e.g., 'stop_instances'
+    :param instance_ids: Iterable of instance IDs in the default region, or
+    a dictionary of region name -> instance IDs
+    :param batch_size: Instance IDs per request
+    :param max_workers: Maximum number of concurrent requests
+    :param dry_run: If False, skip the dry-run permission checks. An
+    unauthorized request fails as a whole, so nothing is changed either way.
+    :return: Dictionary of instance ID -> {'region', 'state', 'error'}.
+    state is the new instance or monitoring state, error the message of a
+    failed request, else None
+    """
+
+    if not isinstance(instance_ids, dict):
+        instance_ids = {None: instance_ids}
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        batches = []
+        for region_name, ids in instance_ids.items():
+            ids = list(ids)
+            ec2 = get_client('ec2', region_name=region_name,
+                             max_pool_connections=max(max_workers, DEFAULT_MAX_POOL_CONNECTIONS))
+            batches.extend(executor.submit(_run_batch, ec2, method_name, ids[i:i + batch_size],
+                                           region_name, results, dry_run)
+                           for i in range(0, len(ids), batch_size))
+        for batch in batches:
+            batch.result()
+    return results
+
+
+def toggle_ec2_instances(instance_ids, action='ON', **kwargs):
+    """Start ('ON') or stop many instances, see run_instance_action"""
+
+    method_name = 'start_instances' if action == 'ON' else 'stop_instances'
+    return run_instance_action(method_name, instance_ids, **kwargs)
+
+
+def reboot_ec2_instances(instance_ids, **kwargs):
+    """Reboot many instances, see run_instance_action"""
+
+    return run_instance_action('reboot_instances', instance_ids, **kwargs)
+
+
+def toggle_ec2_instances_monitoring(instance_ids, toggle='ON', **kwargs):
+    """Enable ('ON') or disable detailed monitoring of many instances, see run_instance_action"""
+
+    method_name = 'monitor_instances' if toggle == 'ON' else 'unmonitor_instances'
+    return run_instance_action(method_name, instance_ids, **kwargs)
+
+
 def describe_ec2_key_pairs():
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
     response = ec2.describe_key_pairs()
     print(response)
 
 
 def create_ec2_key_pair(key_pair_name):
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
     response = ec2.create_key_pair(KeyName=key_pair_name)
     print(response)
 
 
 def delete_ec2_key_pair(key_pair_name):
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
     response = ec2.delete_key_pair(KeyName=key_pair_name)
     print(response)
 
 
 def describe_ec2_regions():
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
 
     # Retrieves all regions/endpoints that work with EC2
     response = ec2.describe_regions()
@@ -97,7 +265,7 @@ def describe_ec2_regions():
 
 
 def describe_ec2_availability_zones():
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
 
     # Retrieves availability zones only for region of the ec2 object
     response = ec2.describe_availability_zones()
@@ -105,7 +273,7 @@ def describe_ec2_availability_zones():
 
 
 def describe_security_groups(security_group_id):
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
 
     try:
         response = ec2.describe_security_groups(GroupIds=[security_group_id])
@@ -116,7 +284,7 @@ def describe_security_groups(security_group_id):
 
 
 def create_security_groups(security_group_name, description):
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
 
     response = ec2.describe_vpcs()
     vpc_id = response.get('Vpcs', [{}])[0].get('VpcId', '')
@@ -147,7 +315,7 @@ def create_security_groups(security_group_name, description):
 
 def delete_security_group(security_group_id):
     # Create EC2 client
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
 
     # Delete security group
     try:
@@ -158,7 +326,7 @@ def delete_security_group(security_group_id):
 
 
 def describe_elastic_ip_addresses():
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
 
     filters = [
         {'Name': 'domain', 'Values': ['vpc']}
@@ -172,7 +340,7 @@ def describe_elastic_ip_addresses():
 
 
 def allocate_address(allocation_id, instance_id):
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
 
     try:
         allocation = ec2.allocate_address(Domain='vpc')
@@ -186,7 +354,7 @@ def allocate_address(allocation_id, instance_id):
 
 
 def release_elastic_ip_address(allocation_id):
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
 
     try:
         response = ec2.release_address(AllocationId=allocation_id)
@@ -1,11 +1,11 @@
 import json
-import boto3
+from client_helpers import get_client
 from botocore.exceptions import ClientError
 
 
 def create_user(iam_user_name):
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # Create user
     response = iam.create_user(UserName=iam_user_name)
@@ -17,7 +17,7 @@ def create_user(iam_user_name):
 
 def list_users():
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # List users with the pagination interface
     paginator = iam.get_paginator('list_users')
@@ -28,7 +28,7 @@ def list_users():
 
 def update_user(iam_user_name, new_iam_user_name):
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # Update a user name
     iam.update_user(UserName=iam_user_name, NewUserName=new_iam_user_name)
@@ -36,7 +36,7 @@ def update_user(iam_user_name, new_iam_user_name):
 
 def delete_user(iam_user_name):
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # Delete a user
     iam.delete_user(UserName=iam_user_name)
@@ -44,7 +44,7 @@ def delete_user(iam_user_name):
 
 def create_policy(policy_name):
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # EXAMPLE - Create a policy
     my_managed_policy = {
@@ -81,7 +81,7 @@ def get_iam_policy(poilcy_arn):
     # EXAMPLE policy_arn: arn:aws:iam::aws:policy/AWSLambdaExecute
     #
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # Get a policy
     response = iam.get_policy(PolicyArn=poilcy_arn)
@@ -97,7 +97,7 @@ def attach_managed_role_to_policy(policy_arn, role_name):
     #
     # EXAMPLE role_name: AmazonDynamoDBFullAccess
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # Attach a role policy
     iam.attach_role_policy(PolicyArn=policy_arn, RoleName=role_name)
@@ -109,7 +109,7 @@ def detach_managed_role_from_policy(policy_arn, role_name):
     #
     # EXAMPLE role_name: AmazonDynamoDBFullAccess
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # Detach a role policy
     iam.detach_role_policy(PolicyArn=policy_arn, RoleName=role_name)
@@ -117,7 +117,7 @@ def detach_managed_role_from_policy(policy_arn, role_name):
 
 def create_access_key(iam_user_name):
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # Create an access key
     response = iam.create_access_key(UserName=iam_user_name)
@@ -129,7 +129,7 @@ def create_access_key(iam_user_name):
 
 def list_users_access_keys(iam_user_name):
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # List access keys through the pagination interface.
     paginator = iam.get_paginator('list_access_keys')
@@ -140,7 +140,7 @@ def list_users_access_keys(iam_user_name):
 
 def get_last_used_access_key(access_key_id):
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # Get last use of access key
     response = iam.get_access_key_last_used(AccessKeyId=access_key_id)
@@ -152,7 +152,7 @@ def get_last_used_access_key(access_key_id):
 
 def update_access_key_status(access_key_id, status, iam_user_name):
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # Update access key to be active
     iam.update_access_key(AccessKeyId=access_key_id, Status=status, UserName=iam_user_name)
@@ -160,7 +160,7 @@ def update_access_key_status(access_key_id, status, iam_user_name):
 
 def delete_access_key(access_key_id, iam_user_name):
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # Delete access key
     iam.delete_access_key(AccessKeyId=access_key_id, UserName=iam_user_name)
@@ -168,7 +168,7 @@ def delete_access_key(access_key_id, iam_user_name):
 
 def list_server_certificates():
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # List server certificates through the pagination interface
     paginator = iam.get_paginator('list_server_certificates')
@@ -179,7 +179,7 @@ def list_server_certificates():
 
 def get_server_certificate(certificate_name):
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # Get the server certificate
     response = iam.get_server_certificate(ServerCertificateName=certificate_name)
@@ -191,7 +191,7 @@ def get_server_certificate(certificate_name):
 
 def update_server_certificate(certificate_name, new_certificate_name):
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # Update the name of the server certificate
     iam.update_server_certificate(ServerCertificateName=certificate_name, NewServerCertificateName=new_certificate_name)
@@ -199,7 +199,7 @@ def update_server_certificate(certificate_name, new_certificate_name):
 
 def delete_server_certificate(certificate_name):
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # Delete the server certificate
     iam.delete_server_certificate(ServerCertificateName=certificate_name)
@@ -207,7 +207,7 @@ def delete_server_certificate(certificate_name):
 
 def create_account_alias(alias_name):
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # Create an account alias
     iam.create_account_alias(AccountAlias=alias_name)
@@ -215,7 +215,7 @@ def create_account_alias(alias_name):
 
 def list_account_aliases():
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # List account aliases through the pagination interface
     paginator = iam.get_paginator('list_account_aliases')
@@ -226,7 +226,7 @@ def list_account_aliases():
 
 def delete_account_alias(alias_name):
     # Create IAM client
-    iam = boto3.client('iam')
+    iam = get_client('iam')
 
     # Delete an account alias
     iam.delete_account_alias(AccountAlias=alias_name)
\ No newline at end of file
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import BotoCoreError, ClientError
+from client_helpers import get_client
+import s3_helpers
+
+
+class AsyncS3:
+    """asyncio front end for the S3 helpers
+
+    boto3 itself is blocking, so every call runs on a worker pool owned by
+    this object and shares one pooled S3 client. A semaphore bounds the
+    number of calls in flight; callers beyond that wait on the event loop,
+    not in a thread, so thousands of transfers can be awaited at once while
+    only max_workers threads and connections do the work.
+
+    Transfers default to use_threads=False, so each one runs entirely on
+    its worker instead of starting a thread pool of its own.
+    """
+
+    def __init__(self, max_concurrency=256, max_workers=32, region_name=None,
+                 endpoint_url=None, config=None):
+        """
+        :param max_concurrency: Maximum number of S3 calls in flight
+        :param max_workers: Number of worker threads and pooled connections
+        :param region_name: String region, e.g., 'us-west-2'
+        :param endpoint_url: Custom S3 endpoint
+        :param config: TransferConfig for uploads and downloads
+        """
+
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='async-s3')
+        self._client = get_client('s3', region_name=region_name,
+                                  endpoint_url=endpoint_url,
+                                  max_pool_connections=max_workers)
+        self._config = config if config is not None else TransferConfig(use_threads=False)
+
+    async def _call(self, fn, *args, **kwargs):
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor,
+                                              functools.partial(fn, *args, **kwargs))
+
+    async def upload_file(self, file_name, bucket_name, object_name=None):
+        """Upload a file to an S3 bucket
+
+        :return: True if file was uploaded, else False
+        """
+
+        if object_name is None:
+            object_name = file_name
+        try:
+            await self._call(self._client.upload_file, file_name, bucket_name,
+                             object_name, Config=self._config)
+        except (ClientError, S3UploadFailedError) as e:
+            logging.error(e)
+            return False
+        return True
+
+    async def upload_fileobj(self, fileobj, bucket_name, object_name):
+        await self._call(self._client.upload_fileobj, fileobj, bucket_name,
+                         object_name, Config=self._config)
+
+    async def download_file(self, file_name, bucket_name, object_name):
+        await self._call(self._client.download_file, bucket_name, object_name,
+                         file_name, Config=self._config)
+
+    async def download_fileobj(self, fileobj, bucket_name, object_name):
+        await self._call(self._client.download_fileobj, bucket_name, object_name,
+                         fileobj, Config=self._config)
+
+    async def create_presigned_url(self, bucket_name, object_name, expiration=3600):
+        # Signing one URL is a little local CPU work, usually served from the
+        # URL cache, so it does not need a worker thread
+        return s3_helpers.create_presigned_urls(bucket_name, [object_name], expiration,
+                                                s3_client=self._client)[0]
+
+    async def create_presigned_urls(self, bucket_name, object_names, expiration=3600):
+        """Sign many URLs with this object's client, on a worker thread
+
+        :return: Same list as s3_helpers.create_presigned_urls
+        """
+
+        return await self._call(s3_helpers.create_presigned_urls, bucket_name,
+                                list(object_names), expiration, s3_client=self._client)
+
+    async def get_bucket_config(self, bucket_name, config_name, ttl=300):
+        """Return one bucket config, see s3_helpers.get_bucket_configs
+
+        Shares the TTL cache of s3_helpers.get_bucket_configs.
+        """
+
+        return await self._call(s3_helpers.get_bucket_config, bucket_name, config_name,
+                                ttl, s3_client=self._client)
+
+    async def get_bucket_policy(self, bucket_name):
+        return await self.get_bucket_config(bucket_name, 'policy')
+
+    async def get_bucket_acl(self, bucket_name):
+        return await self.get_bucket_config(bucket_name, 'acl')
+
+    async def get_bucket_cors(self, bucket_name):
+        return await self.get_bucket_config(bucket_name, 'cors')
+
+    async def get_website_configuration(self, bucket_name):
+        return await self.get_bucket_config(bucket_name, 'website')
+
+    async def get_bucket_configs(self, bucket_names,
+                                 config_names=tuple(s3_helpers.BUCKET_CONFIGS), ttl=300):
+        """Fetch the configuration of many buckets concurrently
+
+        :return: Same records as s3_helpers.get_bucket_configs
+        """
+
+        records = {bucket_name: {'errors': {}} for bucket_name in bucket_names}
+        pairs = [(bucket_name, config_name)
+                 for bucket_name in records for config_name in config_names]
+        results = await asyncio.gather(
+            *(self.get_bucket_config(bucket_name, config_name, ttl)
+              for bucket_name, config_name in pairs),
+            return_exceptions=True)
+
+        for (bucket_name, config_name), result in zip(pairs, results):
+            if isinstance(result, (BotoCoreError, ClientError)):
+                logging.error(result)
+                records[bucket_name]['errors'][config_name] = str(result)
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                records[bucket_name][config_name] = result
+        return records
+
+    async def close(self):
+        # Wait for running calls without blocking the event loop
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._executor.shutdown)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
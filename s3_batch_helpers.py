@@ -0,0 +1,279 @@
+import math
+import time
+import random
+import logging
+import threading
+from urllib.parse import urlencode
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from client_helpers import get_client, DEFAULT_MAX_POOL_CONNECTIONS
+from botocore.exceptions import BotoCoreError, ClientError
+from s3_sync_helpers import BoundedExecutor
+
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+# DeleteObjects accepts at most 1000 keys per request
+MAX_DELETE_BATCH = 1000
+
+# CopyObject cannot copy objects larger than 5 GB
+MAX_COPY_OBJECT_SIZE = 5 * GB
+
+# A multipart upload has at most 10000 parts
+MAX_PARTS = 10000
+
+# HeadObject fields that CreateMultipartUpload has to be given again. CopyObject
+# keeps them on its own, a multipart copy starts from an empty object. Tags
+# are not in HeadObject and are read separately.
+COPIED_HEADERS = ('ContentType', 'Metadata', 'CacheControl', 'ContentEncoding',
+                  'ContentDisposition', 'ContentLanguage', 'Expires',
+                  'WebsiteRedirectLocation', 'StorageClass', 'ServerSideEncryption',
+                  'SSEKMSKeyId', 'BucketKeyEnabled')
+
+# Error codes in a DeleteObjects response that are worth retrying
+RETRYABLE_DELETE_ERRORS = {'InternalError', 'SlowDown', 'ServiceUnavailable',
+                           'RequestTimeout', 'OperationAborted'}
+
+
+class RateLimiter:
+    """Thread-safe token bucket limiting calls per second
+
+    :param rate: Calls allowed per second
+    :param burst: Calls that may be made back to back. If not specified, rate
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _acquire(rate_limiter):
+    if rate_limiter is not None:
+        rate_limiter.acquire()
+
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _object_identifier(key):
+    if isinstance(key, dict):
+        return key
+    return {'Key': key}
+
+
+def _failure_key(identifier):
+    # Versions of one key fail separately
+    return identifier['Key'], identifier.get('VersionId')
+
+
+def _delete_batch(s3, bucket_name, batch, max_retries, backoff, rate_limiter):
+    # Returns (number deleted, {(key, version id): error message})
+    pending = [_object_identifier(key) for key in batch]
+    failed = {}
+    retrying = {}
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+        _acquire(rate_limiter)
+        try:
+            response = s3.delete_objects(Bucket=bucket_name,
+                                         Delete={'Objects': pending, 'Quiet': True})
+        except (BotoCoreError, ClientError) as e:
+            # boto3 already retried the request itself; try the batch again
+            logging.warning(e)
+            retrying = {_failure_key(obj): str(e) for obj in pending}
+            continue
+
+        retry = []
+        retrying = {}
+        for error in response.get('Errors', []):
+            message = f"{error['Code']}: {error.get('Message', '')}"
+            if error['Code'] in RETRYABLE_DELETE_ERRORS:
+                retry.append({k: error[k] for k in ('Key', 'VersionId') if k in error})
+                retrying[_failure_key(error)] = message
+            else:
+                failed[_failure_key(error)] = message
+        if not retry:
+            break
+        pending = retry
+
+    failed.update(retrying)
+    return len(batch) - len(failed), failed
+
+
+def delete_objects(bucket_name, keys, batch_size=MAX_DELETE_BATCH, max_workers=8,
+                   max_retries=5, backoff=0.2, rate_limit=None):
+    """Delete a stream of objects with batched DeleteObjects calls
+
+    Keys are consumed lazily, so they can come straight from a lister or a
+    file. Keys that come back as retryable partial failures are sent again
+    with jittered exponential backoff.
+
+    :param bucket_name: string
+    :param keys: Iterable of key strings, or of {'Key', 'VersionId'} dictionaries
+    :param batch_size: Keys per DeleteObjects request, at most 1000
+    :param max_workers: Maximum number of concurrent DeleteObjects requests
+    :param max_retries: Number of retries for the failed keys of a batch
+    :param backoff: Base delay in seconds between retries
+    :param rate_limit: Maximum DeleteObjects requests per second. If not specified, unlimited
+    :return: Dictionary with 'deleted', the number of deleted objects, and
+    'failed', a dictionary of (key, version id) -> error message. The
+    version id is None for keys given without one
+    """
+
+    batch_size = min(batch_size, MAX_DELETE_BATCH)
+    rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+    s3 = get_client('s3', max_pool_connections=max(max_workers, DEFAULT_MAX_POOL_CONNECTIONS))
+    result = {'deleted': 0, 'failed': {}}
+    lock = threading.Lock()
+
+    def done(batch, future):
+        try:
+            deleted, failed = future.result()
+        except Exception as e:
+            logging.error(e)
+            deleted = 0
+            failed = {_failure_key(_object_identifier(key)): str(e) for key in batch}
+        with lock:
+            result['deleted'] += deleted
+            result['failed'].update(failed)
+
+    with BoundedExecutor(max_workers) as executor:
+        for batch in _batched(keys, batch_size):
+            future = executor.submit(_delete_batch, s3, bucket_name, batch,
+                                     max_retries, backoff, rate_limiter)
+            future.add_done_callback(lambda f, batch=batch: done(batch, f))
+
+    return result
+
+
+def _multipart_copy(s3, part_executor, source, dest_bucket, dest_key, head,
+                    part_size, rate_limiter):
+    size = head['ContentLength']
+    part_size = max(part_size, math.ceil(size / MAX_PARTS))
+    headers = {name: head[name] for name in COPIED_HEADERS if name in head}
+    if head.get('TagCount'):
+        _acquire(rate_limiter)
+        tags = s3.get_object_tagging(Bucket=source['Bucket'], Key=source['Key'])['TagSet']
+        headers['Tagging'] = urlencode([(tag['Key'], tag['Value']) for tag in tags])
+    _acquire(rate_limiter)
+    upload_id = s3.create_multipart_upload(Bucket=dest_bucket, Key=dest_key,
+                                           **headers)['UploadId']
+
+    def copy_part(part_number, start):
+        end = min(start + part_size, size) - 1
+        _acquire(rate_limiter)
+        response = s3.upload_part_copy(Bucket=dest_bucket, Key=dest_key,
+                                       UploadId=upload_id, PartNumber=part_number,
+                                       CopySource=source,
+                                       CopySourceRange=f'bytes={start}-{end}',
+                                       # Every part must come from the same version
+                                       CopySourceIfMatch=head['ETag'])
+        return {'PartNumber': part_number, 'ETag': response['CopyPartResult']['ETag']}
+
+    try:
+        futures = [part_executor.submit(copy_part, part_number, start)
+                   for part_number, start in enumerate(range(0, size, part_size), 1)]
+        parts = [future.result() for future in futures]
+        s3.complete_multipart_upload(Bucket=dest_bucket, Key=dest_key, UploadId=upload_id,
+                                     MultipartUpload={'Parts': parts})
+    except Exception:
+        # Don't leave an incomplete upload behind to be billed for
+        s3.abort_multipart_upload(Bucket=dest_bucket, Key=dest_key, UploadId=upload_id)
+        raise
+
+
+def _copy_one(s3, part_executor, copy, multipart_threshold, part_size, rate_limiter):
+    source_bucket, source_key, dest_bucket, dest_key = copy[:4]
+    size = copy[4] if len(copy) > 4 else None
+    source = {'Bucket': source_bucket, 'Key': source_key}
+
+    if size is not None and size < multipart_threshold:
+        head = None
+    else:
+        # A multipart copy needs the source headers, not just the size
+        _acquire(rate_limiter)
+        head = s3.head_object(Bucket=source_bucket, Key=source_key)
+        size = head['ContentLength']
+
+    if size < multipart_threshold:
+        _acquire(rate_limiter)
+        s3.copy_object(Bucket=dest_bucket, Key=dest_key, CopySource=source)
+    else:
+        _multipart_copy(s3, part_executor, source, dest_bucket, dest_key, head,
+                        part_size, rate_limiter)
+
+
+def copy_objects(copies, max_workers=16, multipart_threshold=1 * GB,
+                 part_size=256 * MB, rate_limit=None):
+    """Run server-side copies in parallel
+
+    Objects of multipart_threshold bytes or more are copied with parallel
+    UploadPartCopy calls. The data never leaves S3.
+
+    :param copies: Iterable of (source_bucket, source_key, dest_bucket,
+    dest_key) tuples. A fifth element with the object size, e.g., from a
+    listing, saves a HeadObject call per object below multipart_threshold.
+    Larger objects are always read with HeadObject to carry their
+    ContentType, Metadata, storage class, encryption settings and other
+    headers, and their tags, over to the copy. A source that changes while
+    its parts are copied fails with PreconditionFailed.
+    :param max_workers: Maximum number of concurrent objects, and of
+    concurrent part copies
+    :param multipart_threshold: Size from which multipart copy is used, at most 5 GB
+    :param part_size: Size of each copied part. Raised for objects that
+    would otherwise need more than 10000 parts
+    :param rate_limit: Maximum S3 requests per second. If not specified, unlimited
+    :return: Dictionary with 'copied', the number of copied objects, and
+    'failed', a dictionary of (source_bucket, source_key) -> error message
+    """
+
+    multipart_threshold = min(multipart_threshold, MAX_COPY_OBJECT_SIZE)
+    rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+    s3 = get_client('s3', max_pool_connections=max(2 * max_workers, DEFAULT_MAX_POOL_CONNECTIONS))
+    result = {'copied': 0, 'failed': {}}
+    lock = threading.Lock()
+
+    def done(copy, future):
+        try:
+            future.result()
+        except Exception as e:
+            logging.error(e)
+            with lock:
+                result['failed'][(copy[0], copy[1])] = str(e)
+        else:
+            with lock:
+                result['copied'] += 1
+
+    # Parts get a pool of their own so a worker waiting on its parts can
+    # never starve them of threads
+    with ThreadPoolExecutor(max_workers=max_workers) as part_executor, \
+            BoundedExecutor(max_workers) as executor:
+        for copy in copies:
+            future = executor.submit(_copy_one, s3, part_executor, copy,
+                                     multipart_threshold, part_size, rate_limiter)
+            future.add_done_callback(lambda f, copy=copy: done(copy, f))
+
+    return result
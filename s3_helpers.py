@@ -1,9 +1,22 @@
+import io
+import os
+import copy
+import time
+import uuid
+import random
+import threading
 import requests
 import logging
 import json
-import boto3
-from botocore.exceptions import ClientError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from client_helpers import get_client, get_http_session, DEFAULT_MAX_POOL_CONNECTIONS
+from botocore.exceptions import BotoCoreError, ClientError
 from boto3.s3.transfer import TransferConfig
+from s3_metrics_helpers import track_transfer
+
+
+MB = 1024 ** 2
 
 
 def create_bucket(bucket_name, region=None):
@@ -20,10 +33,10 @@ def create_bucket(bucket_name, region=None):
     # Create bucket
     try:
         if region is None:
-            s3_client = boto3.client('s3')
+            s3_client = get_client('s3')
             s3_client.create_bucket(Bucket=bucket_name)
         else:
-            s3_client = boto3.client('s3', region_name=region)
+            s3_client = get_client('s3', region_name=region)
             location = {'LocationConstraint': region}
             s3_client.create_bucket(Bucket=bucket_name,
                                     CreateBucketConfiguration=location)
@@ -34,7 +47,7 @@ def create_bucket(bucket_name, region=None):
 
 
 def list_existing_buckets():
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
     response = s3.list_buckets()
 
     # Output the bucket names
@@ -43,12 +56,13 @@ def list_existing_buckets():
         print(f'  {bucket["Name"]}')
 
 
-def upload_file(file_name, bucket, object_name=None):
+def upload_file(file_name, bucket, object_name=None, metrics=None):
     """Upload a file to an S3 bucket
 
     :param file_name: File to upload
     :param bucket: Bucket to upload to
     :param object_name: S3 object name. If not specified then file_name is used
+    :param metrics: s3_metrics_helpers.TransferMetrics to report progress to
     :return: True if file was uploaded, else False
     """
 
@@ -57,57 +71,89 @@ def upload_file(file_name, bucket, object_name=None):
         object_name = file_name
 
     # Upload the file
-    s3_client = boto3.client('s3')
+    s3_client = get_client('s3')
     try:
-        response = s3_client.upload_file(file_name, bucket, object_name)
+        with track_transfer(s3_client, metrics, 'upload', bucket, object_name,
+                            os.path.getsize(file_name)) as callback:
+            s3_client.upload_file(file_name, bucket, object_name, Callback=callback)
     except ClientError as e:
         logging.error(e)
         return False
     return True
 
 
-def upload_fileobj(file_name, bucket_name, object_name):
-    s3 = boto3.client('s3')
-    with open(file_name, "rb") as f:
-        s3.upload_fileobj(f, bucket_name, object_name)
+def upload_fileobj(file_name, bucket_name, object_name, metrics=None):
+    s3 = get_client('s3')
+    with open(file_name, "rb") as f, \
+            track_transfer(s3, metrics, 'upload', bucket_name, object_name,
+                           os.fstat(f.fileno()).st_size) as callback:
+        s3.upload_fileobj(f, bucket_name, object_name, Callback=callback)
 
 
-def download_file(file_name, bucket_name, object_name):
-    s3 = boto3.client('s3')
-    s3.download_file(bucket_name, object_name, file_name)
+def download_file(file_name, bucket_name, object_name, metrics=None):
+    s3 = get_client('s3')
+    with track_transfer(s3, metrics, 'download', bucket_name, object_name) as callback:
+        s3.download_file(bucket_name, object_name, file_name, Callback=callback)
 
 
-def download_fileobj(file_name, bucket_name, object_name):
-    s3 = boto3.client('s3')
-    with open(file_name, 'wb') as f:
-        s3.download_fileobj(bucket_name, object_name, f)
+def download_fileobj(file_name, bucket_name, object_name, metrics=None):
+    s3 = get_client('s3')
+    with open(file_name, 'wb') as f, \
+            track_transfer(s3, metrics, 'download', bucket_name, object_name) as callback:
+        s3.download_fileobj(bucket_name, object_name, f, Callback=callback)
 
 
-def upload_multipart_file(file_name, bucket_name, object_name):
+def upload_multipart_file(file_name, bucket_name, object_name, tuner=None, metrics=None):
+    # Let the tuner pick part size, threshold and concurrency
+    if tuner is not None:
+        s3 = get_client('s3', max_pool_connections=tuner.max_concurrency)
+        with track_transfer(s3, metrics, 'upload', bucket_name, object_name,
+                            os.path.getsize(file_name)) as callback:
+            tuner.upload_file(s3, file_name, bucket_name, object_name, Callback=callback)
+        return
+
     # Set the desired multipart threshold value (5GB)
     GB = 1024 ** 3
     config = TransferConfig(multipart_threshold=5*GB)
 
     # Perform the transfer
-    s3 = boto3.client('s3')
-    s3.upload_file(file_name, bucket_name, object_name, Config=config)
+    s3 = get_client('s3')
+    with track_transfer(s3, metrics, 'upload', bucket_name, object_name,
+                        os.path.getsize(file_name)) as callback:
+        s3.upload_file(file_name, bucket_name, object_name, Config=config, Callback=callback)
+
 
+def concurrent_download_file(file_name, bucket_name, object_name, tuner=None, metrics=None):
+    # Let the tuner pick part size, threshold and concurrency
+    if tuner is not None:
+        s3 = get_client('s3', max_pool_connections=tuner.max_concurrency)
+        with track_transfer(s3, metrics, 'download', bucket_name, object_name) as callback:
+            tuner.download_file(s3, file_name, bucket_name, object_name, Callback=callback)
+        return
 
-def concurrent_download_file(file_name, bucket_name, object_name):
     # To consume less downstream bandwidth, decrease the maximum concurrency
     config = TransferConfig(max_concurrency=5)
 
     # Download an S3 object
-    s3 = boto3.client('s3')
-    s3.download_file(bucket_name, object_name, file_name, Config=config)
+    s3 = get_client('s3')
+    with track_transfer(s3, metrics, 'download', bucket_name, object_name) as callback:
+        s3.download_file(bucket_name, object_name, file_name, Config=config, Callback=callback)
 
 
-def threaded_download_file(file_name, bucket_name, object_name):
+def threaded_download_file(file_name, bucket_name, object_name, tuner=None, metrics=None):
+    # Let the tuner pick part size, threshold and concurrency
+    if tuner is not None:
+        s3 = get_client('s3', max_pool_connections=tuner.max_concurrency)
+        with track_transfer(s3, metrics, 'download', bucket_name, object_name) as callback:
+            tuner.download_file(s3, file_name, bucket_name, object_name, Callback=callback)
+        return
+
     # Disable thread use/transfer concurrency
     config = TransferConfig(use_threads=True)
 
-    s3 = boto3.client('s3')
-    s3.download_file(bucket_name, object_name, file_name, Config=config)
+    s3 = get_client('s3')
+    with track_transfer(s3, metrics, 'download', bucket_name, object_name) as callback:
+        s3.download_file(bucket_name, object_name, file_name, Config=config, Callback=callback)
 
 
 def create_presigned_url(bucket_name, object_name, expiration=3600):
@@ -120,7 +166,7 @@ def create_presigned_url(bucket_name, object_name, expiration=3600):
     """
 
     # Generate a presigned URL for the S3 object
-    s3_client = boto3.client('s3')
+    s3_client = get_client('s3')
     try:
         response = s3_client.generate_presigned_url('get_object',
                                                     Params={'Bucket': bucket_name,
@@ -134,9 +180,298 @@ def create_presigned_url(bucket_name, object_name, expiration=3600):
     return response
 
 
-def download_file_from_presigned_url(url):
-    if url is not None:
-        response = requests.get(url)
+class PresignedUrlCache:
+    """Thread-safe LRU cache of presigned URLs
+
+    A URL is served from the cache only during the first part of its
+    lifetime, so every URL handed out still has at least refresh_margin of
+    its ExpiresIn left.
+    """
+
+    def __init__(self, max_size=100000, refresh_margin=0.5):
+        """
+        :param max_size: Maximum number of URLs to keep
+        :param refresh_margin: Fraction of the lifetime that must remain for a
+        cached URL to be reused
+        """
+
+        self.max_size = max_size
+        self.refresh_margin = refresh_margin
+        self._urls = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._urls.get(key)
+            if entry is None:
+                return None
+            url, reuse_until = entry
+            if time.monotonic() >= reuse_until:
+                del self._urls[key]
+                return None
+            self._urls.move_to_end(key)
+            return url
+
+    def put(self, key, url, expiration):
+        reuse_until = time.monotonic() + expiration * (1 - self.refresh_margin)
+        with self._lock:
+            self._urls[key] = (url, reuse_until)
+            self._urls.move_to_end(key)
+            while len(self._urls) > self.max_size:
+                self._urls.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._urls.clear()
+
+
+_presigned_url_cache = PresignedUrlCache()
+
+
+def create_presigned_urls(bucket_name, object_names, expiration=3600,
+                          client_method_name='get_object', cache=_presigned_url_cache,
+                          s3_client=None):
+    """Generate presigned URLs for many objects with one shared client
+
+    URLs issued earlier for the same object and expiration are reused while
+    they have enough lifetime left, so hot objects are not signed again.
+
+    :param bucket_name: string
+    :param object_names: Iterable of object names
+    :param expiration: Time in seconds for the presigned URLs to remain valid
+    :param client_method_name: S3.Client method to sign, e.g., 'get_object'
+    :param cache: PresignedUrlCache to use, or None to always sign
+    :param s3_client: Client to sign with, which determines the endpoint,
+    region and credentials of the URLs. If not specified, the default one
+    :return: List of presigned URLs in the order of object_names. An entry
+    is None if signing that object failed.
+    """
+
+    if s3_client is None:
+        s3_client = get_client('s3')
+    urls = []
+    for object_name in object_names:
+        # URLs signed by another client are for another endpoint or identity
+        key = (s3_client, client_method_name, bucket_name, object_name, expiration)
+        url = cache.get(key) if cache is not None else None
+        if url is None:
+            try:
+                url = s3_client.generate_presigned_url(client_method_name,
+                                                       Params={'Bucket': bucket_name,
+                                                               'Key': object_name},
+                                                       ExpiresIn=expiration)
+            except (BotoCoreError, ClientError) as e:
+                # E.g., a ParamValidationError for an invalid bucket name
+                logging.error(e)
+            else:
+                if cache is not None:
+                    cache.put(key, url, expiration)
+        urls.append(url)
+
+    return urls
+
+
+class _NullSink:
+    # Stands in for a destination when the body is only read and discarded
+
+    def write(self, data):
+        pass
+
+    def seek(self, offset):
+        pass
+
+    def truncate(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _stream_to(response, f, chunk_size):
+    # Returns the number of bytes written and whether the body was read to
+    # the end, so a dropped connection can be resumed from that offset
+    written = 0
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            f.write(chunk)
+            written += len(chunk)
+    except requests.RequestException as e:
+        logging.warning(f'Download interrupted after {written} bytes: {e}')
+        return written, False
+    finally:
+        response.close()
+    return written, True
+
+
+def _validator(response):
+    # What If-Range compares against: the ETag, else the modification time
+    return response.headers.get('ETag') or response.headers.get('Last-Modified')
+
+
+def _range_headers(offset, end, validator):
+    # With If-Range, a changed object comes back whole with status 200
+    # instead of as a range of the new version
+    headers = {'Range': f'bytes={offset}-{end}'}
+    if validator:
+        headers['If-Range'] = validator
+    return headers
+
+
+def _get_object_size(session, url):
+    # A presigned URL is only signed for GET, so probe with a one-byte range
+    # instead of a HEAD request. Returns (size, validator).
+    with session.get(url, headers={'Range': 'bytes=0-0'}, stream=True) as response:
+        if response.status_code == 416:
+            # An empty object has no byte 0
+            return 0, None
+        response.raise_for_status()
+        content_range = response.headers.get('Content-Range')
+        if response.status_code == 206 and content_range:
+            return int(content_range.rsplit('/', 1)[1]), _validator(response)
+        return None, None
+
+
+def _download_range(session, url, file_name, start, end, chunk_size, max_retries,
+                    backoff, validator=None):
+    offset = start
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+        try:
+            response = session.get(url, headers=_range_headers(offset, end, validator),
+                                   stream=True)
+        except requests.ConnectionError as e:
+            logging.warning(f'Range {offset}-{end} failed: {e}')
+            continue
+        response.raise_for_status()
+        if response.status_code != 206:
+            response.close()
+            raise IOError(f'Object changed while downloading range {start}-{end}')
+        with open(file_name, 'r+b') as f:
+            f.seek(offset)
+            written, completed = _stream_to(response, f, chunk_size)
+        offset += written
+        if completed:
+            return
+    raise IOError(f'Range {start}-{end} incomplete after {max_retries} retries')
+
+
+def download_file_from_presigned_url(url, destination=None, chunk_size=MB,
+                                     max_concurrency=1, resume=False, max_retries=3,
+                                     backoff=0.2):
+    """Download an object from a presigned URL without buffering it in memory
+
+    The body is streamed in chunk_size pieces over a pooled HTTP session. If
+    the connection drops, the download continues from the last byte written,
+    after a jittered exponential backoff.
+    Continued downloads send If-Range with the object's ETag, so an object
+    that changed in between is downloaded again from the start.
+
+    :param url: Presigned GET URL
+    :param destination: File name or writable file-like object. If not
+    specified, the body is read and discarded.
+    :param chunk_size: Size in bytes of each chunk read from the socket
+    :param max_concurrency: Number of parallel HTTP Range requests. Only used
+    when destination is a file name. The ranges are written to
+    destination + '.part', which replaces destination once all of them
+    arrived and is removed if any failed.
+    :param resume: If True, a partial file left by an earlier, interrupted
+    single-stream run is continued. The ETag it was started with is kept
+    next to it in destination + '.etag'; without that file, or if the object
+    has changed since, the download starts over.
+    :param max_retries: Number of times a dropped connection is resumed
+    :param backoff: Base delay in seconds between retries
+    :return: True if the object was downloaded, else False
+    """
+
+    if url is None:
+        return False
+
+    session = get_http_session(max(max_concurrency, DEFAULT_MAX_POOL_CONNECTIONS))
+    try:
+        if isinstance(destination, str) and max_concurrency > 1:
+            size, validator = _get_object_size(session, url)
+            if size is not None:
+                part_path = destination + '.part'
+                try:
+                    # Preallocate so every range can be written in place
+                    with open(part_path, 'wb') as f:
+                        f.truncate(size)
+                    part_size = max(-(-size // max_concurrency), chunk_size)
+                    ranges = [(start, min(start + part_size, size) - 1)
+                              for start in range(0, size, part_size)]
+                    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                        futures = [executor.submit(_download_range, session, url,
+                                                   part_path, start, end, chunk_size,
+                                                   max_retries, backoff, validator)
+                                   for start, end in ranges]
+                        for future in futures:
+                            future.result()
+                    os.replace(part_path, destination)
+                except BaseException:
+                    # Don't leave a file with holes behind
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                    raise
+                return True
+
+        validator = None
+        validator_path = None
+        if isinstance(destination, str):
+            validator_path = destination + '.etag'
+            offset = 0
+            if resume and os.path.exists(destination) and os.path.exists(validator_path):
+                with open(validator_path) as f:
+                    validator = f.read().strip() or None
+                if validator:
+                    offset = os.path.getsize(destination)
+            f = open(destination, 'ab' if offset else 'wb')
+        else:
+            offset = 0
+            f = destination if destination is not None else _NullSink()
+
+        try:
+            for attempt in range(max_retries + 1):
+                if attempt:
+                    time.sleep(random.uniform(0, backoff * 2 ** attempt))
+                headers = _range_headers(offset, '', validator) if offset else {}
+                try:
+                    response = session.get(url, headers=headers, stream=True)
+                except requests.ConnectionError as e:
+                    logging.warning(f'Connection failed at byte {offset}: {e}')
+                    continue
+                if response.status_code == 416:
+                    # If-Range matched, so the partial file already holds
+                    # the whole object
+                    response.close()
+                    break
+                response.raise_for_status()
+                if offset and response.status_code == 200:
+                    # The object changed or the server ignored the Range
+                    # header, start over
+                    f.seek(0)
+                    f.truncate()
+                    offset = 0
+                if response.status_code == 200:
+                    validator = _validator(response)
+                    if validator_path is not None and validator:
+                        with open(validator_path, 'w') as v:
+                            v.write(validator)
+                written, completed = _stream_to(response, f, chunk_size)
+                offset += written
+                if completed:
+                    break
+            else:
+                raise IOError(f'Download incomplete after {max_retries} retries')
+        finally:
+            if f is not destination:
+                f.close()
+        if validator_path is not None and os.path.exists(validator_path):
+            os.remove(validator_path)
+        return True
+    except (requests.RequestException, OSError) as e:
+        logging.error(e)
+        return False
 
 
 def create_presigned_url_expanded(client_method_name, method_parameters=None,
@@ -153,7 +488,7 @@ def create_presigned_url_expanded(client_method_name, method_parameters=None,
     """
 
     # Generate a presigned URL for the S3 client method
-    s3_client = boto3.client('s3')
+    s3_client = get_client('s3')
     try:
         response = s3_client.generate_presigned_url(ClientMethod=client_method_name,
                                                     Params=method_parameters,
@@ -183,7 +518,7 @@ def create_presigned_post(bucket_name, object_name,
     """
 
     # Generate a presigned S3 POST URL
-    s3_client = boto3.client('s3')
+    s3_client = get_client('s3')
     try:
         response = s3_client.generate_presigned_post(bucket_name,
                                                      object_name,
@@ -198,22 +533,122 @@ def create_presigned_post(bucket_name, object_name,
     return response
 
 
+class _MultipartFileStream:
+    """multipart/form-data body for a presigned POST, read from disk on demand
+
+    requests sends a file-like body in small blocks, so only one block of
+    the file is in memory at a time instead of the whole encoded form.
+    """
+
+    def __init__(self, fields, file_name):
+        boundary = uuid.uuid4().hex
+        head = []
+        for name, value in fields.items():
+            head.append(f'--{boundary}\r\n'
+                        f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                        f'{value}\r\n')
+        # S3 ignores every form field after the file, so it must come last
+        head.append(f'--{boundary}\r\n'
+                    f'Content-Disposition: form-data; name="file"; '
+                    f'filename="{os.path.basename(file_name)}"\r\n'
+                    f'Content-Type: application/octet-stream\r\n\r\n')
+        head = ''.join(head).encode('utf-8')
+        tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self._file = open(file_name, 'rb')
+        self._length = len(head) + os.fstat(self._file.fileno()).st_size + len(tail)
+        self._parts = [io.BytesIO(head), self._file, io.BytesIO(tail)]
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        data = b''
+        while self._parts and (size < 0 or len(data) < size):
+            chunk = self._parts[0].read(size - len(data) if size >= 0 else -1)
+            if not chunk:
+                self._parts.pop(0)
+            data += chunk
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+def _post_file(session, response, file_name, max_retries, backoff):
+    # Returns the final HTTP status code, or None if no response was received
+    status_code = None
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+        body = _MultipartFileStream(response['fields'], file_name)
+        try:
+            http_response = session.post(response['url'], data=body,
+                                         headers={'Content-Type': body.content_type})
+        except requests.RequestException as e:
+            logging.warning(f'Upload of {file_name} failed: {e}')
+            continue
+        finally:
+            body.close()
+        http_response.close()
+        status_code = http_response.status_code
+        # Retry throttling (503 SlowDown) and server errors only
+        if status_code < 500 and status_code != 429:
+            break
+    return status_code
+
+
 def upload_file_with_presigned_url(response, object_name):
     if response is None:
-        exit(1)
+        logging.error('No presigned POST to upload with')
+        return None
 
     # Demonstrate how another Python program can use the presigned URL to upload a file
-    with open(object_name, 'rb') as f:
-        files = {'file': (object_name, f)}
-        http_response = requests.post(response['url'], data=response['fields'], files=files)
+    http_response = _post_file(get_http_session(), response, object_name, 0, 0)
 
     # If successful, returns HTTP status code 204
-    logging.info(f'File upload HTTP status code: {http_response.status_code}')
+    logging.info(f'File upload HTTP status code: {http_response}')
+    return http_response
+
+
+def upload_files_with_presigned_posts(uploads, max_workers=16, max_retries=3, backoff=0.2):
+    """Upload many files, each with its own presigned POST
+
+    Bodies are streamed from disk over a pooled HTTP session. Connection
+    errors, throttling and server errors are retried with jittered
+    exponential backoff.
+
+    :param uploads: Iterable of (response, file_name) pairs, where response is
+    the dictionary returned by create_presigned_post
+    :param max_workers: Maximum number of concurrent uploads
+    :param max_retries: Number of retries per file
+    :param backoff: Base delay in seconds between retries
+    :return: List of HTTP status codes in the order of uploads. An entry is
+    None if the file could not be read or no response was received.
+    """
+
+    session = get_http_session(max(max_workers, DEFAULT_MAX_POOL_CONNECTIONS))
+
+    def upload(response, file_name):
+        if response is None:
+            logging.error(f'No presigned POST for {file_name}')
+            return None
+        try:
+            return _post_file(session, response, file_name, max_retries, backoff)
+        except OSError as e:
+            logging.error(e)
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(upload, response, file_name)
+                   for response, file_name in uploads]
+        return [future.result() for future in futures]
 
 
 def get_bucket_policy(bucket_name):
     # Retrieve the policy of the specified bucket
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
     result = s3.get_bucket_policy(Bucket=bucket_name)
     print(result['Policy'])
 
@@ -238,19 +673,21 @@ def set_bucket_policy(bucket_name):
     bucket_policy = json.dumps(bucket_policy)
 
     # Set the new policy
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
     s3.put_bucket_policy(Bucket=bucket_name, Policy=bucket_policy)
+    invalidate_bucket_configs(bucket_name, 'policy')
 
 
 def delete_bucket_policy(bucket_name):
     # Delete a bucket's policy
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
     s3.delete_bucket_policy(Bucket=bucket_name)
+    invalidate_bucket_configs(bucket_name, 'policy')
 
 
 def get_bucket_acl(bucket_name):
     # Retrieve a bucket's ACL
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
     result = s3.get_bucket_acl(Bucket=bucket_name)
     print(result)
 
@@ -259,7 +696,7 @@ def get_bucket_acl(bucket_name):
 
 def get_website_configuration(bucket_name):
     # Retrieve the website configuration
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
     result = s3.get_bucket_website(Bucket=bucket_name)
 
     return result
@@ -267,8 +704,9 @@ def get_website_configuration(bucket_name):
 
 def delete_website_configuration(bucket_name):
     # Delete the website configuration
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
     s3.delete_bucket_website(Bucket=bucket_name)
+    invalidate_bucket_configs(bucket_name, 'website')
 
 
 def get_bucket_cors(bucket_name):
@@ -280,7 +718,7 @@ def get_bucket_cors(bucket_name):
     """
 
     # Retrieve the CORS configuration
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
     try:
         response = s3.get_bucket_cors(Bucket=bucket_name)
     except ClientError as e:
@@ -306,13 +744,160 @@ def set_bucket_cors(bucket_name):
     }
 
     # Set the CORS configuration
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
     s3.put_bucket_cors(Bucket=bucket_name,
                     CORSConfiguration=cors_configuration)
 
+    invalidate_bucket_configs(bucket_name, 'cors')
+
+
+# Config name -> (client method, error code when the config is not set,
+# value for a missing config, function extracting the value from the response)
+BUCKET_CONFIGS = {
+    'policy': ('get_bucket_policy', 'NoSuchBucketPolicy', None,
+               lambda response: response['Policy']),
+    'acl': ('get_bucket_acl', None, None,
+            lambda response: {'Owner': response['Owner'], 'Grants': response['Grants']}),
+    'cors': ('get_bucket_cors', 'NoSuchCORSConfiguration', [],
+             lambda response: response['CORSRules']),
+    'website': ('get_bucket_website', 'NoSuchWebsiteConfiguration', None,
+                lambda response: {k: v for k, v in response.items()
+                                  if k != 'ResponseMetadata'}),
+}
+
+_bucket_config_cache = {}
+# (bucket name, config name) -> number of times the entry was invalidated
+_bucket_config_generations = {}
+_bucket_config_lock = threading.Lock()
+
+
+def invalidate_bucket_configs(bucket_name, *config_names):
+    """Drop cached configs of a bucket
+
+    :param bucket_name: string
+    :param config_names: Names from BUCKET_CONFIGS. If none are given, every
+    cached config of the bucket is dropped.
+    """
+
+    with _bucket_config_lock:
+        for config_name in config_names or BUCKET_CONFIGS:
+            key = (bucket_name, config_name)
+            _bucket_config_cache.pop(key, None)
+            # Fetches started before now must not cache their result
+            _bucket_config_generations[key] = _bucket_config_generations.get(key, 0) + 1
+
+
+def _cached_bucket_config(bucket_name, config_name):
+    # Returns (True, value, generation) on a cache hit, else
+    # (False, None, generation). Pass the generation to
+    # _cache_bucket_config with the fetched value.
+    key = (bucket_name, config_name)
+    with _bucket_config_lock:
+        entry = _bucket_config_cache.get(key)
+        generation = _bucket_config_generations.get(key, 0)
+    if entry is not None and entry[0] > time.monotonic():
+        # Callers may change what they get without changing the cache
+        return True, copy.deepcopy(entry[1]), generation
+    return False, None, generation
+
+
+def _cache_bucket_config(bucket_name, config_name, value, ttl, generation):
+    # Drops the value if the entry was invalidated while it was fetched
+    key = (bucket_name, config_name)
+    if ttl:
+        value = copy.deepcopy(value)
+        with _bucket_config_lock:
+            if _bucket_config_generations.get(key, 0) == generation:
+                _bucket_config_cache[key] = (time.monotonic() + ttl, value)
+
+
+def _fetch_bucket_config(s3, bucket_name, config_name):
+    method_name, missing_code, missing_value, extract = BUCKET_CONFIGS[config_name]
+    try:
+        response = getattr(s3, method_name)(Bucket=bucket_name)
+    except ClientError as e:
+        if e.response['Error']['Code'] == missing_code:
+            return missing_value
+        raise
+    return extract(response)
+
+
+def get_bucket_config(bucket_name, config_name, ttl=300, s3_client=None):
+    """Fetch one configuration of a bucket, through the get_bucket_configs cache
+
+    :param bucket_name: string
+    :param config_name: 'policy', 'acl', 'cors' or 'website'
+    :param ttl: Time in seconds to keep the fetched config. 0 disables the cache
+    :param s3_client: S3 client to fetch with. If not specified, the shared one
+    :return: The config, None if it is not set, or an empty list for 'cors'
+    :raises ClientError: If the config could not be read
+    """
+
+    hit, value, generation = _cached_bucket_config(bucket_name, config_name)
+    if hit:
+        return value
+    if s3_client is None:
+        s3_client = get_client('s3')
+    value = _fetch_bucket_config(s3_client, bucket_name, config_name)
+    _cache_bucket_config(bucket_name, config_name, value, ttl, generation)
+    return value
+
+
+def get_bucket_configs(bucket_names, config_names=tuple(BUCKET_CONFIGS),
+                       max_workers=16, ttl=300):
+    """Fetch the configuration of many buckets in parallel
+
+    Results are cached for ttl seconds, and every caller gets its own copy
+    of them. set_bucket_policy,
+    delete_bucket_policy, set_bucket_cors and delete_website_configuration
+    drop the cached entries they change.
+
+    :param bucket_names: Iterable of bucket names
+    :param config_names: Any of 'policy', 'acl', 'cors' and 'website'
+    :param max_workers: Maximum number of concurrent requests
+    :param ttl: Time in seconds to keep fetched configs. 0 disables the cache
+    :return: Dictionary of bucket name -> record with one entry per config.
+    A config that is not set is None, or an empty list for 'cors'. Configs
+    that could not be read are left out and their error message is stored
+    in the record's 'errors' dictionary.
+    """
+
+    records = {}
+    pending = []
+    for bucket_name in bucket_names:
+        record = records.setdefault(bucket_name, {'errors': {}})
+        for config_name in config_names:
+            hit, value, generation = _cached_bucket_config(bucket_name, config_name)
+            if hit:
+                record[config_name] = value
+            else:
+                pending.append((bucket_name, config_name, generation))
+
+    if not pending:
+        return records
+
+    s3 = get_client('s3', max_pool_connections=max(max_workers, DEFAULT_MAX_POOL_CONNECTIONS))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_fetch_bucket_config, s3, bucket_name, config_name):
+                   (bucket_name, config_name, generation)
+                   for bucket_name, config_name, generation in pending}
+        for future in as_completed(futures):
+            bucket_name, config_name, generation = futures[future]
+            try:
+                value = future.result()
+            except (BotoCoreError, ClientError) as e:
+                # AllAccessDisabled error == bucket not found
+                logging.error(e)
+                records[bucket_name]['errors'][config_name] = str(e)
+                continue
+            records[bucket_name][config_name] = value
+            _cache_bucket_config(bucket_name, config_name, value, ttl, generation)
+
+    return records
+
 
 def get_client_from_vpc():
-    s3_client = boto3.client(
+    s3_client = get_client(
         service_name='s3',
         endpoint_url='https://bucket.vpce-abc123-abcdefgh.s3.us-east-1.vpce.amazonaws.com'
     )
@@ -321,7 +906,7 @@ def get_client_from_vpc():
 
 
 def get_client_from_accesspoint():
-    s3_client = boto3.client(
+    s3_client = get_client(
         service_name='s3',
         endpoint_url='https://accesspoint.vpce-abc123-abcdefgh.s3.us-east-1.vpce.amazonaws.com'
     )
@@ -330,7 +915,7 @@ def get_client_from_accesspoint():
 
 
 def get_control_client_from_vpc():
-    control_client = boto3.client(
+    control_client = get_client(
         service_name='s3control',
         endpoint_url='https://control.vpce-abc123-abcdefgh.s3.us-east-1.vpce.amazonaws.com'
     )
@@ -0,0 +1,432 @@
+import os
+import mmap
+import queue
+import struct
+import threading
+import binascii
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from client_helpers import get_client, DEFAULT_MAX_POOL_CONNECTIONS
+
+
+# Index file layout, all in native byte order:
+#   header: magic, version, object count
+#   key offsets (count + 1 x uint64), sizes (count x uint64),
+#   last modified (count x float64, epoch seconds), ETag part counts
+#   (count x uint32), ETag digests (count x 16 bytes), UTF-8 key blob.
+# Every section starts on an 8-byte boundary.
+INDEX_MAGIC = b'S3IX'
+INDEX_VERSION = 1
+_HEADER = struct.Struct('=4sHxxQ')
+
+# Part count stored for ETags that are not an MD5 digest, e.g., from
+# S3-compatible stores. They are read back as None.
+_UNKNOWN_ETAG = 0xFFFFFFFF
+
+_DONE = object()
+
+
+# Character classes a split point keeps to, so a flat keyspace of, e.g.,
+# numbered keys splits into blocks of numbers rather than into ranges
+# nothing can fall in. Other characters split on all of printable ASCII.
+_SPLIT_ALPHABETS = ('0123456789', 'abcdefghijklmnopqrstuvwxyz', 'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+_PRINTABLE = ''.join(chr(c) for c in range(0x21, 0x7f))
+
+
+def _split_points(prefix, first, last, upto, count):
+    # Boundaries above last to split the rest of a range at. They are taken
+    # at the rightmost position the keys of the page just listed varied at,
+    # or further left once that character has nothing after it, so each
+    # split covers about as much as the page, then more and more.
+    varied = len(os.path.commonprefix([first, last]))
+    for position in range(min(varied, len(last) - 1), len(prefix) - 1, -1):
+        character = last[position]
+        alphabet = next((a for a in _SPLIT_ALPHABETS if character in a), _PRINTABLE)
+        points = [last[:position] + c for c in alphabet if c > character]
+        points = [point for point in points if upto is None or point < upto]
+        if points:
+            return points[:count]
+    return []
+
+
+def _put(pages, item, stop):
+    # Blocks while the consumer is behind, but gives up once it has gone away
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _iter_runs(bucket_name, prefix, delimiter, max_workers, max_depth, page_size):
+    # Yields (run, partition, objects). A run is one key range listed in
+    # order by one task, so its pages arrive sorted, and the ranges of
+    # different runs never overlap, except for the objects of the levels
+    # walked to find partitions, which have partition None.
+    s3 = get_client('s3', max_pool_connections=max(max_workers, DEFAULT_MAX_POOL_CONNECTIONS))
+    pages = queue.Queue(maxsize=max_workers * 2)
+    stop = threading.Event()
+    lock = threading.Lock()
+    max_ranges = max_workers * 4
+    state = {'outstanding': 0, 'runs': 0}
+
+    def submit(executor, *task):
+        with lock:
+            state['outstanding'] += 1
+            state['runs'] += 1
+            run = state['runs']
+        executor.submit(worker, executor, run, *task)
+
+    def worker(executor, run, *task):
+        try:
+            if not stop.is_set():
+                list_range(executor, run, *task)
+        except Exception as e:
+            _put(pages, (_DONE, None, e), stop)
+        finally:
+            # Tasks are counted before the one submitting them finishes,
+            # so nothing is left once the count drops to zero
+            with lock:
+                state['outstanding'] -= 1
+                finished = not state['outstanding']
+            if finished:
+                _put(pages, (_DONE, None, None), stop)
+
+    def list_range(executor, run, partition, list_prefix, level_delimiter, depth,
+                   after, upto):
+        # Lists the keys k under list_prefix with after < k <= upto. With a
+        # delimiter, the common prefixes found become tasks of their own.
+        kwargs = {'Bucket': bucket_name, 'Prefix': list_prefix, 'MaxKeys': page_size}
+        if level_delimiter:
+            kwargs['Delimiter'] = level_delimiter
+        if after is not None:
+            kwargs['StartAfter'] = after
+
+        while not stop.is_set():
+            response = s3.list_objects_v2(**kwargs)
+            contents = response.get('Contents', [])
+            prefixes = [p['Prefix'] for p in response.get('CommonPrefixes', [])]
+            listed = [obj['Key'] for obj in contents[:1] + contents[-1:]] + prefixes
+            done = not response.get('IsTruncated')
+            if upto is not None:
+                kept = [obj for obj in contents if obj['Key'] <= upto]
+                kept_prefixes = [p for p in prefixes if p <= upto]
+                done = done or len(kept) < len(contents) or len(kept_prefixes) < len(prefixes)
+                contents, prefixes = kept, kept_prefixes
+            if after is not None:
+                # A common prefix straddling the start of the range is
+                # listed by the range before it
+                prefixes = [p for p in prefixes if p > after]
+
+            if contents and not _put(pages, (run, partition, contents), stop):
+                return
+            for common_prefix in prefixes:
+                if depth + 1 < max_depth:
+                    submit(executor, None, common_prefix, level_delimiter, depth + 1,
+                           None, None)
+                else:
+                    submit(executor, common_prefix, common_prefix, None, depth + 1,
+                           None, None)
+            if done:
+                return
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+            # Hand the rest of the range beyond the next split points to
+            # new tasks while there are workers to run them
+            with lock:
+                room = max_ranges - state['outstanding']
+            if room > 0 and listed:
+                points = _split_points(list_prefix, min(listed), max(listed), upto, room)
+                for lower, upper in zip(points, points[1:] + [upto]):
+                    submit(executor, partition, list_prefix, level_delimiter, depth,
+                           lower, upper)
+                if points:
+                    upto = points[0]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if delimiter and max_depth > 0:
+            submit(executor, None, prefix, delimiter, 0, None, None)
+        else:
+            submit(executor, prefix, prefix, None, 0, None, None)
+        try:
+            while True:
+                run, partition, contents = pages.get()
+                if run is _DONE:
+                    if contents is not None:
+                        raise contents
+                    return
+                yield run, partition, contents
+        finally:
+            # Unblock workers if the caller stopped early or a range failed
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_object_pages(bucket_name, prefix='', delimiter='/', max_workers=16,
+                      max_depth=2, page_size=1000):
+    """List a bucket prefix with parallel ListObjectsV2 calls
+
+    The keyspace is split on the delimiter into common prefixes, which are
+    then listed in parallel. While there are idle workers, a range still
+    being listed is split further at StartAfter keys, so flat keyspaces
+    without common prefixes are listed in parallel too. Pages are yielded
+    as soon as they arrive, so pages of different ranges are interleaved.
+
+    :param bucket_name: string
+    :param prefix: Only list keys starting with this prefix
+    :param delimiter: Delimiter used to split the keyspace
+    :param max_workers: Maximum number of concurrent ListObjectsV2 calls
+    :param max_depth: Maximum number of delimiter levels walked to find partitions
+    :param page_size: Keys per ListObjectsV2 page, up to 1000
+    :return: Generator of (partition, objects) tuples. partition is the
+    common prefix the page belongs to, or None for objects found while
+    partitioning. objects is the page's list of object dictionaries.
+    """
+
+    for _, partition, objects in _iter_runs(bucket_name, prefix, delimiter, max_workers,
+                                            max_depth, page_size):
+        yield partition, objects
+
+
+def list_objects(bucket_name, prefix='', delimiter='/', max_workers=16, max_depth=2,
+                 page_size=1000):
+    """Stream every object under a prefix using parallel partitioned listing
+
+    Objects are yielded in no particular order. See iter_object_pages for
+    the parameters.
+
+    :return: Generator of object dictionaries with Key, Size, ETag and
+    LastModified
+    """
+
+    for _, objects in iter_object_pages(bucket_name, prefix, delimiter,
+                                        max_workers, max_depth, page_size):
+        yield from objects
+
+
+class _Columns:
+    # Column-wise storage for one partition, far smaller than a list of dicts
+
+    def __init__(self):
+        self.key_offsets = array('Q')
+        self.keys = bytearray()
+        self.sizes = array('Q')
+        self.last_modified = array('d')
+        self.etag_parts = array('I')
+        self.etag_digests = bytearray()
+
+    def append(self, obj):
+        self.key_offsets.append(len(self.keys))
+        self.keys += obj['Key'].encode('utf-8')
+        self.sizes.append(obj['Size'])
+        self.last_modified.append(obj['LastModified'].timestamp())
+        digest, parts = _pack_etag(obj.get('ETag'))
+        self.etag_parts.append(parts)
+        self.etag_digests += digest
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def key_start(self, i):
+        # Offset of the i-th key in keys, or the end of keys for i == len(self)
+        return self.key_offsets[i] if i < len(self) else len(self.keys)
+
+    def key(self, i):
+        return bytes(self.keys[self.key_start(i):self.key_start(i + 1)])
+
+    def sorted(self):
+        # Copy sorted by key, for objects collected from several listings
+        result = _Columns()
+        for i in sorted(range(len(self)), key=self.key):
+            result.key_offsets.append(len(result.keys))
+            result.keys += self.key(i)
+            result.sizes.append(self.sizes[i])
+            result.last_modified.append(self.last_modified[i])
+            result.etag_parts.append(self.etag_parts[i])
+            result.etag_digests += self.etag_digests[i * 16:i * 16 + 16]
+        return result
+
+
+def _pack_etag(etag):
+    etag = (etag or '').strip('"')
+    digest, _, parts = etag.partition('-')
+    try:
+        digest = binascii.unhexlify(digest)
+        parts = int(parts) if parts else 0
+    except ValueError:
+        return bytes(16), _UNKNOWN_ETAG
+    if len(digest) != 16 or parts >= _UNKNOWN_ETAG:
+        return bytes(16), _UNKNOWN_ETAG
+    return digest, parts
+
+
+def _unpack_etag(digest, parts):
+    if parts == _UNKNOWN_ETAG:
+        return None
+    etag = binascii.hexlify(digest).decode('ascii')
+    if parts:
+        etag += f'-{parts}'
+    return f'"{etag}"'
+
+
+def _pad(f):
+    f.write(bytes(-f.tell() % 8))
+
+
+def build_index(bucket_name, index_path, prefix='', delimiter='/', max_workers=16,
+                max_depth=2, page_size=1000):
+    """List a prefix in parallel and write a compact, sorted object index
+
+    See iter_object_pages for the listing parameters.
+
+    :param bucket_name: string
+    :param index_path: File to write the index to
+    :return: Number of objects in the index
+    """
+
+    # Each run is listed in key order and runs cover disjoint key ranges,
+    # so sorting the runs by their first key sorts everything but the
+    # objects found while partitioning. Those are sorted on their own and
+    # fall between the runs, never inside one.
+    runs = {}
+    level = _Columns()
+    for run, partition, objects in _iter_runs(bucket_name, prefix, delimiter, max_workers,
+                                              max_depth, page_size):
+        columns = level if partition is None else runs.get(run)
+        if columns is None:
+            columns = runs[run] = _Columns()
+        for obj in objects:
+            columns.append(obj)
+
+    level = level.sorted()
+    level_keys = [level.key(i) for i in range(len(level))]
+    segments = []
+    position = 0
+    for first_key, columns in sorted((columns.key(0), columns) for columns in runs.values()):
+        end = bisect_left(level_keys, first_key)
+        segments.append((level, position, end))
+        segments.append((columns, 0, len(columns)))
+        position = end
+    segments.append((level, position, len(level)))
+    segments = [(columns, i, j) for columns, i, j in segments if i < j]
+    count = sum(j - i for _, i, j in segments)
+
+    with open(index_path, 'wb') as f:
+        f.write(_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, count))
+        _pad(f)
+        base = 0
+        for columns, i, j in segments:
+            start = columns.key_start(i)
+            array('Q', (base + offset - start for offset in columns.key_offsets[i:j])).tofile(f)
+            base += columns.key_start(j) - start
+        array('Q', [base]).tofile(f)
+        for name in ('sizes', 'last_modified', 'etag_parts'):
+            for columns, i, j in segments:
+                getattr(columns, name)[i:j].tofile(f)
+            _pad(f)
+        for columns, i, j in segments:
+            f.write(memoryview(columns.etag_digests)[i * 16:j * 16])
+        for columns, i, j in segments:
+            f.write(memoryview(columns.keys)[columns.key_start(i):columns.key_start(j)])
+
+    return count
+
+
+class ObjectIndex:
+    """Read-only, memory-mapped view of an index written by build_index
+
+    Entries are sorted by key, so lookups are binary searches over the
+    mapped file and nothing is loaded into memory up front.
+    """
+
+    def __init__(self, index_path):
+        with open(index_path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count = _HEADER.unpack_from(self._mmap)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            self._mmap.close()
+            raise ValueError(f'{index_path} is not an object index')
+
+        view = self._view = memoryview(self._mmap)
+        offset = -(-_HEADER.size // 8) * 8
+
+        def section(length, fmt=None):
+            nonlocal offset
+            data = view[offset:offset + length]
+            offset += length + (-length % 8)
+            return data.cast(fmt) if fmt else data
+
+        self._count = count
+        self._key_offsets = section((count + 1) * 8, 'Q')
+        self._sizes = section(count * 8, 'Q')
+        self._last_modified = section(count * 8, 'd')
+        self._etag_parts = section(count * 4, 'I')
+        digest_start = offset
+        self._etag_digests = view[digest_start:digest_start + count * 16]
+        keys_start = digest_start + count * 16
+        self._keys = view[keys_start:keys_start + self._key_offsets[count]]
+
+    def __len__(self):
+        return self._count
+
+    def _key_bytes(self, i):
+        return self._keys[self._key_offsets[i]:self._key_offsets[i + 1]]
+
+    def key(self, i):
+        return bytes(self._key_bytes(i)).decode('utf-8')
+
+    def __getitem__(self, i):
+        """Return (key, size, etag, last_modified) of the i-th entry"""
+
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        etag = _unpack_etag(bytes(self._etag_digests[i * 16:i * 16 + 16]),
+                            self._etag_parts[i])
+        return self.key(i), self._sizes[i], etag, self._last_modified[i]
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self[i]
+
+    def find(self, key):
+        """Return the position of key, or -1 if it is not in the index"""
+
+        target = key.encode('utf-8')
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(self._key_bytes(mid)) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._key_bytes(lo) == target:
+            return lo
+        return -1
+
+    def get(self, key):
+        """Return (key, size, etag, last_modified) for key, or None"""
+
+        i = self.find(key)
+        return self[i] if i >= 0 else None
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def close(self):
+        # Release the views first, mmap refuses to close while they exist
+        for name in ('_key_offsets', '_sizes', '_last_modified', '_etag_parts',
+                     '_etag_digests', '_keys', '_view'):
+            getattr(self, name).release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
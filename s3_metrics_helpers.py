@@ -0,0 +1,409 @@
+import math
+import time
+import heapq
+import threading
+import contextlib
+
+
+# Operations whose latency is tracked per request. For GetObject the
+# latency ends when the response headers arrive, not when the body is read.
+TRACKED_OPERATIONS = ('PutObject', 'UploadPart', 'UploadPartCopy', 'GetObject',
+                      'CreateMultipartUpload', 'CompleteMultipartUpload', 'HeadObject')
+
+# Latency histograms use one bucket per power of two of microseconds
+_LATENCY_BUCKETS = 32
+
+
+class _Histogram:
+    # Fixed-size log2 histogram. Recording is O(1) and nothing is kept per
+    # sample, so it can run on every request of a busy process.
+
+    def __init__(self):
+        self.buckets = [0] * _LATENCY_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        micros = int(seconds * 1e6)
+        self.buckets[min(micros.bit_length(), _LATENCY_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the requested sample
+        rank = math.ceil(fraction * self.count)
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min((1 << i) / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count,
+                'mean_ms': self.total / self.count * 1000,
+                'p50_ms': self.percentile(0.5) * 1000,
+                'p99_ms': self.percentile(0.99) * 1000,
+                'max_ms': self.max * 1000}
+
+
+class TransferProgress:
+    """boto3 transfer Callback that tracks one transfer
+
+    boto3 calls it from its worker threads with the number of bytes moved
+    since the last call. Negative amounts mean a request was retried and
+    its bytes are sent again.
+    """
+
+    def __init__(self, metrics, direction, bucket_name, object_name, size=None,
+                 interval=1.0):
+        """
+        :param metrics: TransferMetrics to report to
+        :param direction: 'upload' or 'download'
+        :param size: Expected object size in bytes, if known
+        :param interval: Minimum seconds between progress reports
+        """
+
+        self.metrics = metrics
+        self.direction = direction
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.size = size
+        self.interval = interval
+        self.bytes = 0
+        self.retried_bytes = 0
+        self.retries = 0
+        self.instant_rate = 0.0
+        self.started = time.perf_counter()
+        self.finished = None
+        self.error = None
+
+        self._lock = threading.Lock()
+        self._window_start = self.started
+        self._window_bytes = 0
+
+    def __call__(self, bytes_amount):
+        report = False
+        with self._lock:
+            if bytes_amount < 0:
+                self.retried_bytes -= bytes_amount
+                self.retries += 1
+            self.bytes += bytes_amount
+            self._window_bytes += bytes_amount
+            now = time.perf_counter()
+            if now - self._window_start >= self.interval:
+                self.instant_rate = self._window_bytes / (now - self._window_start)
+                self._window_start = now
+                self._window_bytes = 0
+                report = True
+        if report:
+            self.metrics.transfer_progress(self)
+
+    @property
+    def seconds(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def average_rate(self):
+        """Average throughput since the start in bytes/s"""
+        seconds = self.seconds
+        return self.bytes / seconds if seconds > 0 else 0.0
+
+    def finish(self, error=None):
+        self.finished = time.perf_counter()
+        self.error = error
+        self.metrics.transfer_finished(self)
+
+
+class TransferMetrics:
+    """In-process aggregator for S3 transfer and request figures
+
+    One instance is meant to be shared by every transfer in a process.
+    Counters live under a single lock and latencies go into fixed-size
+    histograms, so the overhead per request is a few additions. Subclass
+    and override transfer_started, transfer_progress or transfer_finished
+    to forward the figures elsewhere, e.g., to a log or a metrics agent.
+    """
+
+    def __init__(self, slowest=10):
+        """
+        :param slowest: Number of slowest finished transfers to keep
+        """
+
+        self._lock = threading.Lock()
+        self._slowest_count = slowest
+        self._in_flight = 0
+        self.reset()
+
+    def reset(self):
+        # Requests in flight are left alone, they still have to finish
+        with self._lock:
+            self._latencies = {}
+            self._slowest = []
+            self._active = set()
+            self._transfers = 0
+            self._failed = 0
+            self._bytes = 0
+            self._seconds = 0.0
+            self._transfer_retries = 0
+            self._requests = 0
+            self._request_errors = 0
+            self._request_retries = 0
+            self._max_in_flight = self._in_flight
+
+    def start_transfer(self, direction, bucket_name, object_name, size=None, interval=1.0):
+        """Return a TransferProgress to pass as the Callback of a transfer"""
+
+        progress = TransferProgress(self, direction, bucket_name, object_name, size, interval)
+        self.transfer_started(progress)
+        return progress
+
+    def transfer_started(self, progress):
+        with self._lock:
+            self._active.add(progress)
+
+    def transfer_progress(self, progress):
+        # Called at most every progress.interval seconds per transfer
+        pass
+
+    def transfer_finished(self, progress):
+        with self._lock:
+            self._active.discard(progress)
+            self._transfers += 1
+            self._transfer_retries += progress.retries
+            if progress.error is not None:
+                self._failed += 1
+                return
+            self._bytes += progress.bytes
+            self._seconds += progress.seconds
+            if not self._slowest_count or not progress.bytes:
+                return
+            # Min-heap on throughput negated, so the fastest of the kept
+            # transfers is the one pushed out
+            record = (-progress.average_rate, id(progress), {
+                'direction': progress.direction,
+                'bucket': progress.bucket_name,
+                'key': progress.object_name,
+                'bytes': progress.bytes,
+                'seconds': progress.seconds,
+                'mb_per_s': progress.average_rate / 1024 ** 2,
+                'retries': progress.retries,
+            })
+            if len(self._slowest) < self._slowest_count:
+                heapq.heappush(self._slowest, record)
+            else:
+                heapq.heappushpop(self._slowest, record)
+
+    def request_started(self, operation_name):
+        with self._lock:
+            self._in_flight += 1
+            self._max_in_flight = max(self._max_in_flight, self._in_flight)
+
+    def request_finished(self, operation_name, seconds, retries=0, error=False):
+        with self._lock:
+            self._in_flight -= 1
+            self._requests += 1
+            self._request_retries += retries
+            if error:
+                self._request_errors += 1
+            histogram = self._latencies.get(operation_name)
+            if histogram is None:
+                histogram = self._latencies[operation_name] = _Histogram()
+            histogram.add(seconds)
+
+    def snapshot(self):
+        """Return the figures collected so far
+
+        :return: Dictionary of transfer counts and bytes, the average
+        throughput of finished transfers, the progress of active ones,
+        request counts, retries, the current and highest number of requests
+        in flight, latencies per operation and the slowest transfers
+        """
+
+        with self._lock:
+            active = [{'direction': p.direction, 'bucket': p.bucket_name,
+                       'key': p.object_name, 'bytes': p.bytes, 'size': p.size,
+                       'mb_per_s': p.instant_rate / 1024 ** 2,
+                       'average_mb_per_s': p.average_rate / 1024 ** 2}
+                      for p in self._active]
+            return {
+                'transfers': self._transfers,
+                'failed': self._failed,
+                'bytes': self._bytes,
+                'mb_per_s': self._bytes / self._seconds / 1024 ** 2 if self._seconds else 0.0,
+                'transfer_retries': self._transfer_retries,
+                'active': active,
+                'requests': self._requests,
+                'request_errors': self._request_errors,
+                'request_retries': self._request_retries,
+                'in_flight': self._in_flight,
+                'max_in_flight': self._max_in_flight,
+                'latencies': {name: histogram.summary()
+                              for name, histogram in self._latencies.items()},
+                'slowest': [record for _, _, record in sorted(self._slowest, reverse=True)],
+            }
+
+
+# (id(client), id(metrics)) -> [count, client, metrics, operations]. The
+# references keep both ids from being reused while they are registered.
+_registrations = {}
+# id(client) -> tuple of (metrics, operations) to report to. Replaced, never
+# changed in place, so the handlers can read it without the lock.
+_active = {}
+_registrations_lock = threading.Lock()
+
+_CONTEXT_KEY = 's3_metrics'
+
+
+def _register_dispatcher(s3):
+    # One set of handlers per client, registered once and left in place.
+    # A request reports to the metrics active when it started, so removing
+    # metrics mid-request never leaves their in-flight count behind.
+    client_key = id(s3)
+
+    def before_call(model, context, **kwargs):
+        active = _active.get(client_key)
+        if not active:
+            return
+        targets = [metrics for metrics, operations in active if model.name in operations]
+        if targets:
+            context[_CONTEXT_KEY] = (time.perf_counter(), targets)
+            for metrics in targets:
+                metrics.request_started(model.name)
+
+    def after_call(model, parsed, context, **kwargs):
+        started = context.pop(_CONTEXT_KEY, None)
+        if started is not None:
+            start, targets = started
+            retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            for metrics in targets:
+                metrics.request_finished(model.name, time.perf_counter() - start, retries,
+                                         error='Error' in parsed)
+
+    def after_call_error(context, event_name, **kwargs):
+        started = context.pop(_CONTEXT_KEY, None)
+        if started is not None:
+            start, targets = started
+            for metrics in targets:
+                metrics.request_finished(event_name.rsplit('.', 1)[-1],
+                                         time.perf_counter() - start, error=True)
+
+    events = s3.meta.events
+    events.register('before-call.s3', before_call, unique_id='s3-metrics-before')
+    events.register('after-call.s3', after_call, unique_id='s3-metrics-after')
+    events.register('after-call-error.s3', after_call_error, unique_id='s3-metrics-error')
+
+
+def _update_active(s3):
+    # Callers hold _registrations_lock
+    active = tuple((metrics, operations)
+                   for (client_key, _), (_, _, metrics, operations) in _registrations.items()
+                   if client_key == id(s3))
+    if active:
+        _active[id(s3)] = active
+    else:
+        _active.pop(id(s3), None)
+
+
+def instrument_client(s3, metrics, operations=TRACKED_OPERATIONS):
+    """Report the latency, retries and concurrency of S3 requests to metrics
+
+    Handlers are registered on the client's event system, so every call made
+    through the client is measured, including the part requests boto3's
+    transfer manager makes on its own threads. Clients from
+    client_helpers.get_client are shared, so requests made by other callers
+    at the same time are counted too. Every call must be matched by one to
+    uninstrument_client; the instrumented context manager does both.
+
+    :param s3: S3 client, e.g., from client_helpers.get_client
+    :param metrics: TransferMetrics
+    :param operations: Names of the operations to measure
+    :return: s3
+    """
+
+    _register_dispatcher(s3)
+    key = (id(s3), id(metrics))
+    with _registrations_lock:
+        registration = _registrations.get(key)
+        if registration is not None:
+            registration[0] += 1
+            return s3
+        _registrations[key] = [1, s3, metrics, frozenset(operations)]
+        _update_active(s3)
+    return s3
+
+
+def uninstrument_client(s3, metrics):
+    """Stop reporting requests made through s3 to metrics
+
+    Undoes one call to instrument_client. Requests already in flight still
+    report to metrics when they finish.
+    """
+
+    key = (id(s3), id(metrics))
+    with _registrations_lock:
+        registration = _registrations.get(key)
+        if registration is None:
+            return
+        registration[0] -= 1
+        if registration[0]:
+            return
+        del _registrations[key]
+        _update_active(s3)
+
+
+@contextlib.contextmanager
+def instrumented(s3, metrics, operations=TRACKED_OPERATIONS):
+    """Context manager reporting the requests made through s3 to metrics
+
+    :return: Context manager giving s3
+    """
+
+    instrument_client(s3, metrics, operations)
+    try:
+        yield s3
+    finally:
+        uninstrument_client(s3, metrics)
+
+
+@contextlib.contextmanager
+def track_transfer(s3, metrics, direction, bucket_name, object_name, size=None):
+    """Track one transfer made through s3
+
+    The client is instrumented for as long as the transfer runs.
+
+    :param metrics: TransferMetrics. If None, nothing is tracked
+    :return: Context manager giving the Callback to pass to the transfer,
+    None if metrics is None
+    """
+
+    if metrics is None:
+        yield None
+        return
+    with instrumented(s3, metrics):
+        progress = metrics.start_transfer(direction, bucket_name, object_name, size)
+        try:
+            yield progress
+        except Exception as e:
+            progress.finish(e)
+            raise
+        progress.finish()
+
+
+_default_metrics = None
+_default_metrics_lock = threading.Lock()
+
+
+def get_default_metrics():
+    """Return the process-wide TransferMetrics, creating it on first use"""
+
+    global _default_metrics
+
+    with _default_metrics_lock:
+        if _default_metrics is None:
+            _default_metrics = TransferMetrics()
+    return _default_metrics
@@ -0,0 +1,298 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from client_helpers import get_client, DEFAULT_MAX_POOL_CONNECTIONS
+from boto3.exceptions import Boto3Error
+from botocore.exceptions import BotoCoreError, ClientError
+
+
+MB = 1024 ** 2
+
+# Objects below this size are sent with a single PutObject/GetObject call.
+# For them per-request latency dominates, and the managed transfer only
+# adds the overhead of setting up its own thread pool per file.
+SMALL_OBJECT_THRESHOLD = 8 * MB
+
+MANIFEST_NAME = '.s3sync-manifest.json'
+
+
+def _sync_client(max_workers):
+    # One pooled connection per worker so no thread waits for a socket
+    return get_client('s3', max_pool_connections=max(max_workers, DEFAULT_MAX_POOL_CONNECTIONS))
+
+
+def load_manifest(manifest_path):
+    """Load a sync manifest
+
+    :param manifest_path: Path of the JSON manifest
+    :return: Dictionary of relative path -> {'size', 'mtime', 'etag'} and,
+    for uploads compared by content, 'md5'. Empty
+    if the manifest does not exist or cannot be parsed.
+    """
+
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logging.error(f'Ignoring unreadable manifest {manifest_path}: {e}')
+        return {}
+
+
+def save_manifest(manifest_path, manifest):
+    # Write to a temporary file first so an interrupted run never leaves
+    # a truncated manifest behind
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.replace(tmp_path, manifest_path)
+
+
+class BoundedExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor whose submit() blocks once enough work is queued
+
+    Feeding it from a walk or listing of millions of entries does not hold
+    a future for every one of them, as long as the caller does not keep
+    the futures either: record results from a done callback instead.
+    """
+
+    def __init__(self, max_workers):
+        super().__init__(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_workers * 4)
+
+    def submit(self, fn, *args, **kwargs):
+        self._slots.acquire()
+        try:
+            future = super().submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+
+def _recorder(name, succeeded, failed, lock):
+    # Done callback that records the outcome of one transfer, so no future
+    # has to be kept until the end of the run
+    def record(future):
+        try:
+            future.result()
+        except (Boto3Error, BotoCoreError, ClientError, OSError) as e:
+            logging.error(e)
+            with lock:
+                failed[name] = str(e)
+        except Exception as e:
+            # Anything else still must not be lost with the future
+            logging.exception(e)
+            with lock:
+                failed[name] = f'{type(e).__name__}: {e}'
+        else:
+            with lock:
+                succeeded.append(name)
+    return record
+
+
+def _file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(MB), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _walk_directory(local_dir, manifest_path):
+    for root, dirs, files in os.walk(local_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.abspath(path) in (manifest_path, manifest_path + '.tmp'):
+                continue
+            yield os.path.relpath(path, local_dir).replace(os.sep, '/'), path
+
+
+def _object_key(prefix, relative_path):
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    return prefix + relative_path
+
+
+def _upload_one(s3, path, bucket_name, key, size, small_object_threshold):
+    if size < small_object_threshold:
+        with open(path, 'rb') as f:
+            response = s3.put_object(Bucket=bucket_name, Key=key, Body=f.read())
+        return response['ETag']
+
+    s3.upload_file(path, bucket_name, key)
+    # The managed transfer does not return the ETag it got
+    return s3.head_object(Bucket=bucket_name, Key=key)['ETag']
+
+
+def sync_directory(local_dir, bucket_name, prefix='', max_workers=16,
+                   manifest_path=None, compare='mtime',
+                   small_object_threshold=SMALL_OBJECT_THRESHOLD):
+    """Upload a local directory tree to an S3 prefix in parallel
+
+    Files that match the local manifest from a previous run are skipped:
+    by size and modification time, by size only, or by the MD5 of their
+    content. A failed file is recorded and the rest of the batch continues.
+    The manifest is saved even if the run is interrupted.
+
+    :param local_dir: Directory to upload
+    :param bucket_name: Bucket to upload to
+    :param prefix: Key prefix for the uploaded objects
+    :param max_workers: Maximum number of concurrent uploads
+    :param manifest_path: Manifest file. If not specified, one is kept in local_dir
+    :param compare: 'mtime' to compare size and mtime, 'size' for size
+    only, 'md5' to hash every file and compare its content. 'md5' reads
+    each file once more, but does not reupload files that were only touched
+    :param small_object_threshold: Files below this size skip the managed transfer
+    :return: Dictionary with 'uploaded' and 'skipped' lists of relative paths
+    and 'failed', a dictionary of relative path -> error message
+    """
+
+    if compare not in ('mtime', 'size', 'md5'):
+        raise ValueError(f'Unsupported compare mode {compare}')
+    if manifest_path is None:
+        manifest_path = os.path.join(local_dir, MANIFEST_NAME)
+    manifest_path = os.path.abspath(manifest_path)
+    manifest = load_manifest(manifest_path)
+    lock = threading.Lock()
+    s3 = _sync_client(max_workers)
+    result = {'uploaded': [], 'skipped': [], 'failed': {}}
+
+    def upload(relative_path, path, stat, md5):
+        key = _object_key(prefix, relative_path)
+        etag = _upload_one(s3, path, bucket_name, key, stat.st_size,
+                           small_object_threshold)
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'etag': etag}
+        if md5 is not None:
+            entry['md5'] = md5
+        with lock:
+            manifest[relative_path] = entry
+
+    try:
+        with BoundedExecutor(max_workers) as executor:
+            for relative_path, path in _walk_directory(local_dir, manifest_path):
+                try:
+                    stat = os.stat(path)
+                    # Also kept in the manifest for the next run to compare
+                    md5 = _file_md5(path) if compare == 'md5' else None
+                except OSError as e:
+                    with lock:
+                        result['failed'][relative_path] = str(e)
+                    continue
+
+                with lock:
+                    entry = manifest.get(relative_path)
+                if entry is not None and entry['size'] == stat.st_size and (
+                        compare == 'size' or
+                        compare == 'mtime' and entry['mtime'] == stat.st_mtime or
+                        compare == 'md5' and entry.get('md5') == md5):
+                    with lock:
+                        result['skipped'].append(relative_path)
+                    continue
+
+                future = executor.submit(upload, relative_path, path, stat, md5)
+                future.add_done_callback(_recorder(relative_path, result['uploaded'],
+                                                   result['failed'], lock))
+    finally:
+        with lock:
+            save_manifest(manifest_path, manifest)
+
+    return result
+
+
+def _list_prefix(s3, bucket_name, prefix):
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+def _download_one(s3, bucket_name, key, path, size, small_object_threshold):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    if size < small_object_threshold:
+        response = s3.get_object(Bucket=bucket_name, Key=key)
+        with open(path, 'wb') as f:
+            for chunk in response['Body'].iter_chunks():
+                f.write(chunk)
+    else:
+        s3.download_file(bucket_name, key, path)
+
+
+def download_prefix(bucket_name, prefix, local_dir, max_workers=16,
+                    manifest_path=None,
+                    small_object_threshold=SMALL_OBJECT_THRESHOLD):
+    """Download every object under an S3 prefix in parallel
+
+    Objects whose ETag matches the local manifest, and whose local copy
+    still has the recorded size, are skipped. The manifest is saved even if
+    the run is interrupted.
+
+    :param bucket_name: Bucket to download from
+    :param prefix: Key prefix to download
+    :param local_dir: Destination directory. Keys are stored relative to
+    prefix; keys that would resolve outside it are recorded as failed
+    :param max_workers: Maximum number of concurrent downloads
+    :param manifest_path: Manifest file. If not specified, one is kept in local_dir
+    :param small_object_threshold: Objects below this size skip the managed transfer
+    :return: Dictionary with 'downloaded' and 'skipped' lists of keys and
+    'failed', a dictionary of key -> error message
+    """
+
+    os.makedirs(local_dir, exist_ok=True)
+    if manifest_path is None:
+        manifest_path = os.path.join(local_dir, MANIFEST_NAME)
+    manifest_path = os.path.abspath(manifest_path)
+    manifest = load_manifest(manifest_path)
+    lock = threading.Lock()
+    s3 = _sync_client(max_workers)
+    root = os.path.realpath(local_dir)
+    result = {'downloaded': [], 'skipped': [], 'failed': {}}
+
+    def download(relative_path, path, obj):
+        _download_one(s3, bucket_name, obj['Key'], path, obj['Size'],
+                      small_object_threshold)
+        stat = os.stat(path)
+        with lock:
+            manifest[relative_path] = {'size': stat.st_size,
+                                       'mtime': stat.st_mtime,
+                                       'etag': obj['ETag']}
+
+    try:
+        with BoundedExecutor(max_workers) as executor:
+            for obj in _list_prefix(s3, bucket_name, prefix):
+                key = obj['Key']
+                relative_path = key[len(prefix):].lstrip('/')
+                if not relative_path or key.endswith('/'):
+                    # Zero-byte "directory" placeholder objects
+                    continue
+                path = os.path.realpath(os.path.join(root, *relative_path.split('/')))
+                if os.path.commonpath([root, path]) != root:
+                    # Keys such as 'prefix/../../name' must not escape local_dir
+                    logging.error(f'Skipping {key}: resolves outside {local_dir}')
+                    with lock:
+                        result['failed'][key] = f'Resolves outside {local_dir}'
+                    continue
+
+                entry = manifest.get(relative_path)
+                if entry is not None and entry['etag'] == obj['ETag'] and \
+                        os.path.exists(path) and os.path.getsize(path) == obj['Size']:
+                    with lock:
+                        result['skipped'].append(key)
+                    continue
+
+                future = executor.submit(download, relative_path, path, obj)
+                future.add_done_callback(_recorder(key, result['downloaded'],
+                                                   result['failed'], lock))
+    finally:
+        with lock:
+            save_manifest(manifest_path, manifest)
+
+    return result
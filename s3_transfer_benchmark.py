@@ -0,0 +1,392 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+import client_helpers
+import s3_helpers
+from client_helpers import get_client
+from s3_transfer_helpers import TransferTuner, MB, GB
+
+
+KB = 1024
+
+
+# The fixed configs hard-coded in s3_helpers
+FIXED_CONFIGS = {
+    'upload_multipart_file': TransferConfig(multipart_threshold=5*GB),
+    'concurrent_download_file': TransferConfig(max_concurrency=5),
+    'threaded_download_file': TransferConfig(use_threads=True),
+}
+
+
+def _make_file(directory, size):
+    path = os.path.join(directory, f'bench-{size}')
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            chunk = os.urandom(min(remaining, 8 * MB))
+            f.write(chunk)
+            remaining -= len(chunk)
+    return path
+
+
+def _rate(size, seconds):
+    return size / seconds / MB
+
+
+def run(bucket_name, sizes, repeats, endpoint_url=None):
+    tuner = TransferTuner()
+    s3 = get_client('s3', endpoint_url=endpoint_url,
+                    max_pool_connections=tuner.max_concurrency)
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            path = _make_file(directory, size)
+            target = path + '.out'
+            key = f'transfer-benchmark/{size}'
+
+            for name, config in FIXED_CONFIGS.items():
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    if name == 'upload_multipart_file':
+                        s3.upload_file(path, bucket_name, key, Config=config)
+                    else:
+                        s3.download_file(bucket_name, key, target, Config=config)
+                    results.append((size, name, _rate(size, time.perf_counter() - start)))
+
+            # Warm the tuner up on this size first, as a long-running
+            # process would be, then measure
+            for _ in range(repeats):
+                tuner.upload_file(s3, path, bucket_name, key)
+            for _ in range(repeats):
+                elapsed = tuner.upload_file(s3, path, bucket_name, key)
+                results.append((size, 'tuned upload', _rate(size, elapsed)))
+            for _ in range(repeats):
+                elapsed = tuner.download_file(s3, target, bucket_name, key, size=size)
+                results.append((size, 'tuned download', _rate(size, elapsed)))
+
+            s3.delete_object(Bucket=bucket_name, Key=key)
+            os.remove(path)
+            os.remove(target)
+
+    return results, tuner
+
+
+def report(results, tuner):
+    baselines = {'tuned upload': 'upload_multipart_file',
+                 'tuned download': 'concurrent_download_file'}
+    averages = {}
+    for size, name, rate in results:
+        averages.setdefault((size, name), []).append(rate)
+
+    print(f'{"size":>10}  {"transfer":<26} {"MB/s":>9} {"speedup":>8}')
+    for (size, name), rates in averages.items():
+        rate = sum(rates) / len(rates)
+        speedup = ''
+        if name in baselines:
+            baseline = averages[(size, baselines[name])]
+            speedup = f'{rate / (sum(baseline) / len(baseline)):.2f}x'
+        print(f'{size // MB:>8}MB  {name:<26} {rate:>9.1f} {speedup:>8}')
+
+    print(f'Tuner settled on max_concurrency={tuner.concurrency}, '
+          f'{tuner.stream_rate / MB:.1f} MB/s per connection')
+
+
+def _returned_true(result):
+    return result is True
+
+
+def _returned(result):
+    # Helpers that return nothing and raise on failure
+    return True
+
+
+def _http_success(status_code):
+    return status_code is not None and 200 <= status_code < 300
+
+
+# Helper name -> (direction, function running one transfer of one object,
+# check of its return value telling whether the transfer succeeded)
+SCENARIOS = {
+    'upload_file': ('upload', lambda path, bucket, key:
+                    s3_helpers.upload_file(path, bucket, key), _returned_true),
+    'upload_fileobj': ('upload', lambda path, bucket, key:
+                       s3_helpers.upload_fileobj(path, bucket, key), _returned),
+    'upload_multipart_file': ('upload', lambda path, bucket, key:
+                              s3_helpers.upload_multipart_file(path, bucket, key), _returned),
+    'presigned_post': ('upload', lambda path, bucket, key:
+                       s3_helpers.upload_file_with_presigned_url(
+                           s3_helpers.create_presigned_post(bucket, key), path), _http_success),
+    'concurrent_download_file': ('download', lambda path, bucket, key:
+                                 s3_helpers.concurrent_download_file(path, bucket, key),
+                                 _returned),
+    'presigned_get': ('download', lambda path, bucket, key:
+                      s3_helpers.download_file_from_presigned_url(
+                          s3_helpers.create_presigned_url(bucket, key), path), _returned_true),
+}
+
+
+class _PeakMemory:
+    # Samples the resident set size in the background. ru_maxrss would only
+    # ever report the peak of the whole process, not of one scenario.
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def rss():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            import resource
+            # Linux reports kilobytes, macOS bytes
+            scale = 1 if sys.platform == 'darwin' else KB
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self.rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.rss())
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def _make_files(directory, size, count):
+    data = os.urandom(min(size, 8 * MB))
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f'src-{size}-{i}')
+        with open(path, 'wb') as f:
+            remaining = size
+            while remaining:
+                f.write(data[:remaining])
+                remaining -= min(remaining, len(data))
+        paths.append(path)
+    return paths
+
+
+def run_scenario(name, bucket_name, paths, size, concurrency, directory):
+    direction, transfer, succeeded = SCENARIOS[name]
+    keys = [f'benchmark/{size}/{i}' for i in range(len(paths))]
+    if direction == 'download':
+        targets = [os.path.join(directory, f'dst-{i}') for i in range(len(paths))]
+        # Make sure the objects exist before timing downloads, and that no
+        # earlier download is left for the resumable paths to pick up
+        for path, target, key in zip(paths, targets, keys):
+            s3_helpers.upload_file(path, bucket_name, key)
+            if os.path.exists(target):
+                os.remove(target)
+    else:
+        targets = paths
+
+    # Failed transfers are counted apart, they would pass for fast ones
+    latencies = []
+    failures = []
+
+    def one(target, key):
+        start = time.perf_counter()
+        try:
+            ok = succeeded(transfer(target, bucket_name, key))
+        except Exception as e:
+            logging.error(f'{name} {key}: {e}')
+            ok = False
+        (latencies if ok else failures).append(time.perf_counter() - start)
+
+    with _PeakMemory() as memory:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(one, target, key)
+                           for target, key in zip(targets, keys)]:
+                future.result()
+        elapsed = time.perf_counter() - start
+
+    count = len(paths)
+    transferred = len(latencies)
+    p50 = _percentile(latencies, 0.5)
+    p99 = _percentile(latencies, 0.99)
+    return {
+        'scenario': name,
+        'size': size,
+        'count': count,
+        'failed': len(failures),
+        'concurrency': concurrency,
+        'seconds': elapsed,
+        'mb_per_s': size * transferred / elapsed / MB,
+        'objects_per_s': transferred / elapsed,
+        'p50_ms': p50 * 1000 if p50 is not None else None,
+        'p99_ms': p99 * 1000 if p99 is not None else None,
+        'peak_rss_mb': memory.peak / MB,
+    }
+
+
+def _start_moto():
+    # moto is only needed when no S3-compatible endpoint is given
+    from moto.server import ThreadedMotoServer
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = ThreadedMotoServer(port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    return server, f'http://{host}:{port}'
+
+
+def _ms(value):
+    return f'{value:>7.1f}ms' if value is not None else f'{"-":>9}'
+
+
+def run_scenarios(bucket_name, sizes, counts, concurrencies, scenarios, endpoint_url):
+    # Point every helper at the stand-in. botocore reads this variable when
+    # a client is created, so cached clients have to go first.
+    os.environ['AWS_ENDPOINT_URL_S3'] = endpoint_url
+    client_helpers.clear_cache()
+    # Each managed transfer runs up to 10 threads of its own
+    client_helpers.set_max_pool_connections(10 * max(concurrencies))
+    s3_helpers.create_bucket(bucket_name)
+
+    results = []
+    for size in sizes:
+        for count in counts:
+            with tempfile.TemporaryDirectory() as directory:
+                paths = _make_files(directory, size, count)
+                for concurrency in concurrencies:
+                    for name in scenarios:
+                        result = run_scenario(name, bucket_name, paths, size,
+                                              concurrency, directory)
+                        results.append(result)
+                        print(f"{name:<26} {size // KB:>8}KB x{count:<5} c={concurrency:<3} "
+                              f"{result['mb_per_s']:>8.1f} MB/s {result['objects_per_s']:>8.1f} obj/s "
+                              f"p50 {_ms(result['p50_ms'])} p99 {_ms(result['p99_ms'])} "
+                              f"peak {result['peak_rss_mb']:>7.1f}MB failed {result['failed']}")
+    return results
+
+
+def load_results(path):
+    with open(path) as f:
+        baseline = {(r['scenario'], r['size'], r['count'], r['concurrency']): r
+                    for r in json.load(f)['results']}
+    return baseline
+
+
+def compare(results, baseline, baseline_path):
+    print(f'Compared with {baseline_path}:')
+    for result in results:
+        before = baseline.get((result['scenario'], result['size'], result['count'],
+                               result['concurrency']))
+        if before is None or not before['mb_per_s']:
+            continue
+        change = (result['mb_per_s'] / before['mb_per_s'] - 1) * 100
+        print(f"{result['scenario']:<26} {result['size'] // KB:>8}KB x{result['count']:<5} "
+              f"c={result['concurrency']:<3} {change:+7.1f}% MB/s")
+
+
+def _main_tuner(args):
+    sizes = [int(size) * MB for size in args.sizes.split(',')]
+    results, tuner = run(args.bucket, sizes, args.repeats, args.endpoint_url)
+    report(results, tuner)
+
+
+def _main_helpers(args):
+    # The stand-in accepts any credentials
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    # Read the baseline first, it may be the file about to be overwritten
+    baseline = load_results(args.compare) if args.compare else None
+
+    server = None
+    endpoint_url = args.endpoint_url
+    if endpoint_url is None:
+        server, endpoint_url = _start_moto()
+
+    try:
+        results = run_scenarios(args.bucket,
+                                [int(size) * KB for size in args.sizes.split(',')],
+                                [int(count) for count in args.counts.split(',')],
+                                [int(c) for c in args.concurrency.split(',')],
+                                args.scenarios.split(','),
+                                endpoint_url)
+    finally:
+        if server is not None:
+            server.stop()
+
+    with open(args.output, 'w') as f:
+        json.dump({'timestamp': time.time(),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'endpoint_url': endpoint_url,
+                   'results': results}, f, indent=2)
+
+    if baseline is not None:
+        compare(results, baseline, args.compare)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark S3 transfers')
+    commands = parser.add_subparsers(dest='command')
+
+    tuner = commands.add_parser(
+        'tuner', help='Compare the fixed TransferConfigs in s3_helpers with TransferTuner')
+    tuner.add_argument('bucket', help='Scratch bucket to upload to and download from')
+    tuner.add_argument('--endpoint-url', help='S3-compatible endpoint, e.g., a local stand-in')
+    tuner.add_argument('--sizes', default='8,64,256,1024',
+                       help='Comma-separated object sizes in MB')
+    tuner.add_argument('--repeats', type=int, default=3)
+    tuner.set_defaults(run=_main_tuner)
+
+    helpers = commands.add_parser(
+        'helpers', help='Benchmark the s3_helpers transfer paths against a local S3 stand-in')
+    helpers.add_argument('--endpoint-url',
+                         help='S3-compatible endpoint. If not specified, a moto server is started')
+    helpers.add_argument('--bucket', default='s3-helpers-benchmark')
+    helpers.add_argument('--sizes', default='4,256,8192,65536',
+                         help='Comma-separated object sizes in KB')
+    helpers.add_argument('--counts', default='32', help='Comma-separated object counts')
+    helpers.add_argument('--concurrency', default='1,8,32',
+                         help='Comma-separated numbers of concurrent transfers')
+    helpers.add_argument('--scenarios', default=','.join(SCENARIOS))
+    helpers.add_argument('--output', default='s3_transfer_benchmark.json',
+                         help='File to write the results to as JSON')
+    helpers.add_argument('--compare', help='Earlier results file to compare against')
+    helpers.set_defaults(run=_main_helpers)
+
+    if argv is None:
+        argv = sys.argv[1:]
+    # Earlier versions only had the tuner comparison: BUCKET [options]
+    if argv and argv[0] not in ('tuner', 'helpers', '-h', '--help'):
+        argv = ['tuner'] + list(argv)
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error('a command is required')
+    args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
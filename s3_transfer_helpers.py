@@ -0,0 +1,569 @@
+import os
+import zlib
+import mmap
+import time
+import base64
+import hashlib
+import logging
+import binascii
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from client_helpers import get_client, DEFAULT_MAX_POOL_CONNECTIONS
+
+try:
+    from awscrt import checksums as crt_checksums
+except ImportError:
+    # Only needed for CRC32C checksums
+    crt_checksums = None
+
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+# Smallest part size the tuner picks, and the default part size. S3 accepts
+# parts down to 5 MB, but smaller parts only cost more requests.
+MIN_PART_SIZE = 8 * MB
+
+# S3 multipart limits
+MAX_PART_SIZE = 5 * GB
+MAX_PARTS = 10000
+
+# Parts sent at once when neither the caller nor a tuner says otherwise
+DEFAULT_MAX_CONCURRENCY = 10
+
+
+class TransferTuner:
+    """Pick TransferConfig settings from the object size and measured throughput
+
+    A tuner is meant to be shared by every transfer in a process. After each
+    multipart transfer it records the throughput that was reached and nudges
+    the concurrency up while that keeps paying off and back down once it no
+    longer does. Part size follows from the per-connection throughput, so
+    each part takes roughly target_part_seconds to send.
+
+    boto3 fixes the TransferConfig when a transfer starts, so adjustments
+    take effect on the next transfer, not on parts already in flight.
+    """
+
+    def __init__(self, initial_concurrency=10, min_concurrency=2,
+                 max_concurrency=64, target_part_seconds=2.0,
+                 initial_stream_rate=16 * MB, step=1.25, smoothing=0.3):
+        """
+        :param initial_concurrency: Concurrency used before anything is measured
+        :param min_concurrency: Lower bound for max_concurrency
+        :param max_concurrency: Upper bound for max_concurrency
+        :param target_part_seconds: Time each part should take on one connection
+        :param initial_stream_rate: Assumed bytes/s per connection before measuring
+        :param step: Factor by which the concurrency is raised or lowered
+        :param smoothing: Weight of the newest sample in the moving averages
+        """
+
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_part_seconds = target_part_seconds
+        self.step = step
+        self.smoothing = smoothing
+
+        self._lock = threading.Lock()
+        self._concurrency = float(initial_concurrency)
+        self._direction = 1
+        self._stream_rate = float(initial_stream_rate)
+        self._last_rate = None
+
+    @property
+    def concurrency(self):
+        with self._lock:
+            return int(round(self._concurrency))
+
+    @property
+    def stream_rate(self):
+        """Smoothed throughput of a single connection in bytes/s"""
+        with self._lock:
+            return self._stream_rate
+
+    def part_size_for(self, size, concurrency=None):
+        """Return the part size for an object of size bytes"""
+
+        if concurrency is None:
+            concurrency = self.concurrency
+        with self._lock:
+            part_size = self._stream_rate * self.target_part_seconds
+
+        # Keep every connection busy on objects that are only a few parts long
+        part_size = min(part_size, size / concurrency)
+        # Stay within the S3 limit on the number of parts
+        part_size = max(part_size, -(-size // MAX_PARTS))
+        part_size = min(max(part_size, MIN_PART_SIZE), MAX_PART_SIZE)
+        # Round to whole megabytes
+        return int(-(-part_size // MB) * MB)
+
+    def config_for(self, size):
+        """Return a TransferConfig tuned for an object of size bytes
+
+        :param size: Object size in bytes
+        :return: boto3.s3.transfer.TransferConfig
+        """
+
+        concurrency = self.concurrency
+        part_size = self.part_size_for(size, concurrency)
+        # An object needs at least two parts before splitting it can help
+        return TransferConfig(multipart_threshold=2 * part_size,
+                              multipart_chunksize=part_size,
+                              max_concurrency=concurrency,
+                              use_threads=True)
+
+    def record(self, size, seconds, config):
+        """Feed back the outcome of a transfer made with config
+
+        :param size: Bytes transferred
+        :param seconds: Wall-clock duration of the transfer
+        :param config: TransferConfig that was used
+        """
+
+        if seconds <= 0 or size < config.multipart_threshold:
+            # Single-request transfers say nothing about concurrency
+            return
+
+        rate = size / seconds
+        parts = -(-size // config.multipart_chunksize)
+        streams = min(config.max_concurrency, parts)
+        with self._lock:
+            self._stream_rate += self.smoothing * (rate / streams - self._stream_rate)
+
+            if self._last_rate is not None:
+                if rate < self._last_rate * 0.95:
+                    # The last step made things worse, turn around
+                    self._direction = -self._direction
+                elif rate <= self._last_rate * 1.05:
+                    # Within noise, stay where we are
+                    self._last_rate += self.smoothing * (rate - self._last_rate)
+                    return
+            self._last_rate = rate
+
+            if self._direction > 0:
+                self._concurrency *= self.step
+            else:
+                self._concurrency /= self.step
+            self._concurrency = min(max(self._concurrency, self.min_concurrency),
+                                    self.max_concurrency)
+
+    def upload_file(self, s3, file_name, bucket_name, object_name, **kwargs):
+        """Upload a file with a tuned config and record the throughput
+
+        :param s3: S3 client
+        :return: Duration of the upload in seconds
+        """
+
+        size = os.path.getsize(file_name)
+        config = self.config_for(size)
+        start = time.perf_counter()
+        s3.upload_file(file_name, bucket_name, object_name, Config=config, **kwargs)
+        elapsed = time.perf_counter() - start
+        self.record(size, elapsed, config)
+        return elapsed
+
+    def download_file(self, s3, file_name, bucket_name, object_name, size=None, **kwargs):
+        """Download an object with a tuned config and record the throughput
+
+        :param s3: S3 client
+        :param size: Object size. If not specified, it is read with HeadObject
+        :return: Duration of the download in seconds
+        """
+
+        if size is None:
+            size = s3.head_object(Bucket=bucket_name, Key=object_name)['ContentLength']
+        config = self.config_for(size)
+        start = time.perf_counter()
+        s3.download_file(bucket_name, object_name, file_name, Config=config, **kwargs)
+        elapsed = time.perf_counter() - start
+        self.record(size, elapsed, config)
+        return elapsed
+
+
+_default_tuner = None
+_default_tuner_lock = threading.Lock()
+
+
+def get_default_tuner():
+    """Return the process-wide TransferTuner, creating it on first use"""
+
+    global _default_tuner
+
+    with _default_tuner_lock:
+        if _default_tuner is None:
+            _default_tuner = TransferTuner()
+    return _default_tuner
+
+
+class BufferReader:
+    """Read-only file object over a bytes-like buffer that never copies it
+
+    read() hands out memoryview slices of the buffer, so botocore streams
+    straight from the caller's memory or memory map. seek() and tell() let
+    botocore rewind the body when it retries a request.
+    """
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast('B')
+        self._position = 0
+
+    def __len__(self):
+        return len(self._view) - self._position
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else self._position + size
+        data = self._view[self._position:end]
+        self._position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += len(self._view)
+        self._position = min(max(offset, 0), len(self._view))
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self._view.release()
+
+
+class _Crc32:
+    # hashlib-style wrapper so CRC32 fits the same code path as the digests
+
+    def __init__(self):
+        self._crc = 0
+
+    def update(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+
+    def digest(self):
+        return self._crc.to_bytes(4, 'big')
+
+
+class _Crc32c(_Crc32):
+
+    def update(self, data):
+        self._crc = crt_checksums.crc32c(data, self._crc)
+
+
+# Algorithm -> (hash factory, name used in S3 request and response fields)
+CHECKSUM_ALGORITHMS = {
+    'md5': (hashlib.md5, None),
+    'sha1': (hashlib.sha1, 'SHA1'),
+    'sha256': (hashlib.sha256, 'SHA256'),
+    'crc32': (_Crc32, 'CRC32'),
+    'crc32c': (_Crc32c, 'CRC32C'),
+}
+
+
+def _new_hash(algorithm):
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise ValueError(f'Unsupported checksum algorithm {algorithm}')
+    if algorithm == 'crc32c' and crt_checksums is None:
+        raise ValueError('crc32c checksums need the awscrt package')
+    return CHECKSUM_ALGORITHMS[algorithm][0]()
+
+
+def _encode_checksum(digest, algorithm):
+    # S3 reports MD5 as the hex ETag and every other algorithm as base64
+    if algorithm == 'md5':
+        return binascii.hexlify(digest).decode('ascii')
+    return base64.b64encode(digest).decode('ascii')
+
+
+def combine_checksums(part_digests, algorithm):
+    """Combine per-part digests into the object checksum S3 reports
+
+    A single-part object reports the digest of its data. A multipart object
+    reports the digest of the concatenated part digests followed by the
+    part count, the same way as multipart ETags.
+
+    :param part_digests: Raw digests of the parts in part order
+    :param algorithm: Any of CHECKSUM_ALGORITHMS
+    :return: Checksum string in the format S3 returns it, without ETag quotes
+    """
+
+    if len(part_digests) == 1:
+        return _encode_checksum(part_digests[0], algorithm)
+    combined = _new_hash(algorithm)
+    for digest in part_digests:
+        combined.update(digest)
+    return f'{_encode_checksum(combined.digest(), algorithm)}-{len(part_digests)}'
+
+
+def _reported_checksum(response, algorithm):
+    if algorithm == 'md5':
+        return response['ETag'].strip('"')
+    return response.get('Checksum' + CHECKSUM_ALGORITHMS[algorithm][1])
+
+
+def _checksum_result(digests, expected, algorithm):
+    checksum = combine_checksums(digests, algorithm)
+    if expected is not None:
+        expected = expected.strip('"')
+        # Some S3-compatible stores leave the part count off combined checksums
+        if len(digests) > 1 and '-' not in expected:
+            expected = f'{expected}-{len(digests)}'
+    return {'algorithm': algorithm, 'checksum': checksum, 'expected': expected,
+            'match': checksum == expected if expected is not None else None}
+
+
+def _checksum_arguments(digest, algorithm):
+    # Lets S3 verify the data against the digest computed on the way out
+    if algorithm is None:
+        return {}
+    if algorithm == 'md5':
+        return {'ContentMD5': base64.b64encode(digest).decode('ascii')}
+    return {'Checksum' + CHECKSUM_ALGORITHMS[algorithm][1]:
+            base64.b64encode(digest).decode('ascii')}
+
+
+def _digest(view, algorithm):
+    if algorithm is None:
+        return None
+    h = _new_hash(algorithm)
+    h.update(view)
+    return h.digest()
+
+
+def _upload_part(s3, bucket_name, object_name, upload_id, part_number, view, algorithm):
+    # The slice is hashed from memory right before it is sent, so the file
+    # is only read from disk once
+    try:
+        digest = _digest(view, algorithm)
+        checksum_arguments = _checksum_arguments(digest, algorithm)
+        body = BufferReader(view)
+        try:
+            response = s3.upload_part(Bucket=bucket_name, Key=object_name,
+                                      UploadId=upload_id, PartNumber=part_number,
+                                      Body=body, **checksum_arguments)
+        finally:
+            body.close()
+    finally:
+        # Views left on a memory map would keep it from being closed
+        view.release()
+
+    part = {'PartNumber': part_number, 'ETag': response['ETag']}
+    if algorithm != 'md5':
+        # CompleteMultipartUpload needs the checksum of every part
+        part.update(checksum_arguments)
+    return part, digest
+
+
+def _upload_view(view, bucket_name, object_name, tuner, part_size, max_concurrency,
+                 multipart_threshold, algorithm, kwargs):
+    # Returns the PutObject/CompleteMultipartUpload response and the part digests
+    size = len(view)
+    # Arguments the caller gave win over the tuner
+    if tuner is not None:
+        config = tuner.config_for(size)
+        part_size = part_size or config.multipart_chunksize
+        max_concurrency = max_concurrency or config.max_concurrency
+        multipart_threshold = multipart_threshold or config.multipart_threshold
+    if max_concurrency is None:
+        max_concurrency = DEFAULT_MAX_CONCURRENCY
+    if part_size is None:
+        part_size = max(MIN_PART_SIZE, -(-size // MAX_PARTS))
+    if multipart_threshold is None:
+        multipart_threshold = 2 * part_size
+
+    s3 = get_client('s3', max_pool_connections=max(max_concurrency,
+                                                   DEFAULT_MAX_POOL_CONNECTIONS))
+    start = time.perf_counter()
+    if size < multipart_threshold:
+        digest = _digest(view, algorithm)
+        body = BufferReader(view)
+        try:
+            response = s3.put_object(Bucket=bucket_name, Key=object_name, Body=body,
+                                     **_checksum_arguments(digest, algorithm), **kwargs)
+        finally:
+            body.close()
+        return response, [digest]
+
+    if algorithm not in (None, 'md5'):
+        kwargs = dict(kwargs, ChecksumAlgorithm=CHECKSUM_ALGORITHMS[algorithm][1])
+    upload_id = s3.create_multipart_upload(Bucket=bucket_name, Key=object_name,
+                                           **kwargs)['UploadId']
+    try:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = [executor.submit(_upload_part, s3, bucket_name, object_name,
+                                       upload_id, part_number,
+                                       view[offset:offset + part_size], algorithm)
+                       for part_number, offset in enumerate(range(0, size, part_size), 1)]
+            results = [future.result() for future in futures]
+        response = s3.complete_multipart_upload(
+            Bucket=bucket_name, Key=object_name, UploadId=upload_id,
+            MultipartUpload={'Parts': [part for part, _ in results]})
+    except Exception:
+        logging.error(f'Aborting multipart upload of {object_name}')
+        s3.abort_multipart_upload(Bucket=bucket_name, Key=object_name, UploadId=upload_id)
+        raise
+
+    if tuner is not None:
+        tuner.record(size, time.perf_counter() - start,
+                     TransferConfig(multipart_threshold=multipart_threshold,
+                                    multipart_chunksize=part_size,
+                                    max_concurrency=max_concurrency))
+    return response, [digest for _, digest in results]
+
+
+def upload_buffer(buffer, bucket_name, object_name, tuner=None, part_size=None,
+                  max_concurrency=None, multipart_threshold=None, **kwargs):
+    """Upload a bytes-like buffer without copying it
+
+    Accepts bytes, bytearray, memoryview, mmap or anything else supporting
+    the buffer protocol. Each part of a multipart upload is a slice of the
+    buffer, so no temporary part buffers are allocated.
+
+    :param buffer: Data to upload
+    :param bucket_name: Bucket to upload to
+    :param object_name: S3 object name
+    :param tuner: TransferTuner to pick part size and concurrency from
+    :param part_size: Size of each part. If not specified, 8 MB or whatever
+    keeps the upload within 10000 parts
+    :param max_concurrency: Number of parts uploaded at once. If not
+    specified, the tuner's choice, or DEFAULT_MAX_CONCURRENCY
+    :param multipart_threshold: Size from which a multipart upload is used.
+    If not specified, twice the part size
+    :param kwargs: Extra arguments for PutObject/CreateMultipartUpload, e.g., ContentType
+    :return: ETag of the uploaded object
+    """
+
+    view = memoryview(buffer).cast('B')
+    try:
+        response, _ = _upload_view(view, bucket_name, object_name, tuner, part_size,
+                                   max_concurrency, multipart_threshold, None, kwargs)
+    finally:
+        view.release()
+    return response['ETag']
+
+
+def _mapped(f):
+    # Empty files cannot be mapped
+    if os.fstat(f.fileno()).st_size == 0:
+        return contextlib.nullcontext(b'')
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def upload_mmap_file(file_name, bucket_name, object_name, **kwargs):
+    """Upload a local file through a read-only memory map
+
+    Parts are read as slices of the map, so the page cache is the only
+    copy of the file in memory. See upload_buffer for the keyword arguments.
+
+    :return: ETag of the uploaded object
+    """
+
+    with open(file_name, 'rb') as f, _mapped(f) as mapped:
+        return upload_buffer(mapped, bucket_name, object_name, **kwargs)
+
+
+def upload_file_with_checksum(file_name, bucket_name, object_name, algorithm='sha256',
+                              tuner=None, part_size=None, max_concurrency=None,
+                              multipart_threshold=None, **kwargs):
+    """Upload a file and verify its checksum in the same pass
+
+    Each part is hashed from the memory map as it is sent and S3 checks it
+    on arrival. The part digests are combined into the object checksum and
+    compared with the one S3 reports, so the file is never read twice.
+    See upload_buffer for the other arguments.
+
+    :param algorithm: 'md5', 'sha1', 'sha256', 'crc32' or 'crc32c' (needs awscrt)
+    :return: Dictionary with 'algorithm', 'checksum' (computed locally),
+    'expected' (reported by S3) and 'match'
+    """
+
+    _new_hash(algorithm)
+    with open(file_name, 'rb') as f, _mapped(f) as mapped:
+        view = memoryview(mapped).cast('B')
+        try:
+            response, digests = _upload_view(view, bucket_name, object_name, tuner,
+                                             part_size, max_concurrency,
+                                             multipart_threshold, algorithm, kwargs)
+        finally:
+            view.release()
+
+    return _checksum_result(digests, _reported_checksum(response, algorithm), algorithm)
+
+
+def _download_range(s3, bucket_name, object_name, etag, file_name, algorithm, start,
+                    end=None):
+    # Streams one part (or the whole object) into place, hashing every
+    # chunk on its way to disk. IfMatch fails the request if the object
+    # was replaced since it was first read.
+    arguments = {'Bucket': bucket_name, 'Key': object_name, 'IfMatch': etag}
+    if end is not None:
+        arguments['Range'] = f'bytes={start}-{end}'
+    response = s3.get_object(**arguments)
+
+    h = _new_hash(algorithm)
+    with open(file_name, 'r+b') as f:
+        f.seek(start)
+        for chunk in response['Body'].iter_chunks(MB):
+            h.update(chunk)
+            f.write(chunk)
+    return h.digest()
+
+
+def download_file_with_checksum(file_name, bucket_name, object_name, algorithm='sha256',
+                                max_concurrency=10):
+    """Download an object and compute its checksum in the same pass
+
+    Multipart objects are fetched part by part in parallel, so the local
+    part digests line up with the ones S3 combined. The result is compared
+    with the checksum S3 reports for the object.
+
+    :param algorithm: 'md5', 'sha1', 'sha256', 'crc32' or 'crc32c' (needs awscrt)
+    :param max_concurrency: Number of parts downloaded at once
+    :return: Dictionary with 'algorithm', 'checksum' (computed locally),
+    'expected' (reported by S3, None if the object has no checksum of this
+    algorithm) and 'match' (None if there was nothing to compare with)
+    :raises ClientError: PreconditionFailed if the object is overwritten
+    during the download, so parts of two versions are never mixed
+    """
+
+    _new_hash(algorithm)
+    s3 = get_client('s3', max_pool_connections=max(max_concurrency,
+                                                   DEFAULT_MAX_POOL_CONNECTIONS))
+    arguments = {} if algorithm == 'md5' else {'ChecksumMode': 'ENABLED'}
+    head = s3.head_object(Bucket=bucket_name, Key=object_name, **arguments)
+    size = head['ContentLength']
+    expected = _reported_checksum(head, algorithm)
+
+    # Multipart objects have an ETag ending in the part count
+    etag = head['ETag'].strip('"')
+    parts_count = int(etag.rsplit('-', 1)[1]) if '-' in etag else 1
+    if parts_count > 1:
+        # Every part but the last has the size of the first one
+        part_size = s3.head_object(Bucket=bucket_name, Key=object_name, PartNumber=1,
+                                   IfMatch=head['ETag'])['ContentLength']
+        if part_size * (parts_count - 1) >= size:
+            raise IOError(f'Cannot determine the part layout of {object_name}')
+
+    with open(file_name, 'wb') as f:
+        f.truncate(size)
+
+    if parts_count == 1:
+        digests = [_download_range(s3, bucket_name, object_name, head['ETag'], file_name,
+                                   algorithm, 0)]
+    else:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = [executor.submit(_download_range, s3, bucket_name, object_name,
+                                       head['ETag'], file_name, algorithm, start,
+                                       min(start + part_size, size) - 1)
+                       for start in range(0, size, part_size)]
+            digests = [future.result() for future in futures]
+
+    return _checksum_result(digests, expected, algorithm)